@@ -0,0 +1,235 @@
+"""
+Helpers shared by the benchmark management commands.
+
+The benchmarks always run against a throwaway database created like the test
+database, and against the stub financial API and stub LLM models, so they are
+reproducible offline and comparable across commits. Their Redis state (the shared
+responses, the circuit breaker, the metrics and the query caches) lives in the
+BENCHMARK_REDIS_URL database, flushed before every scale, and what a process keeps in
+memory of it is dropped too, so a scale doesn't start with what the previous one left.
+"""
+
+import datetime
+import itertools
+import logging
+import subprocess
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import orjson
+import redis
+from celery import signals
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+
+from core import query_cache
+from core.models import Company, Currency
+from core.prompts import get_rag_prompt
+from embeds.templating import TEMPLATE_VERSION, hash_statement, render_statement
+from fin_vantage import instrumentation
+from ingestion import circuit_breaker, scheduling
+from ingestion import client as ingestion_client
+from ingestion.stub_api import (
+    StubApiConfig,
+    StubApiServer,
+    get_statements,
+    get_symbol,
+)
+from ingestion.tasks import parse_financial_statements
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize_latencies(latencies: list[float]) -> dict:
+    if not latencies:
+        return {"count": 0}
+    values = np.array(latencies)
+    return {
+        "count": len(latencies),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+
+@contextmanager
+def benchmark_database():
+    """Creates a fresh, migrated database for the duration of the block."""
+
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield connection.settings_dict["NAME"]
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+# the modules connecting to Redis lazily, through a module level _client
+REDIS_CLIENT_MODULES = (instrumentation, ingestion_client, circuit_breaker, query_cache)
+
+
+def reset_process_state():
+    """Drops the Redis clients of this process and what it kept of the previous run."""
+    for module in REDIS_CLIENT_MODULES:
+        module._client = None
+    circuit_breaker._scripts.clear()
+
+    with instrumentation._lock:
+        instrumentation._pending.clear()
+    with scheduling._lock:
+        scheduling._pending_requests = 0
+    for cache in (query_cache.question_embeddings, query_cache.question_contexts):
+        with cache.local.lock:
+            cache.local.entries.clear()
+    get_rag_prompt.cache_clear()
+
+
+@contextmanager
+def benchmark_redis():
+    """Points the Redis users at the flushed BENCHMARK_REDIS_URL database for the block."""
+
+    url = settings.BENCHMARK_REDIS_URL
+    if url in (settings.CELERY_BROKER_URL, settings.CELERY_RESULT_BACKEND):
+        raise RuntimeError(
+            "BENCHMARK_REDIS_URL is flushed before every run, "
+            "it can't be the Celery broker or result backend."
+        )
+    redis.Redis.from_url(url).flushdb()
+
+    with override_settings(
+        INGESTION_REDIS_URL=url,
+        METRICS_REDIS_URL=url,
+        # the shared tier of the query caches is only measured where it's configured
+        QUERY_CACHE_REDIS_URL=url if settings.QUERY_CACHE_REDIS_URL else None,
+        # the prompt is the local copy, the hub isn't part of what is measured
+        RAG_PROMPT_FROM_HUB=False,
+    ):
+        reset_process_state()
+        try:
+            yield url
+        finally:
+            reset_process_state()
+
+
+@contextmanager
+def stub_environment(config: StubApiConfig, **overrides):
+    """Points the pipeline at the stub API and removes the rate limiting sleeps."""
+
+    if settings.LLM_MODEL != "Stub":
+        raise RuntimeError(
+            "The benchmarks need the stub LLM models, set LLM_MODEL=Stub."
+        )
+
+    with StubApiServer(config) as server, override_settings(
+        FINANCIAL_DATA_API_URL=server.url,
+        FINANCIAL_DATA_API_KEY="benchmark",
+        STOCK_EXCHANGES=[config.exchange],
+        FINANCIAL_DATA_API_REQUEST_DELAY=0,
+        FINANCIAL_DATA_API_RATE_LIMIT_PAUSE=0,
+        EMBEDDING_REQUEST_DELAY=0,
+        **overrides,
+    ):
+        yield server
+
+
+def build_embeddings_payload(companies: int, years: int) -> list[dict]:
+    """A build_financial_embeddings chunk, as generate_financial_sentences queues it."""
+    config = StubApiConfig(companies=companies, years=years)
+    currencies = {"USD": Currency(id=1, code="USD", name="US Dollar", symbol="$")}
+    logger = logging.getLogger("benchmark")
+    statement_ids = itertools.count(1)
+
+    payload = []
+    for index in range(companies):
+        company = Company(
+            id=index + 1, name=f"Benchmark Company {index}", symbol=get_symbol(index)
+        )
+        statements = parse_financial_statements(
+            company.id,
+            company.symbol,
+            get_statements(config, company.symbol),
+            currencies,
+            logger,
+        )
+        for statement in statements:
+            statement.id = next(statement_ids)
+            statement.company = company
+
+        payload.append(
+            {
+                "company_id": company.id,
+                "sentences": [
+                    {
+                        "statement_id": statement.id,
+                        "sentence": render_statement(statement),
+                        "template_version": TEMPLATE_VERSION,
+                        "source_hash": hash_statement(statement),
+                    }
+                    for statement in statements
+                ],
+            }
+        )
+    return payload
+
+
+class TaskTimer:
+    """Collects the duration of every task run while connected, per task name."""
+
+    def __init__(self):
+        self.durations = {}
+        self._started = {}
+
+    def _on_prerun(self, task_id=None, **kwargs):
+        self._started[task_id] = time.perf_counter()
+
+    def _on_postrun(self, task_id=None, task=None, **kwargs):
+        start_time = self._started.pop(task_id, None)
+        if start_time is not None:
+            self.durations.setdefault(task.name, []).append(
+                time.perf_counter() - start_time
+            )
+
+    def __enter__(self):
+        signals.task_prerun.connect(self._on_prerun, weak=False)
+        signals.task_postrun.connect(self._on_postrun, weak=False)
+        return self
+
+    def __exit__(self, *args):
+        signals.task_prerun.disconnect(self._on_prerun)
+        signals.task_postrun.disconnect(self._on_postrun)
+
+    def summary(self) -> dict:
+        return {
+            name: {"runs": len(durations), "seconds": float(sum(durations))}
+            for name, durations in self.durations.items()
+        }
+
+
+def write_report(path: str, report: dict):
+    report = {
+        "commit": get_commit(),
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        **report,
+    }
+    with open(path, "wb") as file:
+        file.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+
+
+def read_report(path: str) -> dict:
+    with open(path, "rb") as file:
+        return orjson.loads(file.read())
@@ -0,0 +1,248 @@
+"""
+Columnar export of the statements and embeddings tables.
+
+Every dataset is exported as a zip archive produced as a stream with constant memory.
+The rows are read once, through a single server-side cursor, and every chunk of rows
+is split into one member per column:
+
+- vectors are stored as plain ``.npy`` members, loadable with ``numpy.load``
+- scalar columns are zstd compressed raw little-endian arrays (``.zst``), strings
+  are zstd compressed JSON lines
+- ``manifest.json`` lists the members of every column in row order, with its dtype,
+  scale and row count
+
+The cursor holds its snapshot, and so VACUUM, while the client downloads the archive,
+so the export is cut short once a statement or the wait for the client takes longer
+than EXPORT_STATEMENT_TIMEOUT.
+"""
+
+import io
+import zipfile
+from collections.abc import Iterator
+from typing import BinaryIO
+
+import numpy as np
+import orjson
+import zstandard
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BigIntegerField, F, FilteredRelation, Q
+from django.db.models.functions import Cast
+
+from core.models import FinancialStatement
+from embeds.models import FinancialStatementAnalysis
+from embeds.versions import get_active_version
+
+CHUNK_SIZE = 10_000
+ZSTD_LEVEL = 3
+
+# decimals are exported as integer cents, exact up to 2^63 cents, about 9.2e16 in
+# the currency's units; past that the cast to bigint fails the export, it doesn't wrap
+DECIMAL_SCALE = 100
+# the cents of the missing amounts, the fields of the endpoints that weren't fetched
+NULL_CENTS = np.iinfo(np.int64).min
+
+
+def _decimal_column(field: str, null: bool = False) -> dict:
+    return {
+        "expression": Cast(F(field) * DECIMAL_SCALE, BigIntegerField()),
+        "dtype": "<i8",
+        "scale": DECIMAL_SCALE,
+        **({"null": int(NULL_CENTS)} if null else {}),
+    }
+
+
+def _get_analyses():
+    # the embeddings of the active version, joined rather than looked up per row
+    return FinancialStatementAnalysis.objects.annotate(
+        active_embedding=FilteredRelation(
+            "embeddings", condition=Q(embeddings__version=get_active_version())
+        )
+    ).order_by("id")
+
+
+DATASETS = {
+    "statements": {
+        "queryset": lambda: FinancialStatement.objects.order_by("id"),
+        "columns": {
+            "id": {"dtype": "<i8"},
+            "company_id": {"dtype": "<i8"},
+            "symbol": {"expression": F("company__symbol"), "dtype": "jsonl"},
+            "date_reported": {"dtype": "<M8[D]"},
+            "calendar_year": {"dtype": "<i4"},
+            "period": {"dtype": "jsonl"},
+            "currency": {"expression": F("currency__code"), "dtype": "jsonl"},
+            "revenue": _decimal_column("revenue"),
+            "net_income": _decimal_column("net_income"),
+            "gross_profit": _decimal_column("gross_profit"),
+            "operating_income": _decimal_column("operating_income"),
+            "income_before_tax": _decimal_column("income_before_tax"),
+            "operating_expenses": _decimal_column("operating_expenses"),
+            "research_and_development_expenses": _decimal_column(
+                "research_and_development_expenses"
+            ),
+            **{
+                field: _decimal_column(field, null=True)
+                for field in (
+                    "cash_and_cash_equivalents",
+                    "total_assets",
+                    "total_liabilities",
+                    "total_stockholders_equity",
+                    "total_debt",
+                    "operating_cash_flow",
+                    "capital_expenditure",
+                    "free_cash_flow",
+                    "dividends_paid",
+                )
+            },
+        },
+    },
+    "analyses": {
+        "queryset": _get_analyses,
+        "columns": {
+            "id": {"dtype": "<i8"},
+            "financial_statement_id": {"dtype": "<i8"},
+            "last_modified": {"dtype": "<M8[D]"},
+            "analysis_text": {"dtype": "jsonl"},
+            "embedding": {
+                "expression": F("active_embedding__embedding"),
+                "dtype": "<f4",
+                "shape": lambda: (getattr(get_active_version(), "dimension", 0),),
+            },
+        },
+    },
+}
+
+
+class _StreamBuffer(io.RawIOBase):
+    """Unseekable sink collecting what the zip writer produces until it is drained."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _resolve(value):
+    # the columns depending on the database are given as callables
+    return value() if callable(value) else value
+
+
+def _iter_row_chunks(queryset, columns: dict) -> Iterator[list[tuple]]:
+    expressions = {
+        f"_export_{name}": column["expression"]
+        for name, column in columns.items()
+        if "expression" in column
+    }
+    values = queryset.annotate(**expressions).values_list(
+        *(
+            f"_export_{name}" if "expression" in column else name
+            for name, column in columns.items()
+        )
+    )
+
+    chunk = []
+    for row in values.iterator(chunk_size=CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _encode_values(values: tuple, column: dict) -> bytes:
+    if column["dtype"] == "jsonl":
+        return b"".join(orjson.dumps(value) + b"\n" for value in values)
+    if "null" in column:
+        values = [column["null"] if value is None else value for value in values]
+    return np.array(values, dtype=column["dtype"]).tobytes()
+
+
+def _encode_vectors(values: tuple, column: dict) -> np.ndarray:
+    vectors = np.full((len(values), *column["shape"]), np.nan, dtype=column["dtype"])
+    for index, vector in enumerate(values):
+        if vector is not None:
+            vectors[index] = vector
+    return vectors
+
+
+def iter_export_archive(dataset: str) -> Iterator[bytes]:
+    """Yields the zip archive of the given dataset, chunk by chunk."""
+
+    spec = DATASETS[dataset]
+    sink = _StreamBuffer()
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    timeout = int(settings.EXPORT_STATEMENT_TIMEOUT * 1000)
+
+    with transaction.atomic(), zipfile.ZipFile(
+        sink, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True
+    ) as archive:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SET LOCAL statement_timeout = {timeout}")
+            cursor.execute(f"SET LOCAL idle_in_transaction_session_timeout = {timeout}")
+
+        columns = {
+            name: (
+                {**column, "shape": _resolve(column["shape"])}
+                if "shape" in column
+                else column
+            )
+            for name, column in spec["columns"].items()
+        }
+        manifest = {"dataset": dataset, "rows": 0, "columns": {}}
+        for name, column in columns.items():
+            manifest["columns"][name] = {
+                "files": [],
+                "dtype": column["dtype"],
+                "encoding": "npy" if "shape" in column else "zstd",
+                **({"shape": [0, *column["shape"]]} if "shape" in column else {}),
+                **({"scale": column["scale"]} if "scale" in column else {}),
+                **({"null": column["null"]} if "null" in column else {}),
+            }
+
+        for part, chunk in enumerate(_iter_row_chunks(spec["queryset"](), columns)):
+            for (name, column), values in zip(columns.items(), zip(*chunk)):
+                is_vector = "shape" in column
+                filename = (
+                    f"{dataset}/{name}/{part:05d}.{'npy' if is_vector else 'zst'}"
+                )
+                with archive.open(filename, mode="w", force_zip64=True) as member:
+                    if is_vector:
+                        np.save(member, _encode_vectors(values, column))
+                    else:
+                        member.write(
+                            compressor.compress(_encode_values(values, column))
+                        )
+                manifest["columns"][name]["files"].append(filename)
+
+            manifest["rows"] += len(chunk)
+            yield sink.drain()
+
+        for name, column in columns.items():
+            if "shape" in column:
+                manifest["columns"][name]["shape"][0] = manifest["rows"]
+        archive.writestr(
+            "manifest.json", orjson.dumps(manifest, option=orjson.OPT_INDENT_2)
+        )
+
+    yield sink.drain()
+
+
+def write_export_archive(dataset: str, file: BinaryIO) -> int:
+    """Writes the zip archive of the given dataset to the file, and returns its size."""
+    size = 0
+    for chunk in iter_export_archive(dataset):
+        file.write(chunk)
+        size += len(chunk)
+    return size
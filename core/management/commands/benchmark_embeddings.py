@@ -0,0 +1,88 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmark import build_embeddings_payload, write_report
+from embeds.models import LlmModel
+
+
+class Command(BaseCommand):
+    help = (
+        "Embeds the same stub statement sentences with each provider and reports "
+        "their throughput in sentences per second."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--providers",
+            nargs="+",
+            default=["Local", "MistralAI"],
+            help="LlmModel providers, MistralAI needs its API key.",
+        )
+        parser.add_argument("--companies", type=int, default=200)
+        parser.add_argument("--years", type=int, default=5)
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=0,
+            help="Sentences per embed_documents call, 0 for one call per company "
+            "as build_financial_embeddings does.",
+        )
+        parser.add_argument("--output", default="benchmark_embeddings.json")
+
+    def handle(self, *args, **options):
+        payload = build_embeddings_payload(options["companies"], options["years"])
+        if options["batch_size"]:
+            sentences = [
+                sentence["sentence"]
+                for company in payload
+                for sentence in company["sentences"]
+            ]
+            batches = [
+                sentences[index : index + options["batch_size"]]
+                for index in range(0, len(sentences), options["batch_size"])
+            ]
+        else:
+            batches = [
+                [sentence["sentence"] for sentence in company["sentences"]]
+                for company in payload
+            ]
+        sentences_count = sum(len(batch) for batch in batches)
+
+        results = {}
+        for provider in options["providers"]:
+            model = getattr(LlmModel, provider, None)
+            if model is None:
+                raise CommandError(f"Unknown provider {provider}.")
+            embeddings = model.embedding_model(model=model.model_name)
+
+            # a first call loads the model, or opens the connection, outside the timing
+            embeddings.embed_query("warm up")
+
+            start_time = time.perf_counter()
+            for batch in batches:
+                embeddings.embed_documents(batch)
+            duration = time.perf_counter() - start_time
+
+            results[provider] = {
+                "model": model.model_name,
+                "sentences": sentences_count,
+                "calls": len(batches),
+                "seconds": duration,
+                "sentences_per_second": sentences_count / duration,
+            }
+            self.stdout.write(
+                f"{provider} ({model.model_name}): "
+                f"{sentences_count / duration:.1f} sentences/s"
+            )
+
+        write_report(
+            options["output"],
+            {
+                "parameters": {
+                    key: options[key] for key in ("companies", "years", "batch_size")
+                },
+                "providers": results,
+            },
+        )
+        self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}."))
@@ -0,0 +1,102 @@
+import logging
+import logging.handlers
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.benchmark import summarize_latencies, write_report
+from fin_vantage.log_handlers import AsyncHandler, SamplingFilter, stop_listener
+
+
+def get_sync_handler(path: str) -> logging.Handler:
+    # the handlers the task loggers had before, formatting and writing on the caller
+    handler = logging.handlers.TimedRotatingFileHandler(
+        path, when="midnight", encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter(settings.VERBOSE_FORMAT, style="{"))
+    return handler
+
+
+def get_async_handler(path: str) -> logging.Handler:
+    return AsyncHandler(path, console_level=None)
+
+
+def get_sampled_handler(path: str) -> logging.Handler:
+    handler = AsyncHandler(path, console_level=None)
+    handler.addFilter(SamplingFilter(settings.LOG_DEBUG_SAMPLE_RATE))
+    return handler
+
+
+SETUPS = {
+    "sync": (get_sync_handler, logging.INFO),
+    "async": (get_async_handler, logging.INFO),
+    "async, sampled debug": (get_sampled_handler, logging.DEBUG),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the cost of a per symbol log record on the logging thread, with the "
+        "synchronous file handlers, the async JSON handlers, and the async handlers "
+        "sampling DEBUG records."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--records", type=int, default=50000)
+        parser.add_argument("--output", default="benchmark_logging.json")
+
+    def handle(self, *args, **options):
+        symbols = [f"SYM{index}" for index in range(10)]
+        results = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for name, (get_handler, level) in SETUPS.items():
+                path = os.path.join(directory, f"{name}.log")
+                handler = get_handler(path)
+                logger = logging.getLogger(f"benchmark_logging.{name}")
+                logger.handlers = [handler]
+                logger.setLevel(logging.DEBUG)
+                logger.propagate = False
+
+                latencies = []
+                start_time = time.perf_counter()
+                for index in range(options["records"]):
+                    record_start_time = time.perf_counter()
+                    logger.log(
+                        level,
+                        f"Fetching data for {', '.join(symbols)}",
+                        extra={"symbols": symbols, "index": index},
+                    )
+                    latencies.append(time.perf_counter() - record_start_time)
+                logged_seconds = time.perf_counter() - start_time
+
+                # the async handlers are done once their listener wrote everything
+                stop_listener()
+                total_seconds = time.perf_counter() - start_time
+                handler.close()
+
+                results[name] = {
+                    "per_record": summarize_latencies(latencies),
+                    "logging_seconds": logged_seconds,
+                    "written_seconds": total_seconds,
+                    "bytes": os.path.getsize(path),
+                }
+                self.stdout.write(
+                    f"{name}: mean {results[name]['per_record']['mean'] * 1e6:.1f}us, "
+                    f"p99 {results[name]['per_record']['p99'] * 1e6:.1f}us per record, "
+                    f"{total_seconds:.2f}s until written"
+                )
+
+        write_report(
+            options["output"],
+            {
+                "parameters": {
+                    "records": options["records"],
+                    "debug_sample_rate": settings.LOG_DEBUG_SAMPLE_RATE,
+                },
+                "setups": results,
+            },
+        )
+        self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}."))
@@ -0,0 +1,192 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client
+from waffle.models import Switch
+
+from core.benchmark import (
+    TaskTimer,
+    benchmark_database,
+    benchmark_redis,
+    read_report,
+    stub_environment,
+    summarize_latencies,
+    write_report,
+)
+from core.models import Company, FinancialStatement
+from embeds.models import FinancialStatementAnalysis
+from embeds.tasks import generate_financial_sentences
+from fin_vantage.celery import app
+from ingestion.stub_api import StubApiConfig
+from ingestion.tasks import schedule_financial_fetching, sync_companies
+
+# the loggers are silenced during the run, per symbol lines would dominate the timings
+TASK_LOGGERS = [
+    "sync_companies",
+    "schedule_financial_fetching",
+    "fetch_financial_report",
+    "generate_financial_sentences",
+    "build_financial_embeddings",
+]
+
+# stage name -> (task, model whose rows the stage produces)
+STAGES = {
+    "sync_companies": (sync_companies, Company),
+    "fetch_financial_reports": (schedule_financial_fetching, FinancialStatement),
+    "build_financial_embeddings": (
+        generate_financial_sentences,
+        FinancialStatementAnalysis,
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the whole pipeline, from sync_companies to /api/ask/, against the stub "
+        "financial API and the stub LLM models, and reports throughput and latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scales", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+        )
+        parser.add_argument("--years", type=int, default=5)
+        parser.add_argument(
+            "--api-latency",
+            type=float,
+            default=0.0,
+            help="Seconds the stub API waits before answering.",
+        )
+        parser.add_argument(
+            "--rate-limit-every",
+            type=int,
+            default=0,
+            help="Answer every n-th stub API request with a 429.",
+        )
+        parser.add_argument("--embedding-latency", type=float, default=0.0)
+        parser.add_argument("--chat-latency", type=float, default=0.0)
+        parser.add_argument("--questions", type=int, default=50)
+        parser.add_argument("--output", default="benchmark_pipeline.json")
+        parser.add_argument(
+            "--compare", help="A previous report to compare the results against."
+        )
+
+    def handle(self, *args, **options):
+        app.conf.task_always_eager = True
+        app.conf.task_eager_propagates = True
+
+        for name in TASK_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+        results = {}
+        for scale in options["scales"]:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{scale} companies"))
+            results[str(scale)] = self.run_scale(scale, options)
+
+        write_report(
+            options["output"],
+            {
+                "parameters": {
+                    key: options[key]
+                    for key in (
+                        "years",
+                        "api_latency",
+                        "rate_limit_every",
+                        "embedding_latency",
+                        "chat_latency",
+                        "questions",
+                    )
+                },
+                "scales": results,
+            },
+        )
+        self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}."))
+
+        if options["compare"]:
+            self.compare(read_report(options["compare"]), results)
+
+    def run_scale(self, scale: int, options: dict) -> dict:
+        config = StubApiConfig(
+            companies=scale,
+            years=options["years"],
+            latency=options["api_latency"],
+            rate_limit_every=options["rate_limit_every"],
+        )
+
+        with benchmark_database(), benchmark_redis(), stub_environment(
+            config,
+            STUB_EMBEDDING_LATENCY=options["embedding_latency"],
+            STUB_CHAT_LATENCY=options["chat_latency"],
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"],
+        ), TaskTimer() as timer:
+            Switch.objects.update_or_create(name="paid-plan", defaults={"active": True})
+
+            stages = {}
+            for name, (task, model) in STAGES.items():
+                count_before = model.objects.count()
+                start_time = time.perf_counter()
+                task.apply()
+                duration = time.perf_counter() - start_time
+                items = model.objects.count() - count_before
+
+                stages[name] = {
+                    "seconds": duration,
+                    "items": items,
+                    "items_per_second": items / duration if duration else None,
+                }
+                self.stdout.write(
+                    f"  {name}: {items} {model.__name__} rows in {duration:.2f}s"
+                )
+
+            ask_latencies = self.ask_questions(scale, options["questions"])
+            self.stdout.write(
+                f"  ask: p50 {ask_latencies.get('p50', 0) * 1000:.1f}ms, "
+                f"p99 {ask_latencies.get('p99', 0) * 1000:.1f}ms"
+            )
+
+            return {"stages": stages, "tasks": timer.summary(), "ask": ask_latencies}
+
+    def ask_questions(self, scale: int, questions: int) -> dict:
+        client = Client()
+        latencies = []
+        for index in range(questions):
+            company = (index * 7919) % scale
+            start_time = time.perf_counter()
+            response = client.get(
+                "/api/ask/",
+                {
+                    "question": f"What was the revenue of Benchmark Company {company} in 2023?"
+                },
+            )
+            latencies.append(time.perf_counter() - start_time)
+            if response.status_code != 200:
+                raise RuntimeError(f"/api/ask/ answered with {response.status_code}")
+        return summarize_latencies(latencies)
+
+    def compare(self, previous: dict, results: dict):
+        self.stdout.write(
+            self.style.MIGRATE_HEADING(f"Compared to {previous.get('commit')}")
+        )
+        for scale, result in results.items():
+            previous_result = previous.get("scales", {}).get(scale)
+            if not previous_result:
+                continue
+
+            for name, stage in result["stages"].items():
+                before = previous_result["stages"].get(name, {}).get("items_per_second")
+                after = stage["items_per_second"]
+                if before and after:
+                    self.stdout.write(
+                        f"  {scale} {name}: {before:.1f} -> {after:.1f} items/s "
+                        f"({(after / before - 1) * 100:+.1f}%)"
+                    )
+
+            before = previous_result.get("ask", {}).get("p50")
+            after = result["ask"].get("p50")
+            if before and after:
+                self.stdout.write(
+                    f"  {scale} ask p50: {before * 1000:.1f} -> {after * 1000:.1f}ms "
+                    f"({(after / before - 1) * 100:+.1f}%)"
+                )
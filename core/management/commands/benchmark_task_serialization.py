@@ -0,0 +1,121 @@
+import time
+
+from django.core.management.base import BaseCommand
+from kombu.serialization import dumps, loads
+
+from core.benchmark import build_embeddings_payload, summarize_latencies, write_report
+from fin_vantage.celery import app
+from fin_vantage.serialization import SERIALIZER_NAME
+
+SERIALIZERS = ["json", SERIALIZER_NAME]
+BENCHMARK_QUEUE = "benchmark_serialization"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the size and the encoding and decoding latency of the "
+        "build_financial_embeddings payloads across the task serializers, and "
+        "optionally their enqueue/dequeue latency and memory on the broker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-sizes",
+            type=int,
+            nargs="+",
+            default=[1, 20, 100],
+            help="Companies per payload.",
+        )
+        parser.add_argument("--years", type=int, default=5)
+        parser.add_argument("--repeats", type=int, default=200)
+        parser.add_argument(
+            "--broker",
+            action="store_true",
+            help="Also send the payloads through the configured Celery broker.",
+        )
+        parser.add_argument("--output", default="benchmark_task_serialization.json")
+
+    def handle(self, *args, **options):
+        results = {}
+        for chunk_size in options["chunk_sizes"]:
+            # the message body of a task, as the Celery protocol 2 sends it
+            body = (
+                [build_embeddings_payload(chunk_size, options["years"])],
+                {},
+                {"callbacks": None, "errbacks": None, "chain": None, "chord": None},
+            )
+            results[str(chunk_size)] = {}
+            for serializer in SERIALIZERS:
+                result = self.measure_codec(body, serializer, options["repeats"])
+                if options["broker"]:
+                    result["broker"] = self.measure_broker(
+                        body, serializer, options["repeats"]
+                    )
+                results[str(chunk_size)][serializer] = result
+
+                self.stdout.write(
+                    f"{chunk_size} companies, {serializer}: {result['bytes']} bytes, "
+                    f"encode p50 {result['encode']['p50'] * 1000:.3f}ms, "
+                    f"decode p50 {result['decode']['p50'] * 1000:.3f}ms"
+                )
+
+        write_report(
+            options["output"],
+            {
+                "parameters": {
+                    key: options[key]
+                    for key in ("chunk_sizes", "years", "repeats", "broker")
+                },
+                "chunk_sizes": results,
+            },
+        )
+        self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}."))
+
+    def measure_codec(self, body, serializer: str, repeats: int) -> dict:
+        encode_latencies, decode_latencies = [], []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            content_type, content_encoding, data = dumps(body, serializer=serializer)
+            encode_latencies.append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            loads(data, content_type, content_encoding, accept={content_type})
+            decode_latencies.append(time.perf_counter() - start_time)
+
+        return {
+            "bytes": len(data),
+            "encode": summarize_latencies(encode_latencies),
+            "decode": summarize_latencies(decode_latencies),
+        }
+
+    def measure_broker(self, body, serializer: str, repeats: int) -> dict:
+        enqueue_latencies, dequeue_latencies = [], []
+        memory = None
+        with app.connection_for_write() as connection:
+            simple_queue = connection.SimpleQueue(BENCHMARK_QUEUE)
+            try:
+                simple_queue.clear()
+                for _ in range(repeats):
+                    start_time = time.perf_counter()
+                    simple_queue.put(body, serializer=serializer)
+                    enqueue_latencies.append(time.perf_counter() - start_time)
+
+                if connection.transport.driver_type == "redis":
+                    client = connection.default_channel.client
+                    memory = client.memory_usage(BENCHMARK_QUEUE)
+
+                for _ in range(repeats):
+                    start_time = time.perf_counter()
+                    message = simple_queue.get(timeout=10)
+                    message.decode()
+                    dequeue_latencies.append(time.perf_counter() - start_time)
+                    message.ack()
+            finally:
+                simple_queue.clear()
+                simple_queue.close()
+
+        return {
+            "enqueue": summarize_latencies(enqueue_latencies),
+            "dequeue": summarize_latencies(dequeue_latencies),
+            "memory_per_message": memory / repeats if memory else None,
+        }
@@ -0,0 +1,150 @@
+import logging
+import time
+
+from celery.contrib.testing.worker import start_worker
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from waffle.models import Switch
+
+from core.benchmark import (
+    benchmark_database,
+    benchmark_redis,
+    stub_environment,
+    write_report,
+)
+from core.models import CompanyDataTracker, FinancialStatement
+from fin_vantage.celery import app
+from fin_vantage.worker_profiles import WORKER_PROFILES, get_worker_profile
+from ingestion.stub_api import StubApiConfig
+from ingestion.tasks import (
+    dispatch_fetching,
+    fetch_financial_report,
+    get_companies_to_fetch,
+    sync_companies,
+)
+
+TASK_LOGGERS = [
+    "sync_companies",
+    "schedule_financial_fetching",
+    "fetch_financial_report",
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the financial report fetching against the stub financial API in a worker "
+        "configured by each profile (pool, concurrency, prefetch, acks) and reports its "
+        "throughput. The worker runs in process, on the configured Celery broker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--profiles", nargs="+", default=list(WORKER_PROFILES), metavar="PROFILE"
+        )
+        parser.add_argument("--companies", type=int, default=2_000)
+        parser.add_argument("--years", type=int, default=5)
+        parser.add_argument(
+            "--api-latency",
+            type=float,
+            default=0.05,
+            help="Seconds the stub API waits before answering.",
+        )
+        parser.add_argument("--timeout", type=float, default=600)
+        parser.add_argument("--output", default="benchmark_worker_profiles.json")
+
+    def handle(self, *args, **options):
+        try:
+            profiles = [get_worker_profile(name) for name in options["profiles"]]
+        except ValueError as e:
+            raise CommandError(e)
+
+        for name in TASK_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+        config = StubApiConfig(
+            companies=options["companies"],
+            years=options["years"],
+            latency=options["api_latency"],
+        )
+
+        results = {}
+        with benchmark_database(), stub_environment(config):
+            Switch.objects.update_or_create(name="paid-plan", defaults={"active": True})
+            sync_companies.apply()
+
+            for profile in profiles:
+                with benchmark_redis():
+                    results[profile.name] = self.run_profile(
+                        profile, options["timeout"]
+                    )
+                result = results[profile.name]
+                self.stdout.write(
+                    f"{profile.name} ({profile.pool} x{profile.concurrency}, "
+                    f"prefetch {profile.prefetch_multiplier}): "
+                    f"{result['companies_per_second']:.1f} companies/s, "
+                    f"{result['statements_per_second']:.1f} statements/s"
+                )
+
+        write_report(
+            options["output"],
+            {
+                "parameters": {
+                    key: options[key] for key in ("companies", "years", "api_latency")
+                },
+                "profiles": results,
+            },
+        )
+        self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}."))
+
+    def run_profile(self, profile, timeout: float) -> dict:
+        # every profile fetches the same companies from scratch
+        FinancialStatement.objects.all().delete()
+        CompanyDataTracker.objects.update(
+            fetch_status=CompanyDataTracker.FetchStatus.PENDING,
+            fetch_attempts=0,
+            last_financial_report_fetch=None,
+            next_fetch_eligible_at=None,
+        )
+        companies = [
+            (company_id, symbol) for company_id, symbol, _ in get_companies_to_fetch()
+        ]
+
+        # the tasks are bound already, the profile's acks can only be set on them
+        fetch_financial_report.acks_late = profile.acks_late
+        # the prefork children must not share the connections of this process
+        connections.close_all()
+
+        queue = f"benchmark_{profile.name}"
+        with start_worker(
+            app,
+            pool=profile.pool,
+            concurrency=profile.concurrency,
+            prefetch_multiplier=profile.prefetch_multiplier,
+            queues=[queue],
+            perform_ping_check=False,
+            shutdown_timeout=timeout,
+        ):
+            start_time = time.perf_counter()
+            dispatch_fetching(companies, queue, logging.getLogger("benchmark"))
+            while CompanyDataTracker.objects.filter(
+                fetch_status=CompanyDataTracker.FetchStatus.IN_FLIGHT
+            ).exists():
+                if time.perf_counter() - start_time > timeout:
+                    raise CommandError(
+                        f"The {profile.name} profile didn't finish in {timeout}s."
+                    )
+                time.sleep(0.2)
+            duration = time.perf_counter() - start_time
+
+        statements = FinancialStatement.objects.count()
+        return {
+            "pool": profile.pool,
+            "concurrency": profile.concurrency,
+            "prefetch_multiplier": profile.prefetch_multiplier,
+            "acks_late": profile.acks_late,
+            "seconds": duration,
+            "companies": len(companies),
+            "statements": statements,
+            "companies_per_second": len(companies) / duration,
+            "statements_per_second": statements / duration,
+        }
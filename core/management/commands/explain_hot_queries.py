@@ -0,0 +1,80 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+
+from embeds.tasks import get_companies_to_describe, get_statements_to_describe
+from ingestion.tasks import get_companies_to_fetch
+
+# tables that grow with history and must never be scanned sequentially by the nightly jobs
+HISTORY_TABLES = (
+    "core_companydatatracker",
+    "core_financialstatement",
+    "embeds_financialstatementanalysis",
+)
+
+
+def get_hot_queries(sample_size: int) -> dict:
+    companies_to_describe = get_companies_to_describe()
+    sample_company_ids = list(
+        companies_to_describe.values_list("id", flat=True)[:sample_size]
+    )
+
+    return {
+        "schedule_financial_fetching": get_companies_to_fetch(),
+        "generate_financial_sentences": companies_to_describe,
+        # the filter the prefetch adds to its queryset
+        "generate_financial_sentences (statements prefetch)": (
+            get_statements_to_describe().filter(company_id__in=sample_company_ids)
+        ),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs EXPLAIN ANALYZE on the hot ingestion and embedding queries, "
+        "optionally failing when a history table is scanned sequentially."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--no-analyze",
+            action="store_true",
+            help="Only plan the queries, without executing them.",
+        )
+        parser.add_argument(
+            "--fail-on-seq-scan",
+            action="store_true",
+            help="Exit with an error if any plan does a sequential scan on a history table.",
+        )
+        parser.add_argument(
+            "--sample-size",
+            type=int,
+            default=20,
+            help="Number of companies used for the statements prefetch query.",
+        )
+
+    def handle(self, *args, **options):
+        explain_options = (
+            {} if options["no_analyze"] else {"analyze": True, "buffers": True}
+        )
+
+        regressions = []
+        for name, queryset in get_hot_queries(options["sample_size"]).items():
+            plan = queryset.explain(**explain_options)
+
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(plan)
+            self.stdout.write("")
+
+            for table in HISTORY_TABLES:
+                # the partitions of a table are named after it
+                if re.search(rf"Seq Scan on {table}(_y\d+|_default)?\b", plan):
+                    regressions.append(f"{name}: sequential scan on {table}")
+
+        for regression in regressions:
+            self.stdout.write(self.style.WARNING(regression))
+
+        if regressions and options["fail_on_seq_scan"]:
+            raise CommandError(
+                f"{len(regressions)} hot query plan regression(s) found."
+            )
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.exports import DATASETS, write_export_archive
+
+
+class Command(BaseCommand):
+    help = "Exports a dataset as a columnar zip archive (.npy vectors, zstd scalar columns)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("dataset", choices=sorted(DATASETS))
+        parser.add_argument(
+            "--output",
+            help="Path of the archive to write. Defaults to <dataset>.zip.",
+        )
+
+    def handle(self, *args, **options):
+        dataset = options["dataset"]
+        output = options["output"] or f"{dataset}.zip"
+
+        start_time = time.perf_counter()
+        with open(output, "wb") as archive:
+            size = write_export_archive(dataset, archive)
+        duration = time.perf_counter() - start_time
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Exported {dataset} to {output} ({size / 1_000_000:.1f} MB in {duration:.1f}s)."
+            )
+        )
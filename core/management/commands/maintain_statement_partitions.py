@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core.partitioning import (
+    TABLE,
+    ensure_partitions,
+    get_partitions,
+    is_partitioned,
+    partition_table,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the yearly partitions of the financial statements ahead of time, "
+        "and for the years that landed in the default partition. Run it daily."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--years-ahead",
+            type=int,
+            default=settings.FINANCIAL_STATEMENT_PARTITION_YEARS_AHEAD,
+        )
+        parser.add_argument(
+            "--partition",
+            action="store_true",
+            help="Partitions the table first, if it isn't yet. Locks it for the copy.",
+        )
+
+    def handle(self, *args, **options):
+        if not is_partitioned(connection):
+            if not options["partition"]:
+                raise CommandError(
+                    f"{TABLE} is not partitioned, use --partition to partition it."
+                )
+            partition_table(connection, options["years_ahead"])
+            self.stdout.write(f"Partitioned {TABLE} by calendar_year.")
+
+        created = ensure_partitions(connection, options["years_ahead"])
+        for year in created:
+            self.stdout.write(f"Created the {year} partition.")
+
+        partitions = get_partitions(connection)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{TABLE} has {len(partitions)} partitions, " f"{len(created)} created."
+            )
+        )
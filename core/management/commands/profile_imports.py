@@ -0,0 +1,125 @@
+import os
+import re
+import subprocess
+import sys
+
+import orjson
+from django.core.management.base import BaseCommand, CommandError
+
+# the modules each kind of process imports when it starts
+ROLES = {
+    "web": ["fin_vantage.wsgi", "fin_vantage.urls"],
+    "worker": ["fin_vantage.celery", "ingestion.tasks", "embeds.tasks"],
+    "ingestion-worker": ["fin_vantage.celery", "ingestion.tasks"],
+    "beat": ["fin_vantage.celery", "django_celery_beat.schedulers"],
+}
+
+# packages a role must not import, they belong to the processes answering questions
+FORBIDDEN = {
+    "ingestion-worker": ["langchain", "langchain_core", "langchain_mistralai"],
+    "beat": ["langchain", "langchain_core", "langchain_mistralai"],
+}
+
+STARTUP_SCRIPT = """
+import importlib, os, resource, sys, time
+start_time = time.perf_counter()
+import django
+django.setup()
+for module in sys.argv[1:]:
+    importlib.import_module(module)
+duration = time.perf_counter() - start_time
+print(duration, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def parse_import_times(output: str) -> list[dict]:
+    modules = []
+    for line in output.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append(
+                {
+                    "module": name,
+                    "self": int(self_us) / 1e6,
+                    "cumulative": int(cumulative_us) / 1e6,
+                    "depth": len(indent) // 2,
+                }
+            )
+    return modules
+
+
+class Command(BaseCommand):
+    help = (
+        "Starts a fresh interpreter the way a web, worker or beat process does, and "
+        "reports the import time and memory it costs, per package and per module."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--role", choices=sorted(ROLES), default="web")
+        parser.add_argument("--top", type=int, default=20)
+        parser.add_argument("--output", help="Writes the full profile as JSON.")
+
+    def handle(self, *args, **options):
+        role = options["role"]
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT, *ROLES[role]],
+            capture_output=True,
+            text=True,
+            env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        )
+        if result.returncode != 0:
+            raise CommandError(f"The {role} startup failed:\n{result.stderr[-2000:]}")
+
+        duration, max_rss_kb = result.stdout.split()[-2:]
+        modules = parse_import_times(result.stderr)
+
+        # the top level imports cover their dependencies, their sum is the import time
+        packages = {}
+        for module in modules:
+            if module["depth"] == 0:
+                package = module["module"].split(".")[0]
+                packages[package] = packages.get(package, 0) + module["cumulative"]
+
+        self.stdout.write(
+            self.style.MIGRATE_HEADING(
+                f"{role}: {float(duration):.2f}s to start, {len(modules)} modules, "
+                f"{int(max_rss_kb) / 1024:.0f} MB max RSS"
+            )
+        )
+        self.stdout.write("Packages, by cumulative import time:")
+        for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[
+            : options["top"]
+        ]:
+            self.stdout.write(f"  {seconds * 1000:9.1f}ms  {package}")
+
+        self.stdout.write("Modules, by their own import time:")
+        for module in sorted(modules, key=lambda module: -module["self"])[
+            : options["top"]
+        ]:
+            self.stdout.write(f"  {module['self'] * 1000:9.1f}ms  {module['module']}")
+
+        if options["output"]:
+            with open(options["output"], "wb") as file:
+                file.write(
+                    orjson.dumps(
+                        {
+                            "role": role,
+                            "seconds": float(duration),
+                            "max_rss_kb": int(max_rss_kb),
+                            "packages": packages,
+                            "modules": modules,
+                        },
+                        option=orjson.OPT_INDENT_2,
+                    )
+                )
+
+        imported = {module["module"].split(".")[0] for module in modules}
+        forbidden = sorted(imported & set(FORBIDDEN.get(role, [])))
+        if forbidden:
+            raise CommandError(
+                f"The {role} processes import {', '.join(forbidden)}, "
+                "which should only be imported lazily."
+            )
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from core.metrics import refresh_financial_metrics
+from core.models import Company
+
+
+class Command(BaseCommand):
+    help = "Recomputes the precomputed financial metrics for every company with statements."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        company_ids = list(
+            Company.objects.filter(financial_statements__isnull=False)
+            .distinct()
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+
+        written = 0
+        for index in range(0, len(company_ids), batch_size):
+            written += refresh_financial_metrics(
+                company_ids[index : index + batch_size]
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Refreshed {written} company-years for {len(company_ids)} companies."
+            )
+        )
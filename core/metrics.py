@@ -0,0 +1,128 @@
+from collections.abc import Iterable
+
+import numpy as np
+
+from core.models import FinancialMetrics, FinancialStatement
+
+ANNUAL_PERIOD = "FY"
+
+VALUE_FIELDS = (
+    "revenue",
+    "gross_profit",
+    "operating_income",
+    "net_income",
+    "research_and_development_expenses",
+)
+
+METRIC_FIELDS = [
+    "currency",
+    "revenue",
+    "revenue_growth",
+    "gross_margin",
+    "operating_margin",
+    "net_margin",
+    "research_and_development_intensity",
+    "last_modified",
+]
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator != 0, numerator / denominator, np.nan)
+
+
+def _nullable(value: float) -> float | None:
+    return None if np.isnan(value) else float(value)
+
+
+def compute_financial_metrics(rows: list[tuple]) -> list[FinancialMetrics]:
+    """
+    The metrics of the company-years of the annual statement rows, which hold the
+    company id, calendar year, currency id and VALUE_FIELDS, ordered by company,
+    calendar year and date reported.
+    """
+    if not rows:
+        return []
+
+    columns = list(zip(*rows))
+    company = np.array(columns[0], dtype=np.int64)
+    year = np.array(columns[1], dtype=np.int64)
+    currency = np.array(columns[2], dtype=np.int64)
+    revenue, gross_profit, operating_income, net_income, research = (
+        np.array(column, dtype=np.float64) for column in columns[3:]
+    )
+
+    # a restated report shares the company-year with the original one, keep the latest
+    latest = np.ones(len(rows), dtype=bool)
+    latest[:-1] = (company[:-1] != company[1:]) | (year[:-1] != year[1:])
+    indices = np.flatnonzero(latest)
+
+    company, year, currency = company[indices], year[indices], currency[indices]
+    revenue, gross_profit, operating_income, net_income, research = (
+        revenue[indices],
+        gross_profit[indices],
+        operating_income[indices],
+        net_income[indices],
+        research[indices],
+    )
+
+    # growth only makes sense against the directly preceding year, in the same currency
+    has_previous = np.zeros(len(indices), dtype=bool)
+    has_previous[1:] = (
+        (company[1:] == company[:-1])
+        & (year[1:] == year[:-1] + 1)
+        & (currency[1:] == currency[:-1])
+    )
+    previous_revenue = np.roll(revenue, 1)
+    revenue_growth = np.where(
+        has_previous,
+        _ratio(revenue - previous_revenue, np.abs(previous_revenue)),
+        np.nan,
+    )
+
+    gross_margin = _ratio(gross_profit, revenue)
+    operating_margin = _ratio(operating_income, revenue)
+    net_margin = _ratio(net_income, revenue)
+    research_intensity = _ratio(research, revenue)
+
+    return [
+        FinancialMetrics(
+            company_id=int(company[i]),
+            calendar_year=int(year[i]),
+            currency_id=int(currency[i]),
+            revenue=rows[index][3],
+            revenue_growth=_nullable(revenue_growth[i]),
+            gross_margin=_nullable(gross_margin[i]),
+            operating_margin=_nullable(operating_margin[i]),
+            net_margin=_nullable(net_margin[i]),
+            research_and_development_intensity=_nullable(research_intensity[i]),
+        )
+        for i, index in enumerate(indices)
+    ]
+
+
+def refresh_financial_metrics(company_ids: Iterable[int]) -> int:
+    """
+    Recomputes the metrics of the given companies from their annual statements.
+    Returns the number of company-years that were written.
+    """
+
+    rows = list(
+        FinancialStatement.objects.filter(
+            company_id__in=list(company_ids), period=ANNUAL_PERIOD
+        )
+        .order_by("company_id", "calendar_year", "date_reported")
+        .values_list("company_id", "calendar_year", "currency_id", *VALUE_FIELDS)
+    )
+    metrics = compute_financial_metrics(rows)
+    if not metrics:
+        return 0
+
+    FinancialMetrics.objects.bulk_create(
+        metrics,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["company", "calendar_year"],
+        update_fields=METRIC_FIELDS,
+    )
+    return len(metrics)
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.1 on 2026-10-19 14:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_enable_pgvector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FinancialMetrics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('calendar_year', models.IntegerField()),
+                ('revenue', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('revenue_growth', models.FloatField(db_comment='Year over year revenue growth, as a fraction', null=True)),
+                ('gross_margin', models.FloatField(null=True)),
+                ('operating_margin', models.FloatField(null=True)),
+                ('net_margin', models.FloatField(null=True)),
+                ('research_and_development_intensity', models.FloatField(db_comment='Research and development expenses over revenue', null=True)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='financial_metrics', to='core.company')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.currency')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['calendar_year', 'id'], name='core_metrics_year_id_idx')],
+                'unique_together': {('company', 'calendar_year')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.1 on 2026-10-19 14:24
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the indexed tables grow with history, build the indexes without blocking writes
+    atomic = False
+
+    dependencies = [
+        ('core', '0010_financialmetrics'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='companydatatracker',
+            index=models.Index(fields=['last_financial_report_fetch'], include=('company',), name='core_tracker_last_fetch_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='financialstatement',
+            index=models.Index(fields=['company', '-calendar_year'], name='core_stmt_company_year_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.1 on 2026-10-19 14:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_companydatatracker_core_tracker_last_fetch_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='companydatatracker',
+            name='fetch_attempts',
+            field=models.PositiveIntegerField(db_comment='Consecutive failed fetches, reset on success', default=0),
+        ),
+        migrations.AddField(
+            model_name='companydatatracker',
+            name='fetch_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('in_flight', 'In Flight'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='companydatatracker',
+            name='next_fetch_eligible_at',
+            field=models.DateTimeField(db_comment='When the company can be scheduled again, NULL meaning right away', null=True),
+        ),
+        # the already fetched companies become eligible again a year after their last fetch
+        migrations.RunSQL(
+            sql="""
+                UPDATE core_companydatatracker
+                SET fetch_status = 'succeeded',
+                    next_fetch_eligible_at = last_financial_report_fetch + interval '1 year'
+                WHERE last_financial_report_fetch IS NOT NULL
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
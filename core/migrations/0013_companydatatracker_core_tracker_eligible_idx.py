@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-19 14:31
+
+from django.contrib.postgres.operations import (
+    AddIndexConcurrently,
+    RemoveIndexConcurrently,
+)
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the tracker grows with the companies, build the index without blocking writes
+    atomic = False
+
+    dependencies = [
+        ('core', '0012_companydatatracker_fetch_status'),
+    ]
+
+    operations = [
+        RemoveIndexConcurrently(
+            model_name='companydatatracker',
+            name='core_tracker_last_fetch_idx',
+        ),
+        AddIndexConcurrently(
+            model_name='companydatatracker',
+            index=models.Index(fields=['next_fetch_eligible_at'], include=('company',), name='core_tracker_eligible_idx'),
+        ),
+    ]
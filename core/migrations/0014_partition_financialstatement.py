@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.db import migrations
+
+
+def partition_financial_statements(apps, schema_editor):
+    # optional, the maintain_statement_partitions command partitions the table later on
+    if (
+        not settings.FINANCIAL_STATEMENT_PARTITIONING
+        or schema_editor.connection.vendor != "postgresql"
+    ):
+        return
+
+    from core.partitioning import is_partitioned, partition_table
+
+    if not is_partitioned(schema_editor.connection):
+        partition_table(
+            schema_editor.connection,
+            settings.FINANCIAL_STATEMENT_PARTITION_YEARS_AHEAD,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0013_companydatatracker_core_tracker_eligible_idx"),
+        # the analyses lose their foreign key constraint to the statements
+        ("embeds", "0010_financialstatementanalysis_template"),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_financial_statements, migrations.RunPython.noop),
+    ]
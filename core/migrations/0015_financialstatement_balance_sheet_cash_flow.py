@@ -0,0 +1,58 @@
+# Generated by Django 5.2.1 on 2026-10-19 15:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0014_partition_financialstatement"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="financialstatement",
+            name="capital_expenditure",
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+        migrations.AddField(
+            model_name="financialstatement",
+            name="cash_and_cash_equivalents",
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+        migrations.AddField(
+            model_name="financialstatement",
+            name="dividends_paid",
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+        migrations.AddField(
+            model_name="financialstatement",
+            name="free_cash_flow",
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+        migrations.AddField(
+            model_name="financialstatement",
+            name="operating_cash_flow",
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+        migrations.AddField(
+            model_name="financialstatement",
+            name="total_assets",
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+        migrations.AddField(
+            model_name="financialstatement",
+            name="total_debt",
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+        migrations.AddField(
+            model_name="financialstatement",
+            name="total_liabilities",
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+        migrations.AddField(
+            model_name="financialstatement",
+            name="total_stockholders_equity",
+            field=models.DecimalField(decimal_places=2, max_digits=20, null=True),
+        ),
+    ]
@@ -43,6 +43,25 @@ class FinancialStatement(models.Model):
         max_digits=20, decimal_places=2
     )
 
+    # from the balance sheet and the cash flow statement, when their endpoints are fetched
+    cash_and_cash_equivalents = models.DecimalField(
+        max_digits=20, decimal_places=2, null=True
+    )
+    total_assets = models.DecimalField(max_digits=20, decimal_places=2, null=True)
+    total_liabilities = models.DecimalField(max_digits=20, decimal_places=2, null=True)
+    total_stockholders_equity = models.DecimalField(
+        max_digits=20, decimal_places=2, null=True
+    )
+    total_debt = models.DecimalField(max_digits=20, decimal_places=2, null=True)
+    operating_cash_flow = models.DecimalField(
+        max_digits=20, decimal_places=2, null=True
+    )
+    capital_expenditure = models.DecimalField(
+        max_digits=20, decimal_places=2, null=True
+    )
+    free_cash_flow = models.DecimalField(max_digits=20, decimal_places=2, null=True)
+    dividends_paid = models.DecimalField(max_digits=20, decimal_places=2, null=True)
+
     class Meta:
         unique_together = (
             "company",
@@ -51,6 +70,13 @@ class FinancialStatement(models.Model):
             "period",
             "currency",
         )
+        indexes = [
+            # serves the per company statements ordered by year when generating sentences
+            models.Index(
+                fields=["company", "-calendar_year"],
+                name="core_stmt_company_year_idx",
+            ),
+        ]
 
 
 class CompanyDataTracker(models.Model):
@@ -59,7 +85,69 @@ class CompanyDataTracker(models.Model):
     For example, we will fetch the financial reports only yearly.
     """
 
+    class FetchStatus(models.TextChoices):
+        PENDING = "pending"
+        IN_FLIGHT = "in_flight"
+        SUCCEEDED = "succeeded"
+        FAILED = "failed"
+
     company = models.OneToOneField(
         Company, on_delete=models.CASCADE, related_name="data_tracker"
     )
     last_financial_report_fetch = models.DateField(null=True)
+
+    fetch_status = models.CharField(
+        max_length=10, choices=FetchStatus.choices, default=FetchStatus.PENDING
+    )
+    fetch_attempts = models.PositiveIntegerField(
+        default=0, db_comment="Consecutive failed fetches, reset on success"
+    )
+    next_fetch_eligible_at = models.DateTimeField(
+        null=True,
+        db_comment="When the company can be scheduled again, NULL meaning right away",
+    )
+
+    class Meta:
+        indexes = [
+            # btree keeps the NULLs too, so both sides of the scheduler's
+            # "eligible right away OR eligible since" predicate are served by a bitmap OR
+            models.Index(
+                fields=["next_fetch_eligible_at"],
+                include=["company"],
+                name="core_tracker_eligible_idx",
+            ),
+        ]
+
+
+class FinancialMetrics(models.Model):
+    """
+    Precomputed per company-year ratios derived from the annual financial statements.
+    Refreshed after every financial report fetch, so that numeric lookups don't need the LLM.
+    """
+
+    company = models.ForeignKey(
+        Company, on_delete=models.CASCADE, related_name="financial_metrics"
+    )
+    calendar_year = models.IntegerField()
+    currency = models.ForeignKey(Currency, on_delete=models.CASCADE)
+
+    revenue = models.DecimalField(max_digits=20, decimal_places=2)
+    revenue_growth = models.FloatField(
+        null=True, db_comment="Year over year revenue growth, as a fraction"
+    )
+    gross_margin = models.FloatField(null=True)
+    operating_margin = models.FloatField(null=True)
+    net_margin = models.FloatField(null=True)
+    research_and_development_intensity = models.FloatField(
+        null=True, db_comment="Research and development expenses over revenue"
+    )
+
+    last_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("company", "calendar_year")
+        indexes = [
+            models.Index(
+                fields=["calendar_year", "id"], name="core_metrics_year_id_idx"
+            ),
+        ]
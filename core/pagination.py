@@ -0,0 +1,13 @@
+from rest_framework.pagination import CursorPagination
+
+
+class FinancialMetricsPagination(CursorPagination):
+    ordering = "id"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+class CompanyFinancialMetricsPagination(FinancialMetricsPagination):
+    # unique within a single company, so the cursor stays a pure keyset seek
+    ordering = "calendar_year"
@@ -0,0 +1,214 @@
+"""
+Range partitioning of the financial statements by calendar year.
+
+The partitioned table has a partition per calendar year, named after it, and a
+default partition for the years that don't have one yet. The queries and the bulk
+loads filtering on calendar_year only touch the partitions of their years.
+
+The ORM keeps using the id as the primary key. In the database the primary key is
+(id, calendar_year), as a partitioned table only enforces the unique constraints
+holding its partition key; the id stays unique through its sequence. For the same
+reason the foreign keys to the statements can't be enforced by the database anymore:
+the analyses are deleted with their statement by the ORM, their writes lock their
+statements like the foreign key did, and maintain_statement_partitions deletes the
+analyses left behind by the deletes that bypass the ORM.
+"""
+
+import datetime
+import logging
+import re
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from core.models import FinancialStatement
+from embeds.models import FinancialStatementAnalysis
+
+logger = logging.getLogger(__name__)
+
+TABLE = FinancialStatement._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+PARTITION_BOUND = re.compile(r"FROM \('?(\d+)'?\) TO \('?(\d+)'?\)")
+
+
+def get_partition_name(year: int) -> str:
+    return f"{TABLE}_y{year}"
+
+
+def is_partitioned(connection) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))",
+            [TABLE],
+        )
+        return cursor.fetchone()[0]
+
+
+def get_partitions(connection) -> dict[str, int | None]:
+    """The partitions of the table and their year, None for the default one."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = to_regclass(%s)
+            """,
+            [TABLE],
+        )
+        partitions = {}
+        for name, bound in cursor.fetchall():
+            match = PARTITION_BOUND.search(bound)
+            partitions[name] = int(match.group(1)) if match else None
+        return partitions
+
+
+def get_maintained_years(cursor, table: str, years_ahead: int) -> list[int]:
+    """The years needing a partition, those in the table up to the coming ones."""
+    cursor.execute(f"SELECT DISTINCT calendar_year FROM {table}")
+    years = {year for (year,) in cursor.fetchall()}
+    current_year = datetime.date.today().year
+    years.update(range(current_year, current_year + years_ahead + 1))
+    return sorted(years)
+
+
+def create_partition(cursor, year: int):
+    """
+    Creates the partition of the year, moving its rows out of the default partition,
+    which can't hold rows of a year that has a partition.
+    """
+    name = get_partition_name(year)
+    cursor.execute(
+        f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+    )
+    # spares the attach a scan of the rows to validate them
+    cursor.execute(
+        f"ALTER TABLE {name} ADD CONSTRAINT {name}_bound "
+        f"CHECK (calendar_year >= {year} AND calendar_year < {year + 1})"
+    )
+    cursor.execute(
+        f"INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE calendar_year = %s",
+        [year],
+    )
+    cursor.execute(
+        f"DELETE FROM {DEFAULT_PARTITION} WHERE calendar_year = %s",
+        [year],
+    )
+    cursor.execute(
+        f"ALTER TABLE {TABLE} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ({year}) TO ({year + 1})"
+    )
+    cursor.execute(f"ALTER TABLE {name} DROP CONSTRAINT {name}_bound")
+
+
+def ensure_partitions(connection, years_ahead: int) -> list[int]:
+    """Creates the missing yearly partitions, and returns their years."""
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        existing = set(get_partitions(connection).values())
+        missing = [
+            year
+            for year in get_maintained_years(cursor, DEFAULT_PARTITION, years_ahead)
+            if year not in existing
+        ]
+        if missing:
+            # the moves out of the default partition must not race with the loads
+            cursor.execute(f"LOCK TABLE {TABLE} IN SHARE ROW EXCLUSIVE MODE")
+            for year in missing:
+                create_partition(cursor, year)
+    return missing
+
+
+def delete_orphaned_analyses() -> int:
+    """Deletes the analyses whose statement is gone, and returns how many."""
+    _, deleted = FinancialStatementAnalysis.objects.exclude(
+        Exists(FinancialStatement.objects.filter(pk=OuterRef("financial_statement")))
+    ).delete()
+    # the count of the analyses, not of their embeddings deleted with them
+    return deleted.get(FinancialStatementAnalysis._meta.label, 0)
+
+
+def _get_definitions(cursor, table: str) -> tuple[list[str], list[tuple[str, str]]]:
+    """The indexes, foreign keys and unique constraints of the table, to create again."""
+    cursor.execute(
+        """
+        SELECT pg_get_indexdef(indexrelid)
+        FROM pg_index
+        WHERE indrelid = to_regclass(%s)
+        AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)
+        """,
+        [table],
+    )
+    indexes = [definition for (definition,) in cursor.fetchall()]
+    cursor.execute(
+        """
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = to_regclass(%s) AND contype IN ('f', 'u')
+        """,
+        [table],
+    )
+    return indexes, cursor.fetchall()
+
+
+def partition_table(connection, years_ahead: int):
+    """
+    Replaces the table with a partitioned one holding the same rows, indexes and
+    constraints. The table is locked for the copy.
+    """
+    new_table = f"{TABLE}_partitioned"
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE")
+        indexes, constraints = _get_definitions(cursor, TABLE)
+        cursor.execute(
+            "SELECT is_identity = 'YES' FROM information_schema.columns "
+            "WHERE table_name = %s AND column_name = 'id'",
+            [TABLE],
+        )
+        (is_identity,) = cursor.fetchone()
+
+        cursor.execute(
+            f"CREATE TABLE {new_table} (LIKE {TABLE} INCLUDING DEFAULTS "
+            "INCLUDING IDENTITY INCLUDING CONSTRAINTS INCLUDING COMMENTS) "
+            "PARTITION BY RANGE (calendar_year)"
+        )
+        for year in get_maintained_years(cursor, TABLE, years_ahead):
+            cursor.execute(
+                f"CREATE TABLE {get_partition_name(year)} PARTITION OF {new_table} "
+                f"FOR VALUES FROM ({year}) TO ({year + 1})"
+            )
+        cursor.execute(
+            f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {new_table} DEFAULT"
+        )
+        cursor.execute(f"INSERT INTO {new_table} SELECT * FROM {TABLE}")
+
+        if is_identity:
+            # the identity of the new table has a sequence of its own
+            cursor.execute(
+                f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM {new_table}), 0) + 1, false)",
+                [new_table],
+            )
+        else:
+            # the serial sequence is shared, it must outlive the table
+            cursor.execute(
+                "SELECT pg_get_serial_sequence(%s, 'id')",
+                [TABLE],
+            )
+            (sequence,) = cursor.fetchone()
+            cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {new_table}.id")
+
+        # drops the foreign keys of the other tables to this one too
+        cursor.execute(f"DROP TABLE {TABLE} CASCADE")
+        cursor.execute(f"ALTER TABLE {new_table} RENAME TO {TABLE}")
+
+        cursor.execute(
+            f"ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey "
+            "PRIMARY KEY (id, calendar_year)"
+        )
+        # the unique constraints all hold calendar_year, the ORM upserts keep using them
+        for name, definition in constraints:
+            cursor.execute(f"ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}")
+        for definition in indexes:
+            cursor.execute(definition)
+    logger.info(f"Partitioned {TABLE} by calendar_year.")
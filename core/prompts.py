@@ -0,0 +1,35 @@
+import functools
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+RAG_PROMPT_NAME = "rlm/rag-prompt"
+
+# local copy of rlm/rag-prompt, used when the hub can't be reached
+RAG_PROMPT_TEMPLATE = (
+    "You are an assistant for question-answering tasks. "
+    "Use the following pieces of retrieved context to answer the question. "
+    "If you don't know the answer, just say that you don't know. "
+    "Use three sentences maximum and keep the answer concise.\n"
+    "Question: {question} \n"
+    "Context: {context} \n"
+    "Answer:"
+)
+
+
+@functools.cache
+def get_rag_prompt():
+    """Pulls the RAG prompt once per process, instead of once per question."""
+    # imported here, langchain takes a while to import and only /api/ask/ needs it
+    from langchain import hub
+    from langchain_core.prompts import ChatPromptTemplate
+
+    if not settings.RAG_PROMPT_FROM_HUB:
+        return ChatPromptTemplate.from_messages([("human", RAG_PROMPT_TEMPLATE)])
+    try:
+        return hub.pull(RAG_PROMPT_NAME)
+    except Exception as e:
+        logger.warning(f"Could not pull {RAG_PROMPT_NAME}, using the local copy: {e}")
+        return ChatPromptTemplate.from_messages([("human", RAG_PROMPT_TEMPLATE)])
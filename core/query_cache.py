@@ -0,0 +1,178 @@
+"""
+Caches of the question path: the question embeddings and the retrieved contexts.
+
+Every cache is an in-process LRU whose entries expire after a TTL, backed by Redis
+when QUERY_CACHE_REDIS_URL is set, so that the web processes share what any of them
+computed. The question embeddings are keyed by model, the contexts by embedding
+version. The concurrent misses of a key in a process are coalesced: the first request
+computes the value, the others wait for it instead of calling the provider too.
+"""
+
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
+
+import orjson
+import redis
+from django.conf import settings
+
+from fin_vantage.instrumentation import QUERY_CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "fin_vantage:query_cache:"
+
+MISSING = object()
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """The question without the differences that don't change its answer."""
+    # the case is kept, the symbols the question names are read from it
+    return WHITESPACE.sub(" ", question).strip().rstrip("?!. ")
+
+
+class TTLCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+_client = None
+
+
+def _get_client() -> redis.Redis | None:
+    global _client
+    if _client is None and settings.QUERY_CACHE_REDIS_URL:
+        # a slow Redis falls back to computing the values, it doesn't hold the requests
+        _client = redis.Redis.from_url(
+            settings.QUERY_CACHE_REDIS_URL,
+            socket_timeout=settings.QUERY_CACHE_REDIS_TIMEOUT,
+            socket_connect_timeout=settings.QUERY_CACHE_REDIS_TIMEOUT,
+        )
+    return _client
+
+
+class QueryCache:
+    def __init__(self, name: str, max_size: int, ttl: float):
+        self.name = name
+        self.local = TTLCache(max_size, ttl)
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def get_shared_key(self, key: str) -> str:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        return f"{KEY_PREFIX}{self.name}:{digest}"
+
+    def get_shared(self, key: str):
+        client = _get_client()
+        if client is None:
+            return MISSING
+        try:
+            value = client.get(self.get_shared_key(key))
+        except redis.RedisError as e:
+            logger.warning(f"Could not read the {self.name} cache: {e}")
+            return MISSING
+        return MISSING if value is None else orjson.loads(value)
+
+    def set_shared(self, key: str, value):
+        client = _get_client()
+        if client is None:
+            return
+        try:
+            client.set(
+                self.get_shared_key(key),
+                orjson.dumps(value),
+                ex=int(self.local.ttl),
+            )
+        except redis.RedisError as e:
+            logger.warning(f"Could not write the {self.name} cache: {e}")
+
+    def get_or_compute(self, key: str, compute, retry: bool = True):
+        value = self.local.get(key)
+        if value is not MISSING:
+            QUERY_CACHE_REQUESTS.inc(cache=self.name, result="hit")
+            return value
+
+        with self.lock:
+            future = self.inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self.inflight[key] = Future()
+
+        if not is_leader:
+            QUERY_CACHE_REQUESTS.inc(cache=self.name, result="coalesced")
+            try:
+                return future.result(timeout=settings.QUERY_CACHE_WAIT_TIMEOUT)
+            except TimeoutError:
+                logger.warning(
+                    f"Waited too long for the {self.name} value, computing it."
+                )
+                return compute()
+            except Exception:
+                if not retry:
+                    raise
+                # the first of the waiting requests computes it again, once
+                return self.get_or_compute(key, compute, retry=False)
+
+        try:
+            value = self.get_shared(key)
+            if value is MISSING:
+                QUERY_CACHE_REQUESTS.inc(cache=self.name, result="miss")
+                value = compute()
+                self.set_shared(key, value)
+            else:
+                QUERY_CACHE_REQUESTS.inc(cache=self.name, result="shared_hit")
+            self.local.set(key, value)
+        except Exception as e:
+            self.release(key)
+            # the waiting requests retry it, see above
+            future.set_exception(e)
+            raise
+        except BaseException:
+            self.release(key)
+            raise
+        self.release(key)
+        future.set_result(value)
+        return value
+
+    def release(self, key: str):
+        # before the waiting requests wake up, a retry mustn't find the finished future
+        with self.lock:
+            self.inflight.pop(key, None)
+
+
+question_embeddings = QueryCache(
+    "question_embeddings",
+    settings.QUERY_EMBEDDING_CACHE_SIZE,
+    settings.QUERY_EMBEDDING_CACHE_TTL,
+)
+question_contexts = QueryCache(
+    "question_contexts", settings.QUERY_CACHE_SIZE, settings.QUERY_CACHE_TTL
+)
@@ -0,0 +1,226 @@
+"""
+The retrieval stage of the questions.
+
+A larger set of candidate analyses is read by vector distance, re-ranked with the
+companies and years the question names, cut to the ones relevant enough, diversified
+with maximal marginal relevance (MMR), and packed into the context up to
+RETRIEVAL_CONTEXT_TOKENS tokens. The question
+embeddings and the contexts are cached by core.query_cache.
+"""
+
+import functools
+import logging
+import math
+import os
+import re
+
+import numpy as np
+from django.conf import settings
+from django.db.models import F
+from django.db.models.functions import Cast
+from pgvector.django import CosineDistance, VectorField
+
+from core.query_cache import (
+    normalize_question,
+    question_contexts,
+    question_embeddings,
+)
+from embeds.models import EmbeddingModelVersion, FinancialStatementEmbedding
+from fin_vantage.instrumentation import (
+    RETRIEVAL_CONTEXT_DOCUMENTS,
+    RETRIEVAL_CONTEXT_TOKENS,
+)
+from fin_vantage.routers import read_replica
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_SEPARATOR = "\n\n"
+
+# uppercase words are read as symbols, they only count when a candidate has them
+SYMBOL_PATTERN = re.compile(r"\b[A-Z][A-Z.\-]{0,9}\b")
+YEAR_PATTERN = re.compile(r"\b(?:19|20)\d{2}\b")
+YEAR_RANGE_PATTERN = re.compile(r"\b((?:19|20)\d{2})\s*(?:-|–|to)\s*((?:19|20)\d{2})\b")
+
+# added to the cosine similarity of the candidates matching the question
+SYMBOL_BOOST = 0.15
+YEAR_BOOST = 0.05
+
+
+def get_question_terms(question: str) -> tuple[set[str], set[int]]:
+    """The symbols and the years named by the question, "2020-2023" covers 4 years."""
+    symbols = set(SYMBOL_PATTERN.findall(question))
+    years = {int(year) for year in YEAR_PATTERN.findall(question)}
+    for start, end in YEAR_RANGE_PATTERN.findall(question):
+        start, end = sorted((int(start), int(end)))
+        years.update(range(start, end + 1))
+    return symbols, years
+
+
+def fetch_candidates(
+    version: EmbeddingModelVersion, question_embedding, limit: int
+) -> list[dict]:
+    return list(
+        FinancialStatementEmbedding.objects.filter(version=version)
+        .exclude(analysis__analysis_text__isnull=True)
+        # cast like the version's index, see embeds.versions.create_vector_index
+        .order_by(
+            CosineDistance(
+                Cast("embedding", VectorField(dimensions=version.dimension)),
+                question_embedding,
+            )
+        )
+        .values(
+            "embedding",
+            text=F("analysis__analysis_text"),
+            symbol=F("analysis__financial_statement__company__symbol"),
+            calendar_year=F("analysis__financial_statement__calendar_year"),
+        )[:limit]
+    )
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def rerank(
+    question: str, question_embedding, candidates: list[dict], vectors: np.ndarray
+) -> np.ndarray:
+    """The similarity of every candidate, raised by the question terms it matches."""
+    relevance = vectors @ normalize(np.asarray(question_embedding, dtype=np.float32))
+
+    symbols, years = get_question_terms(question)
+    if symbols:
+        relevance += SYMBOL_BOOST * np.array(
+            [candidate["symbol"] in symbols for candidate in candidates]
+        )
+    if years:
+        relevance += YEAR_BOOST * np.array(
+            [candidate["calendar_year"] in years for candidate in candidates]
+        )
+    return relevance
+
+
+def select_relevant(
+    relevance: np.ndarray, min_relevance: float, margin: float
+) -> np.ndarray:
+    """
+    The indices of the candidates at least `min_relevance` relevant and within `margin`
+    of the most relevant one, none when no candidate is relevant enough.
+    """
+    if not len(relevance):
+        return np.array([], dtype=np.int64)
+    return np.flatnonzero(relevance >= max(min_relevance, relevance.max() - margin))
+
+
+def maximal_marginal_relevance(
+    relevance: np.ndarray, vectors: np.ndarray, diversity: float
+) -> list[int]:
+    """
+    Orders the candidates by relevance, less their similarity to the ones ordered
+    before them, so that near duplicate analyses don't crowd out the others. The
+    vectors are normalized.
+    """
+    similarities = vectors @ vectors.T
+    redundancy = np.zeros(len(relevance), dtype=np.float32)
+    remaining = np.ones(len(relevance), dtype=bool)
+
+    order = []
+    for _ in range(len(relevance)):
+        scores = (1 - diversity) * relevance - diversity * redundancy
+        index = int(np.argmax(np.where(remaining, scores, -np.inf)))
+        order.append(index)
+        remaining[index] = False
+        np.maximum(redundancy, similarities[index], out=redundancy)
+    return order
+
+
+@functools.cache
+def get_tokenizer():
+    path = settings.RETRIEVAL_TOKENIZER
+    if not path or not os.path.exists(path):
+        return None
+
+    from tokenizers import Tokenizer
+
+    return Tokenizer.from_file(path)
+
+
+def count_tokens(texts: list[str]) -> list[int]:
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        # about four characters per token in English
+        return [math.ceil(len(text) / 4) for text in texts]
+    return [
+        len(encoding.ids)
+        for encoding in tokenizer.encode_batch(texts, add_special_tokens=False)
+    ]
+
+
+def pack_context(texts: list[str], budget: int) -> list[str]:
+    """The texts, in order, that fit in the budget, skipping the ones too long for it."""
+    separator_tokens = count_tokens([CONTEXT_SEPARATOR])[0]
+    packed, used = [], 0
+    for text, tokens in zip(texts, count_tokens(texts)):
+        cost = tokens + (separator_tokens if packed else 0)
+        if used + cost <= budget:
+            packed.append(text)
+            used += cost
+    RETRIEVAL_CONTEXT_TOKENS.observe(used)
+    RETRIEVAL_CONTEXT_DOCUMENTS.observe(len(packed))
+    return packed
+
+
+def build_context(question: str, question_embedding, candidates: list[dict]) -> str:
+    if not candidates:
+        return ""
+
+    vectors = normalize(
+        np.array([candidate["embedding"] for candidate in candidates], dtype=np.float32)
+    )
+    relevance = rerank(question, question_embedding, candidates, vectors)
+    relevant = select_relevant(
+        relevance,
+        settings.RETRIEVAL_MIN_RELEVANCE,
+        settings.RETRIEVAL_RELEVANCE_MARGIN,
+    )
+    order = [
+        relevant[index]
+        for index in maximal_marginal_relevance(
+            relevance[relevant], vectors[relevant], settings.RETRIEVAL_MMR_DIVERSITY
+        )
+    ]
+    texts = pack_context(
+        [candidates[index]["text"] for index in order],
+        settings.RETRIEVAL_CONTEXT_TOKENS,
+    )
+    logger.debug(
+        f"Packed {len(texts)} of the {len(relevant)} relevant analyses, "
+        f"of {len(candidates)} candidates."
+    )
+    return CONTEXT_SEPARATOR.join(texts)
+
+
+def retrieve_context(question: str, version: EmbeddingModelVersion) -> str:
+    """The context of the question, shared by the identical questions asked meanwhile."""
+    question = normalize_question(question)
+    key = f"{version.pk}:{question}"
+    # the versions of a model share the embedding of the question
+    embedding_key = f"{version.provider}:{version.model_name}:{question}"
+
+    def embed_question():
+        # the question is embedded with the model of the version it is compared to
+        embeddings = version.model.embedding_model(model=version.model_name)
+        return embeddings.embed_query(question)
+
+    def retrieve():
+        question_embedding = question_embeddings.get_or_compute(
+            embedding_key, embed_question
+        )
+        with read_replica():
+            candidates = fetch_candidates(
+                version, question_embedding, settings.RETRIEVAL_CANDIDATES
+            )
+        return build_context(question, question_embedding, candidates)
+
+    return question_contexts.get_or_compute(key, retrieve)
@@ -0,0 +1,22 @@
+from rest_framework import serializers
+
+from core.models import FinancialMetrics
+
+
+class FinancialMetricsSerializer(serializers.ModelSerializer):
+    symbol = serializers.CharField(source="company.symbol")
+    currency = serializers.CharField(source="currency.code")
+
+    class Meta:
+        model = FinancialMetrics
+        fields = [
+            "symbol",
+            "calendar_year",
+            "currency",
+            "revenue",
+            "revenue_growth",
+            "gross_margin",
+            "operating_margin",
+            "net_margin",
+            "research_and_development_intensity",
+        ]
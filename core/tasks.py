@@ -0,0 +1,36 @@
+import logging
+
+from celery import shared_task
+from django.conf import settings
+from django.db import connection
+
+from core.partitioning import (
+    TABLE,
+    delete_orphaned_analyses,
+    ensure_partitions,
+    is_partitioned,
+)
+
+
+@shared_task
+def maintain_statement_partitions():
+    """
+    Creates the coming yearly partitions, and deletes the analyses of the statements
+    that are gone. The table is partitioned by the command.
+    """
+    logger = logging.getLogger("maintain_statement_partitions")
+
+    if connection.vendor != "postgresql" or not is_partitioned(connection):
+        logger.info(f"{TABLE} is not partitioned, nothing to maintain.")
+        return
+
+    created = ensure_partitions(
+        connection, settings.FINANCIAL_STATEMENT_PARTITION_YEARS_AHEAD
+    )
+    for year in created:
+        logger.info(f"Created the {year} partition.")
+    logger.info(f"{TABLE} partitions maintained, {len(created)} created.")
+
+    deleted = delete_orphaned_analyses()
+    if deleted:
+        logger.warning(f"Deleted {deleted} analyses of missing statements.")
@@ -1,3 +1,513 @@
-from django.test import TestCase
+import datetime
+import io
+import threading
+import zipfile
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import orjson
+import zstandard
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from core import retrieval
+from core.exports import NULL_CENTS, write_export_archive
+from core.metrics import compute_financial_metrics, refresh_financial_metrics
+from core.models import Company, Currency, FinancialMetrics, FinancialStatement
+from core.partitioning import (
+    DEFAULT_PARTITION,
+    TABLE,
+    ensure_partitions,
+    get_partition_name,
+    get_partitions,
+    is_partitioned,
+    partition_table,
+)
+from core.prompts import RAG_PROMPT_TEMPLATE, get_rag_prompt
+from core.query_cache import QueryCache
+from core.tasks import maintain_statement_partitions
+from embeds.models import (
+    EmbeddingModelVersion,
+    FinancialStatementAnalysis,
+    FinancialStatementEmbedding,
+)
+
+USD, EUR = 1, 2
+
+
+def row(company_id, year, currency_id, revenue, gross=0, operating=0, net=0, rnd=0):
+    return (
+        company_id,
+        year,
+        currency_id,
+        *(Decimal(value) for value in (revenue, gross, operating, net, rnd)),
+    )
+
+
+class ComputeFinancialMetricsTests(SimpleTestCase):
+    def test_no_rows(self):
+        self.assertEqual(compute_financial_metrics([]), [])
+
+    def test_margins(self):
+        [metrics] = compute_financial_metrics([row(1, 2023, USD, 200, 100, 50, 20, 10)])
+
+        self.assertEqual(metrics.company_id, 1)
+        self.assertEqual(metrics.calendar_year, 2023)
+        self.assertEqual(metrics.revenue, Decimal(200))
+        self.assertAlmostEqual(metrics.gross_margin, 0.5)
+        self.assertAlmostEqual(metrics.operating_margin, 0.25)
+        self.assertAlmostEqual(metrics.net_margin, 0.1)
+        self.assertAlmostEqual(metrics.research_and_development_intensity, 0.05)
+        self.assertIsNone(metrics.revenue_growth)
+
+    def test_zero_revenue_has_no_ratios(self):
+        [metrics] = compute_financial_metrics([row(1, 2023, USD, 0, 10)])
+
+        self.assertIsNone(metrics.gross_margin)
+        self.assertIsNone(metrics.net_margin)
+
+    def test_growth_against_the_preceding_year(self):
+        metrics = compute_financial_metrics(
+            [row(1, 2022, USD, 100), row(1, 2023, USD, 150), row(1, 2024, USD, 75)]
+        )
+
+        self.assertEqual([m.revenue_growth for m in metrics], [None, 0.5, -0.5])
+
+    def test_growth_from_a_negative_revenue(self):
+        metrics = compute_financial_metrics(
+            [row(1, 2022, USD, -100), row(1, 2023, USD, 50)]
+        )
+
+        self.assertAlmostEqual(metrics[1].revenue_growth, 1.5)
+
+    def test_no_growth_across_gaps_currencies_and_companies(self):
+        metrics = compute_financial_metrics(
+            [
+                row(1, 2020, USD, 100),
+                # a missing year
+                row(1, 2022, USD, 100),
+                # another currency
+                row(1, 2023, EUR, 100),
+                # another company
+                row(2, 2024, EUR, 100),
+            ]
+        )
+
+        self.assertEqual([m.revenue_growth for m in metrics], [None] * 4)
+
+    def test_the_latest_restatement_is_kept(self):
+        metrics = compute_financial_metrics(
+            [row(1, 2023, USD, 100), row(1, 2023, USD, 120), row(1, 2024, USD, 180)]
+        )
+
+        self.assertEqual([m.calendar_year for m in metrics], [2023, 2024])
+        self.assertEqual(metrics[0].revenue, Decimal(120))
+        self.assertAlmostEqual(metrics[1].revenue_growth, 0.5)
+
+
+def unit(*components) -> np.ndarray:
+    return retrieval.normalize(np.array(components, dtype=np.float32))
+
+
+def candidate(symbol: str, year: int, *components) -> dict:
+    return {
+        "embedding": list(components),
+        "text": f"{symbol} {year}",
+        "symbol": symbol,
+        "calendar_year": year,
+    }
+
+
+class QuestionTermsTests(SimpleTestCase):
+    def test_symbols_and_years(self):
+        symbols, years = retrieval.get_question_terms(
+            "What was the revenue of AAPL and BRK.B in 2021?"
+        )
+
+        self.assertEqual(symbols, {"AAPL", "BRK.B"})
+        self.assertEqual(years, {2021})
+
+    def test_year_ranges_are_expanded(self):
+        _, years = retrieval.get_question_terms("MSFT growth from 2020 to 2022")
+
+        self.assertEqual(years, {2020, 2021, 2022})
+
+
+class RerankTests(SimpleTestCase):
+    def test_matching_symbols_and_years_are_boosted(self):
+        candidates = [
+            candidate("MSFT", 2022, 1, 0),
+            candidate("AAPL", 2022, 1, 0),
+            candidate("AAPL", 2023, 1, 0),
+        ]
+        vectors = np.stack([unit(1, 0)] * 3)
+
+        relevance = retrieval.rerank("AAPL in 2023", [1, 0], candidates, vectors)
+
+        np.testing.assert_allclose(
+            relevance,
+            [
+                1,
+                1 + retrieval.SYMBOL_BOOST,
+                1 + retrieval.SYMBOL_BOOST + retrieval.YEAR_BOOST,
+            ],
+            rtol=1e-6,
+        )
+
+
+class SelectRelevantTests(SimpleTestCase):
+    def test_margin_from_the_best(self):
+        relevance = np.array([0.9, 0.85, 0.7, 0.95])
+
+        selected = retrieval.select_relevant(relevance, min_relevance=0, margin=0.1)
+
+        self.assertEqual(list(selected), [0, 1, 3])
+
+    def test_min_relevance(self):
+        relevance = np.array([0.3, 0.35])
+
+        self.assertEqual(
+            list(retrieval.select_relevant(relevance, min_relevance=0.32, margin=1)),
+            [1],
+        )
+        self.assertEqual(
+            list(retrieval.select_relevant(relevance, min_relevance=0.5, margin=1)), []
+        )
+
+    def test_no_candidates(self):
+        self.assertEqual(len(retrieval.select_relevant(np.array([]), 0, 0.1)), 0)
+
+
+class MaximalMarginalRelevanceTests(SimpleTestCase):
+    def setUp(self):
+        # the first two analyses are near duplicates
+        self.vectors = np.stack([unit(1, 0), unit(0.99, 0.01), unit(0, 1)])
+        self.relevance = np.array([0.9, 0.89, 0.8], dtype=np.float32)
+
+    def test_relevance_only(self):
+        order = retrieval.maximal_marginal_relevance(self.relevance, self.vectors, 0)
+
+        self.assertEqual(order, [0, 1, 2])
+
+    def test_near_duplicates_are_pushed_back(self):
+        order = retrieval.maximal_marginal_relevance(self.relevance, self.vectors, 0.5)
+
+        self.assertEqual(order, [0, 2, 1])
+
+    def test_no_candidates(self):
+        self.assertEqual(
+            retrieval.maximal_marginal_relevance(
+                np.array([]), np.zeros((0, 2), dtype=np.float32), 0.3
+            ),
+            [],
+        )
+
+
+@override_settings(RETRIEVAL_TOKENIZER="")
+class PackContextTests(SimpleTestCase):
+    def setUp(self):
+        # without a tokenizer, a token is four characters
+        retrieval.get_tokenizer.cache_clear()
+        self.addCleanup(retrieval.get_tokenizer.cache_clear)
+
+    def test_the_texts_fitting_the_budget_in_order(self):
+        # 2 tokens each, and 1 per separator
+        texts = ["a" * 8, "b" * 8, "c" * 8]
+
+        self.assertEqual(retrieval.pack_context(texts, budget=5), texts[:2])
+
+    def test_a_text_too_long_is_skipped(self):
+        texts = ["a" * 8, "b" * 40, "c" * 8]
+
+        self.assertEqual(retrieval.pack_context(texts, budget=5), ["a" * 8, "c" * 8])
+
+
+@override_settings(
+    RETRIEVAL_TOKENIZER="",
+    RETRIEVAL_MIN_RELEVANCE=0.0,
+    RETRIEVAL_RELEVANCE_MARGIN=0.1,
+    RETRIEVAL_MMR_DIVERSITY=0.3,
+    RETRIEVAL_CONTEXT_TOKENS=1500,
+)
+class BuildContextTests(SimpleTestCase):
+    def setUp(self):
+        retrieval.get_tokenizer.cache_clear()
+        self.addCleanup(retrieval.get_tokenizer.cache_clear)
+
+    def test_only_the_relevant_analyses_are_packed(self):
+        candidates = [
+            candidate("MSFT", 2023, 1, 0.2),
+            candidate("AAPL", 2023, 1, 0.3),
+            candidate("GOOG", 2023, 1, 0.25),
+        ]
+
+        context = retrieval.build_context("AAPL in 2023", [1, 0.2], candidates)
+
+        self.assertEqual(context, "AAPL 2023")
+
+    def test_no_candidates(self):
+        self.assertEqual(retrieval.build_context("AAPL", [1, 0], []), "")
+
+
+@override_settings(QUERY_CACHE_REDIS_URL=None)
+class QueryCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = QueryCache("test", max_size=10, ttl=60)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def start_leader(self, compute):
+        def run():
+            try:
+                self.cache.get_or_compute("key", compute)
+            except ValueError:
+                pass
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.started.wait()
+
+    def test_the_waiting_requests_retry_after_a_failure(self):
+        def fail():
+            self.started.set()
+            self.release.wait()
+            raise ValueError("provider failed")
+
+        self.start_leader(fail)
+        threading.Timer(0.05, self.release.set).start()
+
+        self.assertEqual(self.cache.get_or_compute("key", lambda: "value"), "value")
+
+    @override_settings(QUERY_CACHE_WAIT_TIMEOUT=0.05)
+    def test_a_stuck_computation_isnt_waited_for(self):
+        def block():
+            self.started.set()
+            self.release.wait()
+            return "late"
+
+        self.start_leader(block)
+        self.addCleanup(self.release.set)
+
+        self.assertEqual(self.cache.get_or_compute("key", lambda: "value"), "value")
+
+
+class RagPromptTests(SimpleTestCase):
+    def setUp(self):
+        get_rag_prompt.cache_clear()
+        self.addCleanup(get_rag_prompt.cache_clear)
+
+    @override_settings(RAG_PROMPT_FROM_HUB=False)
+    def test_local_copy_without_the_hub(self):
+        with mock.patch("langchain.hub.pull") as pull:
+            prompt = get_rag_prompt()
+
+        pull.assert_not_called()
+        self.assertEqual(prompt.messages[0].prompt.template, RAG_PROMPT_TEMPLATE)
+
+
+def create_statement(company: Company, calendar_year: int, **fields):
+    currency, _ = Currency.objects.get_or_create(
+        code="USD", defaults={"name": "US Dollar", "symbol": "$"}
+    )
+    return FinancialStatement.objects.create(
+        company=company,
+        currency=currency,
+        date_reported=datetime.date(calendar_year, 12, 31),
+        calendar_year=calendar_year,
+        period="FY",
+        **{
+            "revenue": Decimal("100.25"),
+            "net_income": Decimal("10"),
+            "gross_profit": Decimal("50"),
+            "operating_income": Decimal("20"),
+            "income_before_tax": Decimal("15"),
+            "operating_expenses": Decimal("30"),
+            "research_and_development_expenses": Decimal("5"),
+            **fields,
+        },
+    )
+
+
+@override_settings(EXPORT_STATEMENT_TIMEOUT=60)
+@mock.patch("core.exports.CHUNK_SIZE", 2)
+class ExportTests(TestCase):
+    def setUp(self):
+        company = Company.objects.create(name="Apple Inc.", symbol="AAPL")
+        self.statements = [
+            create_statement(company, 2021, total_assets=Decimal("1000.50")),
+            create_statement(company, 2022),
+            create_statement(company, 2023),
+        ]
+
+    def export(self, dataset: str) -> tuple[zipfile.ZipFile, dict]:
+        file = io.BytesIO()
+        write_export_archive(dataset, file)
+        archive = zipfile.ZipFile(file)
+        return archive, orjson.loads(archive.read("manifest.json"))
+
+    def read_column(self, archive, manifest, name: str) -> np.ndarray:
+        column = manifest["columns"][name]
+        parts = []
+        for filename in column["files"]:
+            data = archive.read(filename)
+            if column["encoding"] == "npy":
+                parts.append(np.load(io.BytesIO(data)))
+            else:
+                data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+                parts.append(np.frombuffer(data, dtype=column["dtype"]))
+        return np.concatenate(parts)
+
+    def test_statements(self):
+        with CaptureQueriesContext(connection) as queries:
+            archive, manifest = self.export("statements")
+
+        # the rows are read once, whatever the number of columns
+        self.assertEqual(
+            sum(query["sql"].startswith("DECLARE") for query in queries), 1
+        )
+
+        self.assertEqual(manifest["rows"], 3)
+        self.assertEqual(len(manifest["columns"]["revenue"]["files"]), 2)
+        self.assertEqual(
+            list(self.read_column(archive, manifest, "id")),
+            [statement.pk for statement in self.statements],
+        )
+        self.assertEqual(
+            list(self.read_column(archive, manifest, "revenue")), [10025] * 3
+        )
+        self.assertEqual(
+            list(self.read_column(archive, manifest, "total_assets")),
+            [100050, NULL_CENTS, NULL_CENTS],
+        )
+
+    def test_analyses_with_the_active_version_embeddings(self):
+        version = EmbeddingModelVersion.objects.create(
+            provider="Stub", model_name="test-embed", dimension=2, status="active"
+        )
+        for index, statement in enumerate(self.statements):
+            analysis = FinancialStatementAnalysis.objects.create(
+                financial_statement=statement, analysis_text=f"analysis {index}"
+            )
+            if index != 1:
+                FinancialStatementEmbedding.objects.create(
+                    analysis=analysis, version=version, embedding=[index, 1]
+                )
+
+        archive, manifest = self.export("analyses")
+
+        self.assertEqual(manifest["columns"]["embedding"]["shape"], [3, 2])
+        np.testing.assert_array_equal(
+            self.read_column(archive, manifest, "embedding"),
+            [[0, 1], [np.nan, np.nan], [2, 1]],
+        )
+
+
+class PartitioningTests(TestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Apple Inc.", symbol="AAPL")
+        self.statements = [
+            create_statement(self.company, year) for year in (2019, 2021)
+        ]
+
+    def partition_table(self):
+        # the deferred foreign key checks of the test's inserts would block the drop
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        partition_table(connection, years_ahead=1)
+
+    def get_statement_partitions(self) -> dict[int, str]:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT id, tableoid::regclass::text FROM {TABLE}")
+            return dict(cursor.fetchall())
+
+    def test_partition_table(self):
+        self.partition_table()
+
+        current_year = datetime.date.today().year
+        self.assertTrue(is_partitioned(connection))
+        self.assertEqual(
+            set(get_partitions(connection).values()),
+            {2019, 2021, current_year, current_year + 1, None},
+        )
+        self.assertEqual(
+            self.get_statement_partitions(),
+            {
+                self.statements[0].pk: get_partition_name(2019),
+                self.statements[1].pk: get_partition_name(2021),
+            },
+        )
+
+        # the ids keep coming from the sequence, the unique constraints still hold
+        statement = create_statement(self.company, 1990)
+        self.assertGreater(statement.pk, self.statements[1].pk)
+        self.assertEqual(
+            self.get_statement_partitions()[statement.pk], DEFAULT_PARTITION
+        )
+
+    def test_ensure_partitions_moves_the_default_rows(self):
+        self.partition_table()
+        statement = create_statement(self.company, 1990)
+
+        self.assertEqual(ensure_partitions(connection, years_ahead=1), [1990])
+
+        self.assertEqual(
+            self.get_statement_partitions()[statement.pk], get_partition_name(1990)
+        )
+        self.assertEqual(ensure_partitions(connection, years_ahead=1), [])
+
+    @override_settings(FINANCIAL_STATEMENT_PARTITION_YEARS_AHEAD=1)
+    def test_the_analyses_of_missing_statements_are_deleted(self):
+        self.partition_table()
+        for statement in self.statements:
+            FinancialStatementAnalysis.objects.create(financial_statement=statement)
+        # bypasses the ORM, which deletes the analyses with their statement
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {TABLE} WHERE id = %s", [self.statements[0].pk]
+            )
+
+        maintain_statement_partitions.apply()
+
+        self.assertEqual(
+            list(
+                FinancialStatementAnalysis.objects.values_list(
+                    "financial_statement_id", flat=True
+                )
+            ),
+            [self.statements[1].pk],
+        )
+
+
+class RefreshFinancialMetricsTests(TestCase):
+    def setUp(self):
+        self.company = Company.objects.create(name="Apple Inc.", symbol="AAPL")
+        create_statement(self.company, 2022, revenue=Decimal("100"))
+        self.statement = create_statement(self.company, 2023, revenue=Decimal("150"))
+
+    def get_metrics(self) -> dict[int, FinancialMetrics]:
+        return {
+            metrics.calendar_year: metrics
+            for metrics in FinancialMetrics.objects.filter(company=self.company)
+        }
+
+    def test_the_metrics_are_updated_in_place(self):
+        self.assertEqual(refresh_financial_metrics([self.company.pk]), 2)
+        before = self.get_metrics()
+        self.assertAlmostEqual(before[2023].revenue_growth, 0.5)
+
+        FinancialStatement.objects.filter(pk=self.statement.pk).update(
+            revenue=Decimal("200")
+        )
+        self.assertEqual(refresh_financial_metrics([self.company.pk]), 2)
+
+        after = self.get_metrics()
+        self.assertEqual(
+            {year: metrics.pk for year, metrics in after.items()},
+            {year: metrics.pk for year, metrics in before.items()},
+        )
+        self.assertEqual(after[2023].revenue, Decimal("200"))
+        self.assertAlmostEqual(after[2023].revenue_growth, 1.0)
+        self.assertAlmostEqual(after[2023].net_margin, 0.05)
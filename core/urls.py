@@ -5,4 +5,16 @@ from . import views
 
 urlpatterns = [
     path("ask/", views.financial_query, name="financial_query"),
+    path("metrics/", views.FinancialMetricsList.as_view(), name="financial_metrics"),
+    path(
+        "metrics/<str:symbol>/",
+        views.CompanyFinancialMetricsList.as_view(),
+        name="company_financial_metrics",
+    ),
+    path(
+        "companies/<str:symbol>/refresh/",
+        views.CompanyRefresh.as_view(),
+        name="company_refresh",
+    ),
+    path("export/<str:dataset>/", views.ExportDataset.as_view(), name="export_dataset"),
 ]
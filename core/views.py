@@ -1,28 +1,39 @@
 # Create your views here.
 
-from django.http import JsonResponse
-from langchain import hub
-from pgvector.django import CosineDistance
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import ListAPIView
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from embeds.models import CURRENT_MODEL, FinancialStatementAnalysis
+from core.exports import DATASETS, iter_export_archive
+from core.models import FinancialMetrics
+from core.pagination import (
+    CompanyFinancialMetricsPagination,
+    FinancialMetricsPagination,
+)
+from core.prompts import get_rag_prompt
+from core.retrieval import retrieve_context
+from core.serializers import FinancialMetricsSerializer
+from embeds.models import CURRENT_MODEL
+from embeds.versions import get_active_version
+from fin_vantage import instrumentation
+from fin_vantage.routers import read_replica
+from ingestion.tasks import request_hot_refresh
 
 
 def financial_query(request):
     if request.method == "GET":
         question = request.GET.get("question")
         if question:
-            embeddings = CURRENT_MODEL.embedding_model(
-                model=CURRENT_MODEL.model_name,
-            )
-
-            question_embedding = embeddings.embed_query(question)
-            context_texts = FinancialStatementAnalysis.objects.order_by(
-                CosineDistance("embedding", question_embedding)
-            ).values_list("analysis_text", flat=True)[:2]
-
-            context = "\n\n".join(context_texts)
+            with read_replica():
+                version = get_active_version()
+            context = ""
+            if version is not None:
+                context = retrieve_context(question, version)
 
-            prompt = hub.pull("rlm/rag-prompt")
+            prompt = get_rag_prompt()
             llm = CURRENT_MODEL.chat_model(
                 model=CURRENT_MODEL.chat_model_name, temperature=0
             )
@@ -35,3 +46,68 @@ def financial_query(request):
             response = {"error": "No question provided"}
 
         return JsonResponse(response)
+
+
+def prometheus_metrics(request):
+    metrics = instrumentation.render()
+    if metrics is None:
+        # the scrape fails, rather than reporting the values of a single process
+        return HttpResponse(
+            "Metrics unavailable", status=503, content_type="text/plain"
+        )
+    return HttpResponse(metrics, content_type="text/plain; version=0.0.4")
+
+
+class FinancialMetricsList(ListAPIView):
+    serializer_class = FinancialMetricsSerializer
+    pagination_class = FinancialMetricsPagination
+
+    def get_queryset(self):
+        queryset = FinancialMetrics.objects.select_related("company", "currency")
+
+        year = self.request.query_params.get("year")
+        if year:
+            if not year.isdigit():
+                raise ValidationError({"year": "Must be a calendar year."})
+            queryset = queryset.filter(calendar_year=int(year))
+
+        symbol = self.request.query_params.get("symbol")
+        if symbol:
+            queryset = queryset.filter(company__symbol=symbol.upper())
+
+        return queryset
+
+
+class CompanyFinancialMetricsList(ListAPIView):
+    serializer_class = FinancialMetricsSerializer
+    pagination_class = CompanyFinancialMetricsPagination
+
+    def get_queryset(self):
+        return FinancialMetrics.objects.select_related("company", "currency").filter(
+            company__symbol=self.kwargs["symbol"].upper()
+        )
+
+
+class ExportDataset(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, dataset):
+        if dataset not in DATASETS:
+            raise Http404(f"Unknown dataset {dataset}")
+
+        response = StreamingHttpResponse(
+            iter_export_archive(dataset), content_type="application/zip"
+        )
+        response["Content-Disposition"] = f'attachment; filename="{dataset}.zip"'
+        return response
+
+
+class CompanyRefresh(APIView):
+    """Queues the company on the hot fetch queue, ahead of the scheduled fetches."""
+
+    permission_classes = [IsAdminUser]
+
+    def post(self, request, symbol):
+        if not request_hot_refresh([symbol]):
+            raise Http404(f"Unknown company {symbol}")
+        return Response({"symbol": symbol, "queued": True}, status=202)
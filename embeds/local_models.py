@@ -0,0 +1,169 @@
+"""
+A local, CPU only embedding provider.
+
+Loads a static sentence-embedding model (the Model2Vec layout: ``tokenizer.json`` and
+the token vectors in ``model.safetensors``) from LOCAL_EMBEDDING_MODEL_DIR, and embeds
+a text as the normalized mean of its token vectors. The model is downloaded once with
+the download_local_embedding_model command.
+
+The texts of a call are split into batches of similar lengths, as many as the process
+pool sized to the host cores has processes, and spread over it. The batches are kept
+between LOCAL_EMBEDDING_MIN_BATCH_CHARACTERS and LOCAL_EMBEDDING_BATCH_CHARACTERS, so
+a call smaller than a batch is embedded in process.
+"""
+
+import functools
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import orjson
+from django.conf import settings
+from langchain_core.embeddings import Embeddings
+
+SAFETENSORS_DTYPES = {
+    "F64": "<f8",
+    "F32": "<f4",
+    "F16": "<f2",
+    "BF16": "<u2",
+    "I64": "<i8",
+    "I32": "<i4",
+}
+
+
+def load_safetensors(path: Path) -> dict[str, np.ndarray]:
+    """Maps the tensors of a safetensors file, the pages are shared by the processes."""
+    with open(path, "rb") as file:
+        header_size = int.from_bytes(file.read(8), "little")
+        header = orjson.loads(file.read(header_size))
+
+    tensors = {}
+    for name, tensor in header.items():
+        if name == "__metadata__":
+            continue
+        start, _ = tensor["data_offsets"]
+        array = np.memmap(
+            path,
+            dtype=SAFETENSORS_DTYPES[tensor["dtype"]],
+            mode="r",
+            offset=8 + header_size + start,
+            shape=tuple(tensor["shape"]),
+        )
+        if tensor["dtype"] == "BF16":
+            # bfloat16 is the upper half of a float32
+            array = (array.astype(np.uint32) << 16).view(np.float32)
+        tensors[name] = array
+    return tensors
+
+
+@functools.cache
+def load_model(directory: str):
+    from tokenizers import Tokenizer
+
+    path = Path(directory)
+    tokenizer = Tokenizer.from_file(str(path / "tokenizer.json"))
+    tensors = load_safetensors(path / "model.safetensors")
+    embeddings = tensors.get("embeddings")
+    if embeddings is None:
+        embeddings = next(iter(tensors.values()))
+    return tokenizer, embeddings
+
+
+def embed_texts(directory: str, texts: list[str]) -> np.ndarray:
+    tokenizer, token_vectors = load_model(directory)
+    vectors = np.zeros((len(texts), token_vectors.shape[1]), dtype=np.float32)
+    for index, encoding in enumerate(
+        tokenizer.encode_batch(texts, add_special_tokens=False)
+    ):
+        if encoding.ids:
+            vectors[index] = token_vectors[encoding.ids].mean(axis=0)
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+def make_batches(texts: list[str], max_characters: int) -> list[list[int]]:
+    """
+    Groups the indices of the texts into batches of similar lengths, each holding up
+    to `max_characters` characters, so that no batch is padded by a long outlier.
+    """
+    batches = []
+    batch, batch_characters = [], 0
+    for index in sorted(range(len(texts)), key=lambda index: len(texts[index])):
+        if batch and batch_characters + len(texts[index]) > max_characters:
+            batches.append(batch)
+            batch, batch_characters = [], 0
+        batch.append(index)
+        batch_characters += len(texts[index])
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_processes() -> int:
+    return settings.LOCAL_EMBEDDING_PROCESSES or os.cpu_count() or 1
+
+
+def get_batch_characters(texts: list[str]) -> int:
+    """The characters of a batch, splitting the texts over every process of the pool."""
+    per_process = math.ceil(sum(len(text) for text in texts) / get_processes())
+    return max(
+        settings.LOCAL_EMBEDDING_MIN_BATCH_CHARACTERS,
+        min(per_process, settings.LOCAL_EMBEDDING_BATCH_CHARACTERS),
+    )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor | None:
+    global _pool
+    # the daemonic processes of a prefork pool can't have children of their own
+    if multiprocessing.current_process().daemon:
+        return None
+    # the threads of a worker embed at the same time, they share a single pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=get_processes(),
+                # forking a threaded worker can deadlock its children
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+class LocalEmbeddings(Embeddings):
+    def __init__(self, model: str = "", **kwargs):
+        self.model = model
+        self.directory = str(settings.LOCAL_EMBEDDING_MODEL_DIR)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        batches = make_batches(texts, get_batch_characters(texts))
+        pool = _get_pool() if len(batches) > 1 else None
+
+        if pool is None:
+            results = [
+                embed_texts(self.directory, [texts[index] for index in batch])
+                for batch in batches
+            ]
+        else:
+            results = pool.map(
+                embed_texts,
+                [self.directory] * len(batches),
+                [[texts[index] for index in batch] for batch in batches],
+            )
+
+        vectors = [None] * len(texts)
+        for batch, batch_vectors in zip(batches, results):
+            for index, vector in zip(batch, batch_vectors):
+                vectors[index] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return embed_texts(self.directory, [text])[0].tolist()
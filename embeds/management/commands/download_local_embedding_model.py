@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from huggingface_hub import snapshot_download
+
+
+class Command(BaseCommand):
+    help = "Downloads the local embedding model from the Hugging Face hub."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repo", default=settings.LOCAL_EMBEDDING_MODEL_REPO)
+        parser.add_argument("--directory", default=settings.LOCAL_EMBEDDING_MODEL_DIR)
+
+    def handle(self, *args, **options):
+        path = snapshot_download(
+            repo_id=options["repo"],
+            local_dir=options["directory"],
+            allow_patterns=["tokenizer.json", "model.safetensors", "config.json"],
+            token=settings.HF_TOKEN,
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"Downloaded {options['repo']} to {path}.")
+        )
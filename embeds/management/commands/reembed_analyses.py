@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from embeds.models import EmbeddingModelVersion, LlmModel
+from embeds.tasks import reembed_analyses
+from embeds.versions import get_coverage, get_or_create_version
+from queues import Queues
+
+
+class Command(BaseCommand):
+    help = (
+        "Embeds every analysis with another model in the background, then switches "
+        "the retrieval to it. Without a provider, shows the coverage of the versions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "provider", nargs="?", help="An LlmModel, for example MistralAI."
+        )
+
+    def handle(self, *args, **options):
+        provider = options["provider"]
+        if provider is None:
+            for version in EmbeddingModelVersion.objects.order_by("id"):
+                embedded, total = get_coverage(version)
+                self.stdout.write(f"{version}: {embedded}/{total} analyses")
+            return
+
+        if not hasattr(LlmModel, provider):
+            raise CommandError(f"Unknown provider {provider}.")
+
+        version = get_or_create_version(provider)
+        if version.status == EmbeddingModelVersion.Status.ACTIVE:
+            raise CommandError(f"{version} is already active.")
+        if version.status == EmbeddingModelVersion.Status.RETIRED:
+            # a rollback, the analyses rewritten since it was retired are re-embedded
+            EmbeddingModelVersion.objects.filter(pk=version.pk).update(
+                status=EmbeddingModelVersion.Status.BUILDING
+            )
+
+        reembed_analyses.apply_async(
+            args=[version.pk], queue=Queues.FINANCIAL_SENTENCES
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Queued the re-embedding of the analyses with {version}."
+            )
+        )
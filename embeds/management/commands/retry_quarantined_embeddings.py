@@ -0,0 +1,22 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from embeds.writer import retry_quarantined
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes the quarantined analyses and embeddings again, keeping those that "
+        "still fail in the quarantine."
+    )
+
+    def handle(self, *args, **options):
+        written, failed = retry_quarantined(
+            logging.getLogger("build_financial_embeddings")
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Wrote {written} quarantined analyses, {failed} failed."
+            )
+        )
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.1 on 2026-10-19 14:24
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the indexed tables grow with history, build the indexes without blocking writes
+    atomic = False
+
+    dependencies = [
+        ('core', '0011_companydatatracker_core_tracker_last_fetch_idx_and_more'),
+        ('embeds', '0007_alter_financialstatementanalysis_embedding'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='financialstatementanalysis',
+            index=models.Index(fields=['last_modified'], include=('financial_statement',), name='embeds_analysis_modified_idx'),
+        ),
+    ]
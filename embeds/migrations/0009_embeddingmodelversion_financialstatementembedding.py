@@ -0,0 +1,131 @@
+# Generated by Django 5.2.1 on 2026-10-19 14:41
+
+import django.db.models.deletion
+import django.utils.timezone
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+def copy_embeddings_to_version(apps, schema_editor):
+    """The embeddings stored so far become the active version."""
+    EmbeddingModelVersion = apps.get_model("embeds", "EmbeddingModelVersion")
+    FinancialStatementAnalysis = apps.get_model("embeds", "FinancialStatementAnalysis")
+
+    if not FinancialStatementAnalysis.objects.filter(embedding__isnull=False).exists():
+        return
+
+    # Mistral was the only embedding model before the versions
+    version = EmbeddingModelVersion.objects.create(
+        provider="MistralAI",
+        model_name="mistral-embed",
+        dimension=1024,
+        status="active",
+        activated_at=django.utils.timezone.now(),
+    )
+    schema_editor.execute(
+        "INSERT INTO embeds_financialstatementembedding (analysis_id, version_id, embedding) "
+        "SELECT id, %s, embedding FROM embeds_financialstatementanalysis "
+        "WHERE embedding IS NOT NULL",
+        [version.id],
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("embeds", "0008_financialstatementanalysis_embeds_analysis_modified_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmbeddingModelVersion",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "provider",
+                    models.CharField(
+                        help_text="The LlmModel the embeddings are made with.",
+                        max_length=50,
+                    ),
+                ),
+                ("model_name", models.CharField(max_length=100)),
+                ("dimension", models.PositiveIntegerField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("building", "Building"),
+                            ("active", "Active"),
+                            ("retired", "Retired"),
+                        ],
+                        default="building",
+                        max_length=10,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("activated_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        condition=models.Q(("status", "active")),
+                        fields=("status",),
+                        name="embeds_single_active_version",
+                    )
+                ],
+                "unique_together": {("provider", "model_name")},
+            },
+        ),
+        migrations.CreateModel(
+            name="FinancialStatementEmbedding",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "embedding",
+                    pgvector.django.vector.VectorField(
+                        help_text="Vector representation of the analysis text."
+                    ),
+                ),
+                (
+                    "analysis",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="embeddings",
+                        to="embeds.financialstatementanalysis",
+                    ),
+                ),
+                (
+                    "version",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="embeddings",
+                        to="embeds.embeddingmodelversion",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("version", "analysis")},
+            },
+        ),
+        migrations.RunPython(copy_embeddings_to_version, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="financialstatementanalysis",
+            name="embedding",
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.1 on 2026-10-19 14:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("embeds", "0009_embeddingmodelversion_financialstatementembedding"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="financialstatementanalysis",
+            name="source_hash",
+            field=models.CharField(
+                blank=True,
+                default="",
+                help_text="A hash of the statement values the text was rendered from.",
+                max_length=32,
+            ),
+        ),
+        migrations.AddField(
+            model_name="financialstatementanalysis",
+            name="template_version",
+            field=models.PositiveSmallIntegerField(
+                default=1,
+                help_text="The version of embeds.templating the text was rendered with.",
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.1 on 2026-10-19 14:59
+
+import django.db.models.deletion
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("embeds", "0010_financialstatementanalysis_template"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmbeddingQuarantine",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("financial_statement_id", models.BigIntegerField()),
+                ("analysis_text", models.TextField()),
+                ("template_version", models.PositiveSmallIntegerField(default=1)),
+                (
+                    "source_hash",
+                    models.CharField(blank=True, default="", max_length=32),
+                ),
+                ("embedding", pgvector.django.vector.VectorField()),
+                ("error", models.TextField()),
+                ("attempts", models.PositiveIntegerField(default=1)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "version",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="quarantined",
+                        to="embeds.embeddingmodelversion",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.1 on 2026-10-19 15:14
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the indexed table grows with history, build the index without blocking writes
+    atomic = False
+
+    dependencies = [
+        ("core", "0014_partition_financialstatement"),
+        ("embeds", "0011_embeddingquarantine"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="financialstatementanalysis",
+            index=models.Index(
+                condition=models.Q(("template_version__lt", 2)),
+                fields=["financial_statement"],
+                name="embeds_analysis_outdated_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.1 on 2026-10-19 15:22
+
+from django.contrib.postgres.operations import (
+    AddIndexConcurrently,
+    RemoveIndexConcurrently,
+)
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the partial index follows TEMPLATE_VERSION, rebuilt without blocking writes
+    atomic = False
+
+    dependencies = [
+        ("core", "0014_partition_financialstatement"),
+        ("embeds", "0012_financialstatementanalysis_outdated_idx"),
+    ]
+
+    operations = [
+        RemoveIndexConcurrently(
+            model_name="financialstatementanalysis",
+            name="embeds_analysis_outdated_idx",
+        ),
+        AddIndexConcurrently(
+            model_name="financialstatementanalysis",
+            index=models.Index(
+                condition=models.Q(("template_version__lt", 3)),
+                fields=["financial_statement"],
+                name="embeds_analysis_outdated_idx",
+            ),
+        ),
+    ]
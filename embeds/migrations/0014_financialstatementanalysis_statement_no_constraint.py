@@ -0,0 +1,29 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0014_partition_financialstatement"),
+        ("embeds", "0013_financialstatementanalysis_outdated_idx_v3"),
+    ]
+
+    operations = [
+        # core 0014 or the maintain_statement_partitions command drops the constraint
+        # when partitioning the statements, unpartitioned databases keep it
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name="financialstatementanalysis",
+                    name="financial_statement",
+                    field=models.OneToOneField(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="financial_statement_analysis",
+                        to="core.financialstatement",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.1 on 2026-10-19 18:02
+
+from django.db import migrations
+
+
+def create_active_version_index(apps, schema_editor):
+    """The index of the active version, the later ones are built as they are activated."""
+    EmbeddingModelVersion = apps.get_model("embeds", "EmbeddingModelVersion")
+
+    # pgvector doesn't index the vectors of more than 2000 dimensions
+    version = EmbeddingModelVersion.objects.filter(
+        status="active", dimension__lte=2000
+    ).first()
+    if version is None:
+        return
+    schema_editor.execute(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS embeds_embedding_v{version.pk}_idx "
+        f"ON embeds_financialstatementembedding "
+        f"USING hnsw ((embedding::vector({version.dimension})) vector_cosine_ops) "
+        f"WHERE version_id = {version.pk}"
+    )
+
+
+def drop_active_version_index(apps, schema_editor):
+    EmbeddingModelVersion = apps.get_model("embeds", "EmbeddingModelVersion")
+
+    version = EmbeddingModelVersion.objects.filter(status="active").first()
+    if version is None:
+        return
+    schema_editor.execute(
+        f"DROP INDEX CONCURRENTLY IF EXISTS embeds_embedding_v{version.pk}_idx"
+    )
+
+
+class Migration(migrations.Migration):
+    # the index is built concurrently, which can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ("embeds", "0014_financialstatementanalysis_statement_no_constraint"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_active_version_index, drop_active_version_index),
+    ]
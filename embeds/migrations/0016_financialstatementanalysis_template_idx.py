@@ -0,0 +1,31 @@
+# Generated by Django 5.2.1 on 2026-10-19 15:47
+
+from django.contrib.postgres.operations import (
+    AddIndexConcurrently,
+    RemoveIndexConcurrently,
+)
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the index replacing the partial one is built without blocking writes, first
+    atomic = False
+
+    dependencies = [
+        ("core", "0015_financialstatement_balance_sheet_cash_flow"),
+        ("embeds", "0015_embedding_active_version_index"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="financialstatementanalysis",
+            index=models.Index(
+                fields=["template_version", "financial_statement"],
+                name="embeds_analysis_template_idx",
+            ),
+        ),
+        RemoveIndexConcurrently(
+            model_name="financialstatementanalysis",
+            name="embeds_analysis_outdated_idx",
+        ),
+    ]
@@ -1,20 +1,81 @@
+from django.conf import settings
 from django.db import models
-from langchain_mistralai import ChatMistralAI, MistralAIEmbeddings
 from pgvector.django import VectorField
 
 from core.models import FinancialStatement
+from fin_vantage.lazy import LazyImport
 
 
 class LlmModel:
     class MistralAI:
-        embedding_model = MistralAIEmbeddings
-        chat_model = ChatMistralAI
+        embedding_model = LazyImport("langchain_mistralai.MistralAIEmbeddings")
+        chat_model = LazyImport("langchain_mistralai.ChatMistralAI")
         chat_model_name= "mistral-small-latest"
         model_name = "mistral-embed"
         embedding_length = 1024
 
+    class Local:
+        """Embeds on the CPU with a model from LOCAL_EMBEDDING_MODEL_DIR, chats with Mistral."""
 
-CURRENT_MODEL = LlmModel.MistralAI
+        embedding_model = LazyImport("embeds.local_models.LocalEmbeddings")
+        chat_model = LazyImport("langchain_mistralai.ChatMistralAI")
+        chat_model_name = "mistral-small-latest"
+        model_name = settings.LOCAL_EMBEDDING_MODEL_NAME
+        embedding_length = settings.LOCAL_EMBEDDING_DIMENSION
+
+    class Stub:
+        """Offline deterministic models, for the benchmarks."""
+
+        embedding_model = LazyImport("embeds.stub_models.StubEmbeddings")
+        chat_model = LazyImport("embeds.stub_models.StubChatModel")
+        chat_model_name = "stub-chat"
+        model_name = "stub-embed"
+        # StubEmbeddings embeds with this dimension
+        embedding_length = 1024
+
+
+CURRENT_MODEL = getattr(LlmModel, settings.LLM_MODEL)
+
+
+class EmbeddingModelVersion(models.Model):
+    """
+    An embedding model the analyses are, or are being, embedded with. Several versions
+    coexist, the retrieval uses the single active one, and a new version is built in
+    the background before it replaces it.
+    """
+
+    class Status(models.TextChoices):
+        BUILDING = "building"
+        ACTIVE = "active"
+        RETIRED = "retired"
+
+    provider = models.CharField(
+        max_length=50, help_text="The LlmModel the embeddings are made with."
+    )
+    model_name = models.CharField(max_length=100)
+    dimension = models.PositiveIntegerField()
+    status = models.CharField(
+        max_length=10, choices=Status.choices, default=Status.BUILDING
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    activated_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ("provider", "model_name")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["status"],
+                condition=models.Q(status="active"),
+                name="embeds_single_active_version",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.provider}/{self.model_name} ({self.status})"
+
+    @property
+    def model(self):
+        return getattr(LlmModel, self.provider)
 
 
 class FinancialStatementAnalysis(models.Model):
@@ -22,16 +83,79 @@ class FinancialStatementAnalysis(models.Model):
         FinancialStatement,
         on_delete=models.CASCADE,
         related_name="financial_statement_analysis",
+        # not enforced once the statements are partitioned, see core.partitioning
+        db_constraint=False,
     )
     analysis_text = models.TextField(
         help_text="The generated analysis text that was embedded.",
         blank=True,
         null=True,
     )
-    embedding = VectorField(
-        max_length=CURRENT_MODEL.embedding_length,
-        null=True,
+    last_modified = models.DateField(auto_now=True, null=True, blank=True)
+    template_version = models.PositiveSmallIntegerField(
+        default=1,
+        help_text="The version of embeds.templating the text was rendered with.",
+    )
+    source_hash = models.CharField(
+        max_length=32,
         blank=True,
-        help_text="Vector representation of the analysis text.",
+        default="",
+        help_text="A hash of the statement values the text was rendered from.",
     )
-    last_modified = models.DateField(auto_now=True, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["last_modified"],
+                include=["financial_statement"],
+                name="embeds_analysis_modified_idx",
+            ),
+            # the analyses to render again are a range below TEMPLATE_VERSION, whichever
+            # it is, a bump doesn't need a migration
+            models.Index(
+                fields=["template_version", "financial_statement"],
+                name="embeds_analysis_template_idx",
+            ),
+        ]
+
+
+class FinancialStatementEmbedding(models.Model):
+    analysis = models.ForeignKey(
+        FinancialStatementAnalysis,
+        on_delete=models.CASCADE,
+        related_name="embeddings",
+    )
+    version = models.ForeignKey(
+        EmbeddingModelVersion,
+        on_delete=models.CASCADE,
+        related_name="embeddings",
+    )
+    # not sized, the versions differ in dimension, each has its own index cast to its
+    # dimension, see embeds.versions.create_vector_index
+    embedding = VectorField(help_text="Vector representation of the analysis text.")
+
+    class Meta:
+        # version first, it serves the retrieval and the coverage of a version
+        unique_together = ("version", "analysis")
+
+
+class EmbeddingQuarantine(models.Model):
+    """
+    An analysis and its embedding that couldn't be written, kept to be written
+    again instead of being embedded a second time.
+    """
+
+    version = models.ForeignKey(
+        EmbeddingModelVersion,
+        on_delete=models.CASCADE,
+        related_name="quarantined",
+    )
+    # not a foreign key, a missing statement is one of the reasons to be here
+    financial_statement_id = models.BigIntegerField()
+    analysis_text = models.TextField()
+    template_version = models.PositiveSmallIntegerField(default=1)
+    source_hash = models.CharField(max_length=32, blank=True, default="")
+    embedding = VectorField()
+    error = models.TextField()
+    attempts = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,62 @@
+"""
+Deterministic, offline stand-ins for the embedding and chat providers, used by the benchmarks.
+Their simulated latency comes from the STUB_EMBEDDING_LATENCY and STUB_CHAT_LATENCY settings.
+"""
+
+import re
+import time
+import zlib
+
+import numpy as np
+from django.conf import settings
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import SimpleChatModel
+
+from embeds.models import LlmModel
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class StubEmbeddings(Embeddings):
+    """
+    Hashes the words of a text into a normalized bag-of-words vector, so that
+    texts sharing words end up close to each other and retrieval stays meaningful.
+    """
+
+    dimension = LlmModel.Stub.embedding_length
+
+    def __init__(self, model: str = "", **kwargs):
+        self.model = model
+
+    def _embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            vector[zlib.crc32(token.encode()) % self.dimension] += 1.0
+
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(getattr(settings, "STUB_EMBEDDING_LATENCY", 0))
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(getattr(settings, "STUB_EMBEDDING_LATENCY", 0))
+        return self._embed(text)
+
+
+class StubChatModel(SimpleChatModel):
+    """Answers with the beginning of the prompt it received."""
+
+    model: str = ""
+    temperature: float = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        time.sleep(getattr(settings, "STUB_CHAT_LATENCY", 0))
+        return f"Stub answer based on: {messages[-1].content[:200]}"
@@ -4,69 +4,144 @@ import time
 
 from celery import shared_task
 from dateutil.relativedelta import relativedelta
-from django.db.models import Q
+from django.conf import settings
+from django.db.models import Prefetch, Q
 
 from core.models import Company, FinancialStatement
-from embeds.models import CURRENT_MODEL, FinancialStatementAnalysis
+from embeds.models import EmbeddingModelVersion, FinancialStatementAnalysis
+from embeds.templating import TEMPLATE_VERSION, hash_statement, render_statement
+from embeds.versions import (
+    IncompleteVersionError,
+    activate_version,
+    get_coverage,
+    get_missing_analyses,
+    get_or_create_active_version,
+)
+from embeds.writer import AnalysisRow, EmbeddingWriter, write_embeddings
+from fin_vantage.instrumentation import DB_WRITE_SECONDS, EMBEDDING_BATCH_SECONDS
+from fin_vantage.routers import read_replica
+from fin_vantage.serialization import SERIALIZER_NAME
 from queues import Queues
 
 
-@shared_task
+@shared_task(serializer=SERIALIZER_NAME)
 def build_financial_embeddings(sentences):
     logger = logging.getLogger("build_financial_embeddings")
     logger.info("Starting build_financial_embeddings task ...")
     logger.info(f"Received {len(sentences)} companies to create embeddings for.")
 
-    embeddings = CURRENT_MODEL.embedding_model(
-        model=CURRENT_MODEL.model_name,
+    # the new analyses are embedded with the active version, a version being built
+    # picks them up in reembed_analyses
+    version = get_or_create_active_version()
+    embeddings = version.model.embedding_model(
+        model=version.model_name,
     )
 
-    financial_analyses = []
-    for index, sentences_chunk in enumerate(sentences):
-        start_time = datetime.datetime.now()
-        embedding_vectors = embeddings.embed_documents(
-            [sentence["sentence"] for sentence in sentences_chunk["sentences"]]
-        )
-        time.sleep(5)
-        duration = datetime.datetime.now() - start_time
-        logger.info(
-            f"Embedding data for company {index + 1}/{len(sentences)} took {duration.total_seconds()} seconds"
-        )
+    with EmbeddingWriter(version, logger) as writer:
+        for index, sentences_chunk in enumerate(sentences):
+            start_time = datetime.datetime.now()
+            with EMBEDDING_BATCH_SECONDS.time(model=version.model_name):
+                embedding_vectors = embeddings.embed_documents(
+                    [sentence["sentence"] for sentence in sentences_chunk["sentences"]]
+                )
+            time.sleep(settings.EMBEDDING_REQUEST_DELAY)
+            duration = datetime.datetime.now() - start_time
+            logger.info(
+                f"Embedding data for company {index + 1}/{len(sentences)} took {duration.total_seconds()} seconds"
+            )
 
-        for i, embedding_vector in enumerate(embedding_vectors):
-            sentence = sentences_chunk["sentences"][i]
+            for sentence, embedding_vector in zip(
+                sentences_chunk["sentences"], embedding_vectors
+            ):
+                writer.add(
+                    AnalysisRow(
+                        statement_id=sentence["statement_id"],
+                        text=sentence["sentence"],
+                        # the payloads queued before the templating have neither
+                        template_version=sentence.get("template_version", 1),
+                        source_hash=sentence.get("source_hash", ""),
+                        embedding=embedding_vector,
+                    )
+                )
 
-            statement_id = sentence["statement_id"]
-            sentence_text = sentence["sentence"]
+    logger.info(
+        f"Inserted {writer.written} financial analyses into the database, "
+        f"quarantined {writer.quarantined}."
+    )
 
-            financial_analyses.append(
-                FinancialStatementAnalysis(
-                    financial_statement_id=statement_id,
-                    analysis_text=sentence_text,
-                    embedding=embedding_vector,
-                )
+
+@shared_task
+def reembed_analyses(version_id: int):
+    """
+    Embeds a page of the analyses the version is missing, then queues itself for the
+    next page, and activates the version once it covers every analysis. The provider
+    calls are spaced by EMBEDDING_REQUEST_DELAY only, the re-embedding runs at the
+    provider rate limit while the active version keeps serving the queries.
+    """
+    logger = logging.getLogger("build_financial_embeddings")
+
+    version = EmbeddingModelVersion.objects.get(pk=version_id)
+    if version.status != EmbeddingModelVersion.Status.BUILDING:
+        logger.info(f"{version} is not being built, stopping.")
+        return
+
+    embeddings = version.model.embedding_model(model=version.model_name)
+
+    analyses = list(
+        get_missing_analyses(version)
+        .order_by("id")
+        .values_list("id", "analysis_text")[: settings.REEMBED_PAGE_SIZE]
+    )
+    for index in range(0, len(analyses), settings.REEMBED_BATCH_SIZE):
+        batch = analyses[index : index + settings.REEMBED_BATCH_SIZE]
+        with EMBEDDING_BATCH_SECONDS.time(model=version.model_name):
+            embedding_vectors = embeddings.embed_documents(
+                [analysis_text for _, analysis_text in batch]
             )
+        with DB_WRITE_SECONDS.time(
+            task="reembed_analyses", model="FinancialStatementEmbedding"
+        ):
+            write_embeddings(
+                version,
+                [
+                    (analysis_id, vector)
+                    for (analysis_id, _), vector in zip(batch, embedding_vectors)
+                ],
+            )
+        time.sleep(settings.EMBEDDING_REQUEST_DELAY)
 
-    try:
-        FinancialStatementAnalysis.objects.bulk_create(
-            financial_analyses, batch_size=1000
+    embedded, total = get_coverage(version)
+    logger.info(f"{version} covers {embedded}/{total} analyses.")
+
+    if analyses:
+        reembed_analyses.apply_async(
+            args=[version_id], queue=Queues.FINANCIAL_SENTENCES
         )
-        logger.info(
-            f"Inserted {len(financial_analyses)} financial analyses into the database."
+        return
+
+    try:
+        activate_version(version)
+        logger.info(f"Activated {version}.")
+    except IncompleteVersionError:
+        # analyses were added since the page was read
+        reembed_analyses.apply_async(
+            args=[version_id], queue=Queues.FINANCIAL_SENTENCES
         )
-    except Exception as e:
-        logger.error(f"Error inserting financial analyses: {e}")
 
 
-@shared_task
-def generate_financial_sentences():
-    logger = logging.getLogger("generate_financial_sentences")
+def get_statements_to_describe():
+    """The statements prefetched for every company to describe."""
+    return FinancialStatement.objects.select_related(
+        "currency", "financial_statement_analysis"
+    ).order_by("-calendar_year")
 
-    logger.info("Starting generate_financial_sentences task ...")
 
+def get_companies_to_describe():
     one_year_ago = datetime.date.today() - relativedelta(years=1)
-    companies = (
-        Company.objects.prefetch_related("financial_statements")
+    return (
+        Company.objects.prefetch_related(
+            Prefetch("financial_statements", queryset=get_statements_to_describe())
+        )
         .filter(
             Q(financial_statements__isnull=False)
             & (
@@ -74,41 +149,67 @@ def generate_financial_sentences():
                 | Q(
                     financial_statements__financial_statement_analysis__last_modified__lt=one_year_ago
                 )
+                | Q(
+                    financial_statements__financial_statement_analysis__template_version__lt=TEMPLATE_VERSION
+                )
             )
         )
         .distinct()
     )
 
-    statements_by_company = {
-        company.id: list(company.financial_statements.order_by("-calendar_year"))
-        for company in companies
-    }
-
-    def generate_sentence(statement: FinancialStatement) -> str:
-        return " ".join(
-            [
-                f"The company {statement.company.name}, with the symbol {statement.company.symbol}, for the year {statement.calendar_year}, has a total revenue of {statement.revenue}.",
-                f"The net income is {statement.net_income}, the gross profit is {statement.gross_profit}, and the operating income is {statement.operating_income}.",
-                f"The income before tax is {statement.income_before_tax}, the operating expenses are {statement.operating_expenses}, and the research and development expenses are {statement.research_and_development_expenses}.",
-                f"The financial statement was reported on {statement.date_reported} and the reported period is {statement.period}.",
-            ]
+
+def describe_statements(statements) -> tuple[list[dict], list[int]]:
+    """
+    The sentences of the statements to embed, and the ids of the analyses whose
+    statement didn't change since they were rendered.
+    """
+    sentences, unchanged = [], []
+    for statement in statements:
+        source_hash = hash_statement(statement)
+        analysis = getattr(statement, "financial_statement_analysis", None)
+        if analysis is not None and analysis.source_hash == source_hash:
+            unchanged.append(analysis.id)
+            continue
+
+        sentences.append(
+            {
+                "statement_id": statement.id,
+                "sentence": render_statement(statement),
+                "template_version": TEMPLATE_VERSION,
+                "source_hash": source_hash,
+            }
         )
+    return sentences, unchanged
+
+
+@shared_task
+def generate_financial_sentences():
+    logger = logging.getLogger("generate_financial_sentences")
+
+    logger.info("Starting generate_financial_sentences task ...")
 
-    sentences = [
-        {
-            "company_id": company_id,
-            "sentences": [
-                {
-                    "statement_id": statement.id,
-                    "sentence": generate_sentence(statement),
-                }
-                for statement in financial_statements
-            ],
+    with read_replica():
+        statements_by_company = {
+            company.id: list(company.financial_statements.all())
+            for company in get_companies_to_describe()
         }
-        for company_id, financial_statements in statements_by_company.items()
-    ]
 
-    logger.info(f"Generated sentences for {len(sentences)} companies.")
+    sentences, unchanged = [], []
+    for company_id, financial_statements in statements_by_company.items():
+        company_sentences, company_unchanged = describe_statements(financial_statements)
+        unchanged.extend(company_unchanged)
+        if company_sentences:
+            sentences.append({"company_id": company_id, "sentences": company_sentences})
+
+    # the unchanged analyses are kept, and not looked at again for another year
+    FinancialStatementAnalysis.objects.filter(id__in=unchanged).update(
+        last_modified=datetime.date.today()
+    )
+
+    logger.info(
+        f"Generated sentences for {len(sentences)} companies, "
+        f"{len(unchanged)} statements didn't change."
+    )
 
     chunk_size = 20
     chunks = [
@@ -0,0 +1,117 @@
+"""
+Renders the financial statements as the text that is embedded.
+
+The text is compact, with the amounts scaled to thousands, millions, billions or
+trillions, so that a statement costs fewer tokens and its numbers read the way the
+questions write them. Every analysis stores the TEMPLATE_VERSION it was rendered with
+and a hash of what it was rendered from, so that the unchanged statements are neither
+rendered nor embedded again.
+"""
+
+import hashlib
+import time
+from decimal import Decimal
+
+import orjson
+from django.db.models import Count
+
+from core.models import Currency, FinancialStatement
+
+# raised whenever the template or the number formatting changes, the analyses rendered
+# with an older version are rendered again
+TEMPLATE_VERSION = 3
+
+SCALES = [
+    (Decimal(10) ** 12, "T"),
+    (Decimal(10) ** 9, "B"),
+    (Decimal(10) ** 6, "M"),
+    (Decimal(10) ** 3, "K"),
+]
+
+# the statement fields, in the order they are rendered
+AMOUNTS = [
+    ("revenue", "revenue"),
+    ("gross_profit", "gross profit"),
+    ("operating_income", "operating income"),
+    ("income_before_tax", "income before tax"),
+    ("net_income", "net income"),
+    ("operating_expenses", "operating expenses"),
+    ("research_and_development_expenses", "R&D expenses"),
+]
+
+# the currencies are synced while the workers run, their symbols are read again after
+SHARED_SYMBOLS_CACHE_SECONDS = 10 * 60
+
+TEMPLATE = (
+    "{name} ({symbol}), {period} {calendar_year}, reported {date_reported}: {amounts}."
+)
+
+
+def format_money(amount: Decimal, currency_symbol: str) -> str:
+    """Formats 394328000000.00 in dollars as $394.3B."""
+    sign = "-" if amount < 0 else ""
+    amount = abs(amount)
+    scaled, suffix = amount.quantize(Decimal(1)), ""
+    # the next unit up once the rounded amount reaches 1000, 999.96B reads 1.0T
+    for scale, next_suffix in reversed(SCALES):
+        if scaled < 1000:
+            break
+        scaled, suffix = (amount / scale).quantize(Decimal("0.1")), next_suffix
+    return f"{sign}{currency_symbol}{scaled}{suffix}"
+
+
+_shared_symbols = (0.0, frozenset())
+
+
+def get_shared_symbols() -> frozenset[str]:
+    """The symbols of several currencies, such as $ for the dollar and the pesos."""
+    global _shared_symbols
+    expires_at, symbols = _shared_symbols
+    if time.monotonic() < expires_at:
+        return symbols
+    symbols = frozenset(
+        Currency.objects.values("symbol")
+        .annotate(currencies=Count("id"))
+        .filter(currencies__gt=1)
+        .values_list("symbol", flat=True)
+    )
+    _shared_symbols = (time.monotonic() + SHARED_SYMBOLS_CACHE_SECONDS, symbols)
+    return symbols
+
+
+def get_currency_symbol(statement: FinancialStatement) -> str:
+    """The symbol of the currency, or its ISO code when the symbol is ambiguous."""
+    currency = statement.currency
+    if currency.symbol and currency.symbol not in get_shared_symbols():
+        return currency.symbol
+    return f"{currency.code} "
+
+
+def hash_statement(statement: FinancialStatement) -> str:
+    """A hash of everything the rendered text depends on, cheaper than rendering."""
+    values = [
+        TEMPLATE_VERSION,
+        statement.company.name,
+        statement.company.symbol,
+        statement.period,
+        statement.calendar_year,
+        str(statement.date_reported),
+        get_currency_symbol(statement),
+        *[str(getattr(statement, field)) for field, _ in AMOUNTS],
+    ]
+    return hashlib.blake2b(orjson.dumps(values), digest_size=16).hexdigest()
+
+
+def render_statement(statement: FinancialStatement) -> str:
+    currency_symbol = get_currency_symbol(statement)
+    return TEMPLATE.format(
+        name=statement.company.name,
+        symbol=statement.company.symbol,
+        period=statement.period,
+        calendar_year=statement.calendar_year,
+        date_reported=statement.date_reported,
+        amounts=", ".join(
+            f"{label} {format_money(getattr(statement, field), currency_symbol)}"
+            for field, label in AMOUNTS
+        ),
+    )
@@ -1,3 +1,400 @@
-from django.test import TestCase
+import dataclasses
+import datetime
+import time
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.db import DatabaseError, IntegrityError, connection
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+
+from core.models import Company, Currency, FinancialStatement
+from core.retrieval import fetch_candidates
+from embeds import templating
+from embeds.local_models import get_batch_characters, make_batches
+from embeds.models import (
+    EmbeddingModelVersion,
+    EmbeddingQuarantine,
+    FinancialStatementAnalysis,
+    FinancialStatementEmbedding,
+)
+from embeds.versions import activate_version, get_vector_index_name
+from embeds.writer import (
+    AnalysisRow,
+    EmbeddingWriter,
+    EmbeddingWriteError,
+    write_analyses,
+)
+
+
+def make_statement(currency: Currency, revenue: str = "394328000000.00"):
+    return FinancialStatement(
+        company=Company(name="Apple Inc.", symbol="AAPL"),
+        currency=currency,
+        date_reported=datetime.date(2024, 11, 1),
+        calendar_year=2024,
+        period="FY",
+        revenue=Decimal(revenue),
+        gross_profit=Decimal("180683000000.00"),
+        operating_income=Decimal("123216000000.00"),
+        income_before_tax=Decimal("123485000000.00"),
+        net_income=Decimal("93736000000.00"),
+        operating_expenses=Decimal("57467000000.00"),
+        research_and_development_expenses=Decimal("31370000000.00"),
+    )
+
+
+class FormatMoneyTests(SimpleTestCase):
+    def test_scales(self):
+        cases = [
+            ("394328000000.00", "$394.3B"),
+            ("2500000000000", "$2.5T"),
+            ("12340000", "$12.3M"),
+            ("45600", "$45.6K"),
+            ("999.40", "$999"),
+            ("0", "$0"),
+        ]
+        for amount, expected in cases:
+            with self.subTest(amount=amount):
+                self.assertEqual(
+                    templating.format_money(Decimal(amount), "$"), expected
+                )
+
+    def test_negative_amounts(self):
+        self.assertEqual(templating.format_money(Decimal("-1500000"), "€"), "-€1.5M")
+
+    def test_rounding_up_to_the_next_scale(self):
+        cases = [
+            ("999960000000", "$1.0T"),
+            ("999960000", "$1.0B"),
+            ("999960", "$1.0M"),
+            ("999.6", "$1.0K"),
+        ]
+        for amount, expected in cases:
+            with self.subTest(amount=amount):
+                self.assertEqual(
+                    templating.format_money(Decimal(amount), "$"), expected
+                )
+
+
+@mock.patch.object(
+    templating, "get_shared_symbols", return_value=frozenset({"$", "¥", "kr"})
+)
+class CurrencySymbolTests(SimpleTestCase):
+    def test_unique_symbol(self, _):
+        statement = make_statement(Currency(code="EUR", symbol="€"))
+
+        self.assertEqual(templating.get_currency_symbol(statement), "€")
+
+    def test_shared_symbol_uses_the_code(self, _):
+        for code in ("USD", "MXN", "CLP"):
+            with self.subTest(code=code):
+                statement = make_statement(Currency(code=code, symbol="$"))
+
+                self.assertEqual(templating.get_currency_symbol(statement), f"{code} ")
+
+    def test_missing_symbol_uses_the_code(self, _):
+        statement = make_statement(Currency(code="XYZ", symbol=""))
+
+        self.assertEqual(templating.get_currency_symbol(statement), "XYZ ")
+
+    def test_pesos_and_dollars_render_and_hash_apart(self, _):
+        dollars = make_statement(Currency(code="USD", symbol="$"))
+        pesos = make_statement(Currency(code="MXN", symbol="$"))
+
+        self.assertIn("revenue USD 394.3B", templating.render_statement(dollars))
+        self.assertIn("revenue MXN 394.3B", templating.render_statement(pesos))
+        self.assertNotEqual(
+            templating.hash_statement(dollars), templating.hash_statement(pesos)
+        )
+
+
+class SharedSymbolsTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(templating, "_shared_symbols", (0.0, frozenset()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Currency.objects.create(code="XAA", name="A", symbol="¤")
+
+    def test_the_symbols_are_read_again_once_expired(self):
+        self.assertNotIn("¤", templating.get_shared_symbols())
+
+        Currency.objects.create(code="XBB", name="B", symbol="¤")
+        self.assertNotIn("¤", templating.get_shared_symbols())
+
+        expired = time.monotonic() + templating.SHARED_SYMBOLS_CACHE_SECONDS + 1
+        with mock.patch("time.monotonic", return_value=expired):
+            self.assertIn("¤", templating.get_shared_symbols())
+
+
+class RenderStatementTests(SimpleTestCase):
+    @mock.patch.object(templating, "get_shared_symbols", return_value=frozenset())
+    def test_render(self, _):
+        statement = make_statement(Currency(code="EUR", symbol="€"))
+
+        self.assertEqual(
+            templating.render_statement(statement),
+            "Apple Inc. (AAPL), FY 2024, reported 2024-11-01: revenue €394.3B, "
+            "gross profit €180.7B, operating income €123.2B, income before tax "
+            "€123.5B, net income €93.7B, operating expenses €57.5B, "
+            "R&D expenses €31.4B.",
+        )
+
+    @mock.patch.object(templating, "get_shared_symbols", return_value=frozenset())
+    def test_hash_follows_the_values(self, _):
+        currency = Currency(code="EUR", symbol="€")
+
+        self.assertEqual(
+            templating.hash_statement(make_statement(currency)),
+            templating.hash_statement(make_statement(currency)),
+        )
+        self.assertNotEqual(
+            templating.hash_statement(make_statement(currency)),
+            templating.hash_statement(make_statement(currency, revenue="1.00")),
+        )
+
+
+@override_settings(
+    LOCAL_EMBEDDING_PROCESSES=4,
+    LOCAL_EMBEDDING_MIN_BATCH_CHARACTERS=100,
+    LOCAL_EMBEDDING_BATCH_CHARACTERS=1000,
+)
+class LocalBatchesTests(SimpleTestCase):
+    def get_batches(self, texts: list[str]) -> list[list[int]]:
+        return make_batches(texts, get_batch_characters(texts))
+
+    def test_a_call_is_spread_over_the_processes(self):
+        self.assertEqual(len(self.get_batches(["a" * 50] * 20)), 4)
+
+    def test_batches_stay_under_the_maximum(self):
+        self.assertEqual(len(self.get_batches(["a" * 50] * 200)), 10)
+
+    def test_a_small_call_is_a_single_batch(self):
+        self.assertEqual(len(self.get_batches(["a" * 30] * 3)), 1)
+
+
+def analysis_row(statement_id: int) -> AnalysisRow:
+    return AnalysisRow(
+        statement_id=statement_id,
+        text=f"statement {statement_id}",
+        template_version=templating.TEMPLATE_VERSION,
+        source_hash="",
+        embedding=[0.0],
+    )
+
+
+@override_settings(EMBEDDING_WRITE_BATCH_SIZE=100, EMBEDDING_WRITE_MAX_DELAY=60)
+class EmbeddingWriterTests(SimpleTestCase):
+    def setUp(self):
+        self.writer = EmbeddingWriter(mock.Mock(), mock.Mock())
+        for statement_id in (1, 2, 3):
+            self.writer.add(analysis_row(statement_id))
+
+    def write_analyses(self, failing: set[int]):
+        def write_analyses(version, rows):
+            if len(rows) > 1 or rows[0].statement_id in failing:
+                raise DatabaseError("failed")
+
+        return mock.patch("embeds.writer.write_analyses", side_effect=write_analyses)
+
+    def test_failing_rows_are_quarantined(self):
+        with self.write_analyses({2}), mock.patch(
+            "embeds.writer.quarantine"
+        ) as quarantine:
+            self.writer.flush()
+
+        self.assertEqual(self.writer.written, 2)
+        self.assertEqual(self.writer.quarantined, 1)
+        self.assertEqual(quarantine.call_args.args[1].statement_id, 2)
+        self.assertEqual(self.writer.pending, {})
+
+    def test_rows_that_cant_be_quarantined_stay_pending(self):
+        with self.write_analyses({2}), mock.patch(
+            "embeds.writer.quarantine", side_effect=DatabaseError("down")
+        ):
+            with self.assertRaises(EmbeddingWriteError):
+                self.writer.flush()
+
+        self.assertEqual(self.writer.written, 2)
+        self.assertEqual(list(self.writer.pending), [2])
+
+    def test_the_task_error_isnt_hidden(self):
+        with self.write_analyses({1, 2, 3}), mock.patch(
+            "embeds.writer.quarantine", side_effect=DatabaseError("down")
+        ):
+            with self.assertRaisesMessage(ValueError, "task failed"):
+                with self.writer:
+                    raise ValueError("task failed")
+
+        self.assertEqual(len(self.writer.pending), 3)
+
+
+class WriteAnalysesTests(TestCase):
+    def setUp(self):
+        currency, _ = Currency.objects.get_or_create(
+            code="EUR", defaults={"name": "Euro", "symbol": "€"}
+        )
+        self.statement = make_statement(currency)
+        self.statement.company.save()
+        self.statement.company_id = self.statement.company.pk
+        self.statement.save()
+        self.version = EmbeddingModelVersion.objects.create(
+            provider="Stub", model_name="test-embed", dimension=1
+        )
+
+    def test_missing_statements_fail_the_write(self):
+        missing_id = self.statement.pk + 1
+
+        with self.assertRaisesMessage(IntegrityError, str([missing_id])):
+            write_analyses(
+                self.version,
+                [analysis_row(self.statement.pk), analysis_row(missing_id)],
+            )
+
+        self.assertFalse(FinancialStatementAnalysis.objects.exists())
+
+    def test_the_analysis_is_rewritten_in_place(self):
+        write_analyses(self.version, [analysis_row(self.statement.pk)])
+        analysis = FinancialStatementAnalysis.objects.get()
+        other_version = EmbeddingModelVersion.objects.create(
+            provider="Stub", model_name="other-embed", dimension=1
+        )
+        FinancialStatementEmbedding.objects.create(
+            analysis=analysis, version=other_version, embedding=[0.5]
+        )
+
+        write_analyses(
+            self.version,
+            [
+                dataclasses.replace(
+                    analysis_row(self.statement.pk), text="rewritten", embedding=[1.0]
+                )
+            ],
+        )
+
+        rewritten = FinancialStatementAnalysis.objects.get()
+        self.assertEqual(rewritten.pk, analysis.pk)
+        self.assertEqual(rewritten.analysis_text, "rewritten")
+        # the other version embedded the previous text, it embeds this one again
+        self.assertEqual(
+            [
+                (embedding.version_id, list(embedding.embedding))
+                for embedding in rewritten.embeddings.all()
+            ],
+            [(self.version.pk, [1.0])],
+        )
+
+    def test_the_writer_quarantines_the_analyses_of_missing_statements(self):
+        missing_id = self.statement.pk + 1
+        writer = EmbeddingWriter(self.version, mock.Mock())
+        writer.add(analysis_row(self.statement.pk))
+        writer.add(analysis_row(missing_id))
+
+        writer.flush()
+
+        self.assertEqual((writer.written, writer.quarantined), (1, 1))
+        self.assertEqual(
+            list(
+                FinancialStatementAnalysis.objects.values_list(
+                    "financial_statement_id", flat=True
+                )
+            ),
+            [self.statement.pk],
+        )
+        self.assertEqual(
+            list(
+                EmbeddingQuarantine.objects.values_list(
+                    "financial_statement_id", flat=True
+                )
+            ),
+            [missing_id],
+        )
+
+
+def get_index_names() -> set[str]:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexname FROM pg_indexes "
+            "WHERE tablename = 'embeds_financialstatementembedding'"
+        )
+        return {name for (name,) in cursor.fetchall()}
+
+
+# the indexes are built concurrently, outside of a test transaction
+class VectorIndexTests(TransactionTestCase):
+    def setUp(self):
+        currency, _ = Currency.objects.get_or_create(
+            code="EUR", defaults={"name": "Euro", "symbol": "€"}
+        )
+        self.analyses = []
+        for index in range(3):
+            statement = make_statement(currency)
+            statement.company.symbol = f"C{index}"
+            statement.company.save()
+            statement.company_id = statement.company.pk
+            statement.save()
+            self.analyses.append(
+                FinancialStatementAnalysis.objects.create(
+                    financial_statement=statement, analysis_text=f"analysis {index}"
+                )
+            )
+
+    def create_version(self, model_name: str) -> EmbeddingModelVersion:
+        version = EmbeddingModelVersion.objects.create(
+            provider="Stub", model_name=model_name, dimension=3
+        )
+        FinancialStatementEmbedding.objects.bulk_create(
+            FinancialStatementEmbedding(
+                analysis=analysis, version=version, embedding=[1, index, 0]
+            )
+            for index, analysis in enumerate(self.analyses)
+        )
+        return version
+
+    def test_the_active_version_is_indexed(self):
+        version = self.create_version("first")
+
+        activate_version(version)
+
+        self.assertIn(get_vector_index_name(version), get_index_names())
+
+    def test_the_retrieval_uses_the_index(self):
+        version = self.create_version("first")
+        activate_version(version)
+
+        with connection.cursor() as cursor:
+            # the planner would sort so few rows
+            cursor.execute("SET enable_seqscan = off")
+            cursor.execute("SET enable_sort = off")
+            try:
+                with CaptureQueriesContext(connection) as queries:
+                    candidates = fetch_candidates(version, [1, 0, 0], limit=2)
+                cursor.execute(f"EXPLAIN {queries[-1]['sql']}")
+                plan = "\n".join(row for (row,) in cursor.fetchall())
+            finally:
+                cursor.execute("RESET enable_seqscan")
+                cursor.execute("RESET enable_sort")
+
+        self.assertEqual(
+            [candidate["text"] for candidate in candidates],
+            ["analysis 0", "analysis 1"],
+        )
+        self.assertIn(get_vector_index_name(version), plan)
+
+    def test_the_retired_version_index_is_dropped(self):
+        first = self.create_version("first")
+        activate_version(first)
+        second = self.create_version("second")
+
+        activate_version(second)
+
+        self.assertEqual(
+            get_index_names()
+            & {get_vector_index_name(first), get_vector_index_name(second)},
+            {get_vector_index_name(second)},
+        )
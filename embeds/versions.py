@@ -0,0 +1,150 @@
+"""
+The lifecycle of the embedding model versions.
+
+A version is created building, filled in the background by the reembed_analyses task,
+and activated once it covers every analysis. The activation retires the previous
+version in the same transaction, so the retrieval switches from one to the other
+without ever seeing a partially embedded version.
+
+The embedding column isn't sized, the versions differ in dimension, so every version
+gets its own HNSW index over its rows, cast to its dimension. It is built before the
+version is activated, and dropped once the version is retired.
+"""
+
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from embeds.models import (
+    EmbeddingModelVersion,
+    FinancialStatementAnalysis,
+    FinancialStatementEmbedding,
+    LlmModel,
+)
+
+logger = logging.getLogger(__name__)
+
+Status = EmbeddingModelVersion.Status
+
+# pgvector doesn't index the vectors of more dimensions
+HNSW_MAX_DIMENSION = 2000
+
+
+def get_active_version() -> EmbeddingModelVersion | None:
+    return EmbeddingModelVersion.objects.filter(status=Status.ACTIVE).first()
+
+
+def get_or_create_version(provider: str) -> EmbeddingModelVersion:
+    model = getattr(LlmModel, provider)
+    version, _ = EmbeddingModelVersion.objects.get_or_create(
+        provider=provider,
+        model_name=model.model_name,
+        defaults={"dimension": model.embedding_length},
+    )
+    return version
+
+
+def get_or_create_active_version() -> EmbeddingModelVersion:
+    """The active version, the configured model's one on a fresh install."""
+    version = get_active_version()
+    if version is not None:
+        return version
+
+    version = get_or_create_version(settings.LLM_MODEL)
+    try:
+        # nothing is embedded yet, the version is complete by definition
+        with transaction.atomic():
+            EmbeddingModelVersion.objects.filter(pk=version.pk).update(
+                status=Status.ACTIVE, activated_at=timezone.now()
+            )
+    except IntegrityError:
+        # another worker activated a version meanwhile
+        pass
+    else:
+        create_vector_index(version)
+    return get_active_version()
+
+
+def get_vector_index_name(version: EmbeddingModelVersion) -> str:
+    return f"embeds_embedding_v{version.pk}_idx"
+
+
+def create_vector_index(version: EmbeddingModelVersion):
+    """Builds the index of the version, concurrently, so it can't run in a transaction."""
+    if version.dimension > HNSW_MAX_DIMENSION:
+        logger.warning(f"{version} has too many dimensions to be indexed.")
+        return
+
+    name = get_vector_index_name(version)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+            [name],
+        )
+        row = cursor.fetchone()
+        if row is not None and row[0]:
+            return
+        if row is not None:
+            # left invalid by a build that failed
+            cursor.execute(f"DROP INDEX CONCURRENTLY {connection.ops.quote_name(name)}")
+
+        cursor.execute(
+            f"CREATE INDEX CONCURRENTLY {connection.ops.quote_name(name)} "
+            f"ON {connection.ops.quote_name(FinancialStatementEmbedding._meta.db_table)} "
+            f"USING hnsw ((embedding::vector({int(version.dimension)})) "
+            f"vector_cosine_ops) WHERE version_id = {int(version.pk)}"
+        )
+
+
+def drop_vector_index(version: EmbeddingModelVersion):
+    name = connection.ops.quote_name(get_vector_index_name(version))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def get_missing_analyses(version: EmbeddingModelVersion):
+    return FinancialStatementAnalysis.objects.exclude(
+        embeddings__version=version
+    ).exclude(analysis_text__isnull=True)
+
+
+def get_coverage(version: EmbeddingModelVersion) -> tuple[int, int]:
+    """The analyses embedded with the version, and all of the analyses."""
+    total = FinancialStatementAnalysis.objects.exclude(
+        analysis_text__isnull=True
+    ).count()
+    embedded = FinancialStatementEmbedding.objects.filter(version=version).count()
+    return embedded, total
+
+
+class IncompleteVersionError(Exception):
+    pass
+
+
+def activate_version(version: EmbeddingModelVersion):
+    # the retrieval switches to the version with its index ready
+    create_vector_index(version)
+
+    with transaction.atomic():
+        # serializes the activations, and holds the active version until the switch
+        list(EmbeddingModelVersion.objects.select_for_update().order_by("id"))
+
+        if get_missing_analyses(version).exists():
+            raise IncompleteVersionError(f"{version} doesn't cover every analysis yet.")
+
+        retired = list(
+            EmbeddingModelVersion.objects.filter(status=Status.ACTIVE).exclude(
+                pk=version.pk
+            )
+        )
+        EmbeddingModelVersion.objects.filter(
+            pk__in=[retired_version.pk for retired_version in retired]
+        ).update(status=Status.RETIRED)
+        EmbeddingModelVersion.objects.filter(pk=version.pk).update(
+            status=Status.ACTIVE, activated_at=timezone.now()
+        )
+
+    for retired_version in retired:
+        drop_vector_index(retired_version)
@@ -0,0 +1,237 @@
+"""
+Persists the analyses and their embeddings as build_financial_embeddings embeds them.
+
+The rows are upserted in batches of EMBEDDING_WRITE_BATCH_SIZE, or every
+EMBEDDING_WRITE_MAX_DELAY seconds, whichever comes first, so that a task only holds a
+batch of vectors. A batch failing is written again row by row, and the rows failing
+on their own are kept in the quarantine with their vector, to be written again with
+retry_quarantined_embeddings instead of being embedded, and paid for, a second time.
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, transaction
+
+from core.models import FinancialStatement
+from embeds.models import (
+    EmbeddingModelVersion,
+    EmbeddingQuarantine,
+    FinancialStatementAnalysis,
+    FinancialStatementEmbedding,
+)
+from fin_vantage.instrumentation import DB_WRITE_SECONDS, EMBEDDINGS_QUARANTINED
+
+
+@dataclass(frozen=True)
+class AnalysisRow:
+    statement_id: int
+    text: str
+    template_version: int
+    source_hash: str
+    embedding: list[float]
+
+
+def write_embeddings(version: EmbeddingModelVersion, embeddings: list[tuple]):
+    """Upserts the (analysis id, vector) pairs of the version."""
+    FinancialStatementEmbedding.objects.bulk_create(
+        [
+            FinancialStatementEmbedding(
+                analysis_id=analysis_id, version=version, embedding=vector
+            )
+            for analysis_id, vector in embeddings
+        ],
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["version", "analysis"],
+        update_fields=["embedding"],
+    )
+
+
+def lock_statements(statement_ids: list[int]):
+    """
+    Holds the statements until the transaction ends, and fails for the missing ones,
+    as the foreign key did before the statements were partitioned.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT id FROM {FinancialStatement._meta.db_table} "
+            "WHERE id = ANY(%s) FOR KEY SHARE",
+            [statement_ids],
+        )
+        missing = set(statement_ids) - {statement_id for (statement_id,) in cursor}
+    if missing:
+        raise IntegrityError(f"Statements {sorted(missing)} don't exist.")
+
+
+def write_analyses(version: EmbeddingModelVersion, rows: list[AnalysisRow]):
+    # the instances are built on every attempt, a failed one may have set their ids
+    analyses = [
+        FinancialStatementAnalysis(
+            financial_statement_id=row.statement_id,
+            analysis_text=row.text,
+            template_version=row.template_version,
+            source_hash=row.source_hash,
+        )
+        for row in rows
+    ]
+    with transaction.atomic():
+        lock_statements([row.statement_id for row in rows])
+        # a redelivered task, or a yearly refresh, rewrites the analyses in place
+        FinancialStatementAnalysis.objects.bulk_create(
+            analyses,
+            update_conflicts=True,
+            unique_fields=["financial_statement"],
+            update_fields=[
+                "analysis_text",
+                "last_modified",
+                "template_version",
+                "source_hash",
+            ],
+        )
+        # the other versions embedded the previous texts, they re-embed these
+        FinancialStatementEmbedding.objects.filter(analysis__in=analyses).exclude(
+            version=version
+        ).delete()
+        write_embeddings(
+            version,
+            [(analysis.pk, row.embedding) for analysis, row in zip(analyses, rows)],
+        )
+
+
+def quarantine(version: EmbeddingModelVersion, row: AnalysisRow, error: Exception):
+    EmbeddingQuarantine.objects.create(
+        version=version,
+        financial_statement_id=row.statement_id,
+        analysis_text=row.text,
+        template_version=row.template_version,
+        source_hash=row.source_hash,
+        embedding=row.embedding,
+        error=str(error),
+    )
+    EMBEDDINGS_QUARANTINED.inc(model=version.model_name)
+
+
+class EmbeddingWriteError(Exception):
+    """Analyses could be neither written nor quarantined, they are still pending."""
+
+
+class EmbeddingWriter:
+    def __init__(self, version: EmbeddingModelVersion, logger: logging.Logger):
+        self.version = version
+        self.logger = logger
+        # by statement, a statement queued twice is written once, with its last text
+        self.pending = {}
+        self.last_flush = time.monotonic()
+        self.written = 0
+        self.quarantined = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # the embeddings were paid for, they are written even if the task fails
+        if exc_type is None:
+            self.flush()
+            return
+        try:
+            self.flush()
+        except Exception:
+            # the error failing the task is the one raised
+            self.logger.exception(
+                f"Could not write {len(self.pending)} financial analyses "
+                f"after the task failed."
+            )
+
+    def add(self, row: AnalysisRow):
+        self.pending[row.statement_id] = row
+        if (
+            len(self.pending) >= settings.EMBEDDING_WRITE_BATCH_SIZE
+            or time.monotonic() - self.last_flush >= settings.EMBEDDING_WRITE_MAX_DELAY
+        ):
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending rows. They stay pending until written or quarantined, and
+        EmbeddingWriteError is raised if some could be neither.
+        """
+        rows = list(self.pending.values())
+        self.last_flush = time.monotonic()
+        if not rows:
+            return
+
+        try:
+            with DB_WRITE_SECONDS.time(
+                task="build_financial_embeddings", model="FinancialStatementAnalysis"
+            ):
+                write_analyses(self.version, rows)
+            self.written += len(rows)
+            self.pending = {}
+            return
+        except DatabaseError as e:
+            self.logger.warning(
+                f"Writing {len(rows)} financial analyses failed, "
+                f"writing them one by one: {e}"
+            )
+
+        for row in rows:
+            try:
+                write_analyses(self.version, [row])
+                self.written += 1
+            except DatabaseError as e:
+                try:
+                    quarantine(self.version, row, e)
+                except DatabaseError as quarantine_error:
+                    self.logger.error(
+                        f"Could not quarantine the analysis of statement "
+                        f"{row.statement_id}, keeping it pending: {quarantine_error}"
+                    )
+                    continue
+                self.logger.error(
+                    f"Quarantined the analysis of statement {row.statement_id}: {e}"
+                )
+                self.quarantined += 1
+            del self.pending[row.statement_id]
+
+        if self.pending:
+            raise EmbeddingWriteError(
+                f"{len(self.pending)} financial analyses could be neither written "
+                "nor quarantined."
+            )
+
+
+def retry_quarantined(logger: logging.Logger) -> tuple[int, int]:
+    """Writes the quarantined rows again, and returns how many were and weren't."""
+    written, failed = 0, 0
+    for entry in EmbeddingQuarantine.objects.select_related("version").order_by("id"):
+        if not FinancialStatement.objects.filter(
+            pk=entry.financial_statement_id
+        ).exists():
+            logger.info(
+                f"Statement {entry.financial_statement_id} was deleted, "
+                "dropping its quarantined analysis."
+            )
+            entry.delete()
+            continue
+        row = AnalysisRow(
+            statement_id=entry.financial_statement_id,
+            text=entry.analysis_text,
+            template_version=entry.template_version,
+            source_hash=entry.source_hash,
+            embedding=entry.embedding,
+        )
+        try:
+            write_analyses(entry.version, [row])
+        except DatabaseError as e:
+            logger.warning(f"Statement {row.statement_id} still can't be written: {e}")
+            EmbeddingQuarantine.objects.filter(pk=entry.pk).update(
+                error=str(e), attempts=entry.attempts + 1
+            )
+            failed += 1
+            continue
+        entry.delete()
+        written += 1
+    return written, failed
@@ -0,0 +1,4 @@
+# the app is loaded with Django, so that shared_task uses it in the web process too
+from .celery import app as celery_app
+
+__all__ = ("celery_app",)
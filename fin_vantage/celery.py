@@ -1,11 +1,28 @@
 import os
 
 from celery import Celery
+from django.conf import settings
+
+from fin_vantage.db_pool import install_pool_hooks
+from fin_vantage.instrumentation import install_celery_hooks
+from fin_vantage.profiling import install_profiling_hooks
+from fin_vantage.serialization import register_serializer
+from fin_vantage.worker_profiles import get_worker_profile
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fin_vantage.settings")
 
+register_serializer()
+
 app = Celery("fin_vantage")
 
 app.config_from_object("django.conf:settings", namespace="CELERY")
 
-app.autodiscover_tasks()
\ No newline at end of file
+# before the tasks are bound, they read acks_late and the time limits from the config
+if settings.WORKER_PROFILE:
+    app.conf.update(get_worker_profile(settings.WORKER_PROFILE).get_config())
+
+app.autodiscover_tasks()
+
+install_celery_hooks()
+install_pool_hooks()
+install_profiling_hooks()
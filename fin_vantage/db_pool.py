@@ -0,0 +1,50 @@
+"""
+Metrics and process hooks for the pooled database connections.
+"""
+
+from celery import signals
+from django.conf import settings
+from django.db import connections
+
+from fin_vantage.instrumentation import (
+    DB_POOL_CONNECT_SECONDS,
+    DB_POOL_CONNECTIONS,
+    DB_POOL_CONNECTIONS_LOST,
+    DB_POOL_REQUESTS,
+    DB_POOL_TIMEOUTS,
+    DB_POOL_WAIT_SECONDS,
+    register_collector,
+)
+
+
+def _get_open_pools():
+    for connection in connections.all(initialized_only=True):
+        # reading connection.pool would create the pool, only the existing ones count
+        pools = getattr(type(connection), "_connection_pools", {})
+        if connection.alias in pools:
+            yield connection.alias, pools[connection.alias]
+
+
+def collect_pool_stats():
+    for alias, pool in _get_open_pools():
+        # the counters are reset by every pop, they are added up across the fleet
+        stats = pool.pop_stats()
+        labels = {"role": settings.PROCESS_ROLE, "alias": alias}
+        DB_POOL_REQUESTS.inc(stats.get("requests_num", 0), **labels)
+        DB_POOL_WAIT_SECONDS.inc(stats.get("requests_wait_ms", 0) / 1000, **labels)
+        DB_POOL_TIMEOUTS.inc(stats.get("requests_errors", 0), **labels)
+        DB_POOL_CONNECTIONS.inc(stats.get("connections_num", 0), **labels)
+        DB_POOL_CONNECT_SECONDS.inc(stats.get("connections_ms", 0) / 1000, **labels)
+        DB_POOL_CONNECTIONS_LOST.inc(stats.get("connections_lost", 0), **labels)
+
+
+def _on_worker_process_init(**kwargs):
+    # a prefork child inherits the pools of its parent, along with their sockets and
+    # threads, they are dropped without closing the parent's connections
+    for connection in connections.all(initialized_only=True):
+        getattr(type(connection), "_connection_pools", {}).pop(connection.alias, None)
+
+
+def install_pool_hooks():
+    register_collector(collect_pool_stats)
+    signals.worker_process_init.connect(_on_worker_process_init, weak=False)
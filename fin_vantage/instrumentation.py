@@ -0,0 +1,386 @@
+"""
+Pipeline metrics in the Prometheus text format.
+
+Web and worker processes accumulate observations in memory and flush them to
+Redis (after every task for the workers, on scrape for the web process), so a
+single scrape of the metrics view covers the whole fleet.
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import orjson
+import redis
+from celery import signals
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "fin_vantage:metrics:"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TASK_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+
+_registry = {}
+_collectors = []
+_lock = threading.Lock()
+_pending = defaultdict(float)
+_client = None
+
+
+def _get_client() -> redis.Redis:
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.METRICS_REDIS_URL)
+    return _client
+
+
+def _labels_key(labelnames: tuple, labels: dict) -> str:
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {tuple(labels)}")
+    return orjson.dumps([str(labels[name]) for name in labelnames]).decode()
+
+
+def _record(name: str, field: str, amount: float):
+    with _lock:
+        _pending[(name, field)] += amount
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry[name] = self
+
+    def samples(self, stored: dict):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        _record(self.name, _labels_key(self.labelnames, labels), amount)
+
+    def samples(self, stored: dict):
+        for labels_key, value in stored.items():
+            yield self.name, orjson.loads(labels_key), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        labels_key = _labels_key(self.labelnames, labels)
+        for bound in self.buckets:
+            if value <= bound:
+                _record(self.name, f"{labels_key}|{bound}", 1)
+                break
+        else:
+            _record(self.name, f"{labels_key}|+Inf", 1)
+        _record(self.name, f"{labels_key}|sum", value)
+        _record(self.name, f"{labels_key}|count", 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def samples(self, stored: dict):
+        series = defaultdict(dict)
+        for field, value in stored.items():
+            labels_key, suffix = field.rsplit("|", 1)
+            series[labels_key][suffix] = value
+
+        for labels_key, values in series.items():
+            label_values = orjson.loads(labels_key)
+            cumulative = 0
+            for bound in (*self.buckets, "+Inf"):
+                cumulative += values.get(str(bound), 0)
+                yield f"{self.name}_bucket", [*label_values, str(bound)], cumulative
+            yield f"{self.name}_sum", label_values, values.get("sum", 0)
+            yield f"{self.name}_count", label_values, values.get("count", 0)
+
+
+def register_collector(collector):
+    """Registers a function recording observations, called before every flush."""
+    _collectors.append(collector)
+
+
+def flush():
+    """Pushes the observations accumulated by this process to Redis."""
+
+    for collector in _collectors:
+        try:
+            collector()
+        except Exception as e:
+            logger.warning(f"Metrics collector {collector.__name__} failed: {e}")
+
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+    if not pending:
+        return
+
+    try:
+        pipeline = _get_client().pipeline(transaction=False)
+        for (name, field), amount in pending.items():
+            pipeline.hincrbyfloat(f"{KEY_PREFIX}{name}", field, amount)
+        pipeline.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not flush metrics: {e}")
+        with _lock:
+            for key, amount in pending.items():
+                _pending[key] += amount
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render() -> str | None:
+    """
+    Renders every registered metric, as aggregated in Redis, or returns None when Redis
+    can't be read: the values of this process alone would pass for the fleet's.
+    """
+
+    flush()
+
+    try:
+        pipeline = _get_client().pipeline(transaction=False)
+        for name in _registry:
+            pipeline.hgetall(f"{KEY_PREFIX}{name}")
+        stored_metrics = pipeline.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not read the metrics: {e}")
+        return None
+
+    lines = []
+    for metric, stored in zip(_registry.values(), stored_metrics):
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+
+        stored = {field.decode(): float(value) for field, value in stored.items()}
+        labelnames = metric.labelnames
+        for sample_name, label_values, value in metric.samples(stored):
+            names = (
+                labelnames
+                if len(label_values) == len(labelnames)
+                else (*labelnames, "le")
+            )
+            labels = ",".join(
+                f'{name}="{_escape(label_value)}"'
+                for name, label_value in zip(names, label_values)
+            )
+            lines.append(
+                f"{sample_name}{{{labels}}} {_format_value(value)}"
+                if labels
+                else f"{sample_name} {_format_value(value)}"
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+FINANCIAL_API_REQUEST_SECONDS = Histogram(
+    "fin_vantage_financial_api_request_seconds",
+    "Latency of the financial data API requests.",
+    ["endpoint", "status"],
+)
+FINANCIAL_API_RETRIES = Counter(
+    "fin_vantage_financial_api_retries_total",
+    "Retried financial data API requests.",
+    ["endpoint"],
+)
+FINANCIAL_API_RATE_LIMITED = Counter(
+    "fin_vantage_financial_api_rate_limited_total",
+    "Financial data API responses with the 429 status.",
+    ["endpoint"],
+)
+FINANCIAL_API_DEDUPLICATED = Counter(
+    "fin_vantage_financial_api_deduplicated_total",
+    "Financial data API requests answered by an identical request of another worker.",
+    ["endpoint"],
+)
+FINANCIAL_API_SHED = Counter(
+    "fin_vantage_financial_api_shed_total",
+    "Financial data API requests not made, as the circuit was open or no slot freed up.",
+    ["endpoint", "reason"],
+)
+FINANCIAL_API_BREAKER_TRANSITIONS = Counter(
+    "fin_vantage_financial_api_breaker_transitions_total",
+    "Transitions of the financial data API circuit breaker, by the state entered.",
+    ["state"],
+)
+FINANCIAL_API_CONCURRENCY_LIMIT = Histogram(
+    "fin_vantage_financial_api_concurrency_limit",
+    "The fleet wide financial data API concurrency limit, after every adjustment.",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+FINANCIAL_API_CONCURRENCY_WAIT_SECONDS = Histogram(
+    "fin_vantage_financial_api_concurrency_wait_seconds",
+    "Time waited for a financial data API request slot.",
+    ["endpoint"],
+)
+RECORDS_PARSED = Counter(
+    "fin_vantage_records_parsed_total",
+    "Records parsed from the provider responses.",
+    ["task"],
+)
+PARSE_SECONDS = Counter(
+    "fin_vantage_parse_seconds_total",
+    "Time spent parsing records, records parsed/sec is records_parsed_total over this.",
+    ["task"],
+)
+DB_WRITE_SECONDS = Histogram(
+    "fin_vantage_db_write_seconds",
+    "Duration of the bulk database writes.",
+    ["task", "model"],
+)
+EMBEDDING_BATCH_SECONDS = Histogram(
+    "fin_vantage_embedding_batch_seconds",
+    "Latency of a single embedding provider call.",
+    ["model"],
+)
+TASK_QUEUE_WAIT_SECONDS = Histogram(
+    "fin_vantage_celery_task_queue_wait_seconds",
+    "Time between publishing a task and a worker starting it.",
+    ["task", "queue"],
+    buckets=TASK_BUCKETS,
+)
+TASK_DURATION_SECONDS = Histogram(
+    "fin_vantage_celery_task_duration_seconds",
+    "Duration of the Celery tasks.",
+    ["task", "state"],
+    buckets=TASK_BUCKETS,
+)
+TASK_RETRIES = Counter(
+    "fin_vantage_celery_task_retries_total",
+    "Celery task retries.",
+    ["task"],
+)
+
+
+DB_POOL_REQUESTS = Counter(
+    "fin_vantage_db_pool_requests_total",
+    "Connections requested from the database pools.",
+    ["role", "alias"],
+)
+DB_POOL_WAIT_SECONDS = Counter(
+    "fin_vantage_db_pool_wait_seconds_total",
+    "Time spent waiting for a pooled connection, the mean wait is this over the requests.",
+    ["role", "alias"],
+)
+DB_POOL_TIMEOUTS = Counter(
+    "fin_vantage_db_pool_timeouts_total",
+    "Connection requests that timed out or were refused by a full pool.",
+    ["role", "alias"],
+)
+DB_POOL_CONNECTIONS = Counter(
+    "fin_vantage_db_pool_connections_total",
+    "Connections the database pools opened.",
+    ["role", "alias"],
+)
+DB_POOL_CONNECT_SECONDS = Counter(
+    "fin_vantage_db_pool_connect_seconds_total",
+    "Time spent opening the pooled connections.",
+    ["role", "alias"],
+)
+DB_POOL_CONNECTIONS_LOST = Counter(
+    "fin_vantage_db_pool_connections_lost_total",
+    "Pooled connections found broken by the health checks.",
+    ["role", "alias"],
+)
+DB_REPLICA_READS = Counter(
+    "fin_vantage_db_replica_reads_total",
+    "Read-only blocks, by the database they were routed to.",
+    ["alias"],
+)
+DB_REPLICA_FALLBACKS = Counter(
+    "fin_vantage_db_replica_fallbacks_total",
+    "Replicas skipped by the read-only blocks, lagging or unreachable.",
+    ["alias", "reason"],
+)
+EMBEDDINGS_QUARANTINED = Counter(
+    "fin_vantage_embeddings_quarantined_total",
+    "Embedded analyses that couldn't be written, kept in the quarantine.",
+    ["model"],
+)
+QUERY_CACHE_REQUESTS = Counter(
+    "fin_vantage_query_cache_requests_total",
+    "Lookups of the question path caches, by where the value came from.",
+    ["cache", "result"],
+)
+RETRIEVAL_CONTEXT_TOKENS = Histogram(
+    "fin_vantage_retrieval_context_tokens",
+    "Tokens of retrieved context sent with a question.",
+    buckets=(100, 250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000),
+)
+RETRIEVAL_CONTEXT_DOCUMENTS = Histogram(
+    "fin_vantage_retrieval_context_documents",
+    "Analyses packed into the context of a question.",
+    buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 24),
+)
+
+
+_task_start_times = {}
+
+
+def _on_before_task_publish(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault("published_at", time.time())
+
+
+def _on_task_prerun(task_id=None, task=None, **kwargs):
+    _task_start_times[task_id] = time.perf_counter()
+
+    published_at = getattr(task.request, "published_at", None)
+    if published_at is not None:
+        queue = (task.request.delivery_info or {}).get("routing_key") or "default"
+        TASK_QUEUE_WAIT_SECONDS.observe(
+            max(time.time() - published_at, 0), task=task.name, queue=queue
+        )
+
+
+def _on_task_postrun(task_id=None, task=None, state=None, **kwargs):
+    start_time = _task_start_times.pop(task_id, None)
+    if start_time is not None:
+        TASK_DURATION_SECONDS.observe(
+            time.perf_counter() - start_time, task=task.name, state=state or "UNKNOWN"
+        )
+    flush()
+
+
+def _on_task_retry(request=None, sender=None, **kwargs):
+    TASK_RETRIES.inc(task=sender.name)
+
+
+def _on_worker_process_shutdown(**kwargs):
+    flush()
+
+
+def install_celery_hooks():
+    signals.before_task_publish.connect(_on_before_task_publish, weak=False)
+    signals.task_prerun.connect(_on_task_prerun, weak=False)
+    signals.task_postrun.connect(_on_task_postrun, weak=False)
+    signals.task_retry.connect(_on_task_retry, weak=False)
+    signals.worker_process_shutdown.connect(_on_worker_process_shutdown, weak=False)
@@ -0,0 +1,18 @@
+from django.utils.module_loading import import_string
+
+
+class LazyImport:
+    """
+    A class attribute holding the object at a dotted path, imported the first time
+    the attribute is read. The heavy providers (LangChain, the model SDKs) are then
+    only imported by the processes that use them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __get__(self, instance, owner=None):
+        return import_string(self.path)
+
+    def __repr__(self):
+        return f"LazyImport({self.path!r})"
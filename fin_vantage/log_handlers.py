@@ -0,0 +1,193 @@
+"""
+Non-blocking logging for the task loggers.
+
+AsyncHandler only puts the records on an in-process queue; a single listener thread
+per process formats them, as JSON lines for the files and as text for the console,
+and writes them. The logging call costs a queue put, the formatting and the file I/O
+happen off the task thread.
+
+Past `queue_size` queued records, the records below WARNING are dropped and counted,
+so that a stalled disk doesn't grow the queue without bounds.
+"""
+
+import atexit
+import datetime
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+import orjson
+
+# the attributes every LogRecord has, the others were passed with extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+    "targets",
+    "drained",
+}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in every 1 / `rate` DEBUG records, and every other record."""
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.every = max(round(1 / rate), 1) if rate > 0 else 0
+        self.counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        return self.every > 0 and next(self.counter) % self.every == 0
+
+
+class _Listener(logging.handlers.QueueListener):
+    """Hands every record to the targets of the handler that queued it."""
+
+    def handle(self, record: logging.LogRecord):
+        if record.drained is not None:
+            record.drained.set()
+            return
+        for target in record.targets:
+            if record.levelno >= target.level:
+                target.handle(record)
+
+
+_lock = threading.Lock()
+_queue = None
+_listener = None
+
+# seconds a closing handler waits for its queued records to be written
+DRAIN_TIMEOUT = 5
+
+
+def _get_queue() -> queue.SimpleQueue:
+    global _queue, _listener
+    with _lock:
+        if _listener is None:
+            # lighter than a Queue, its size is checked by the handlers instead
+            _queue = queue.SimpleQueue()
+            _listener = _Listener(_queue)
+            _listener.start()
+        return _queue
+
+
+def drain_queue():
+    """Waits for the records queued so far to be written, if the listener runs."""
+    with _lock:
+        records_queue = _queue if _listener is not None else None
+    if records_queue is None:
+        return
+    drained = threading.Event()
+    records_queue.put(logging.makeLogRecord({"targets": [], "drained": drained}))
+    drained.wait(DRAIN_TIMEOUT)
+
+
+def stop_listener():
+    """Writes the queued records, then stops the listener thread."""
+    global _queue, _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+        _queue, _listener = None, None
+
+
+def _reset_after_fork():
+    # the listener thread of the parent doesn't exist in a forked child
+    global _lock, _queue, _listener
+    _lock = threading.Lock()
+    _queue, _listener = None, None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(stop_listener)
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """
+    Queues the records for a JSON lines file rotated at midnight, and for the
+    console at `console_level` and above.
+    """
+
+    def __init__(
+        self,
+        filename: str | None = None,
+        console_level: str | None = "INFO",
+        console_format: str = "{asctime} {levelname} {module} {message}",
+        backup_count: int = 30,
+        queue_size: int = 10000,
+    ):
+        super().__init__(None)
+        self.targets = []
+        if filename:
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                filename, when="midnight", backupCount=backup_count, encoding="utf-8"
+            )
+            file_handler.setFormatter(JsonFormatter())
+            self.targets.append(file_handler)
+        if console_level:
+            console_handler = logging.StreamHandler(sys.stderr)
+            console_handler.setLevel(console_level)
+            console_handler.setFormatter(logging.Formatter(console_format, style="{"))
+            self.targets.append(console_handler)
+        self.dropped = 0
+        self.queue_size = queue_size
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the record stays in process, it is formatted by the listener thread
+        record.targets = self.targets
+        record.drained = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        records_queue = _get_queue()
+        if (
+            record.levelno < logging.WARNING
+            and records_queue.qsize() >= self.queue_size
+        ):
+            self.dropped += 1
+            return
+        records_queue.put(record)
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            warning = logging.makeLogRecord(
+                {
+                    "name": record.name,
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": f"Dropped {dropped} log records, the log queue was full.",
+                    "targets": self.targets,
+                    "drained": None,
+                }
+            )
+            records_queue.put(warning)
+
+    def close(self):
+        # the listener is shared by every handler, it keeps running for the others
+        drain_queue()
+        for target in self.targets:
+            target.close()
+        super().close()
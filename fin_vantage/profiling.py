@@ -0,0 +1,242 @@
+"""
+Opt-in profiling of the Celery tasks.
+
+A task is profiled when its name is in PROFILED_TASKS, or when the
+"profile-task-<name>" waffle switch is on. While it runs, a sampler thread records
+the stacks of the task thread, and of the threads it starts, every
+TASK_PROFILE_INTERVAL seconds, and the SQL queries of the task thread are counted and
+timed. Once it is done, TASK_PROFILE_DIR gets two files per run:
+
+- <task>-<time>-<id>.collapsed, the sampled stacks in the collapsed format read by
+  flamegraph.pl, speedscope and inferno.
+- <task>-<time>-<id>.json, a summary with the hottest functions and SQL queries.
+"""
+
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+
+import orjson
+import waffle
+from celery import signals
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+TOP_ENTRIES = 25
+SQL_TEXT_LENGTH = 500
+# the switches are read once per this many seconds, rather than once per task
+SWITCH_CACHE_SECONDS = 30
+
+_switches = {}
+
+
+def get_switch_name(task_name: str) -> str:
+    return f"profile-task-{task_name.rsplit('.', 1)[-1]}"
+
+
+def is_profiled(task_name: str) -> bool:
+    profiled = settings.PROFILED_TASKS
+    if "*" in profiled or task_name in profiled:
+        return True
+    if task_name.rsplit(".", 1)[-1] in profiled:
+        return True
+    switch_name = get_switch_name(task_name)
+    expires_at, is_active = _switches.get(switch_name, (0.0, False))
+    if time.monotonic() < expires_at:
+        return is_active
+    try:
+        is_active = waffle.switch_is_active(switch_name)
+    except Exception as e:
+        logger.warning(f"Could not read the profiling switch of {task_name}: {e}")
+        is_active = False
+    _switches[switch_name] = (time.monotonic() + SWITCH_CACHE_SECONDS, is_active)
+    return is_active
+
+
+def _start_thread(start):
+    """Wraps Thread.start to record the thread starting it, see get_task_threads."""
+
+    def start_thread(thread):
+        thread.started_by = threading.get_ident()
+        return start(thread)
+
+    return start_thread
+
+
+def get_task_threads(thread_id: int) -> set[int]:
+    """The thread and the running threads it started, directly or not."""
+    started_by = {
+        thread.ident: getattr(thread, "started_by", None)
+        for thread in threading.enumerate()
+    }
+    task_threads = {thread_id}
+    for ident in started_by:
+        parent, seen = started_by[ident], {ident}
+        while parent is not None and parent not in task_threads and parent not in seen:
+            seen.add(parent)
+            parent = started_by.get(parent)
+        if parent in task_threads:
+            task_threads.add(ident)
+    return task_threads
+
+
+def _describe_frame(frame) -> str:
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{frame.f_code.co_qualname}"
+
+
+class QueryRecorder:
+    """An execute wrapper counting and timing the queries, per statement."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = defaultdict(lambda: {"count": 0, "seconds": 0.0})
+
+    def __call__(self, execute, sql, params, many, context):
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start_time
+            key = (context["connection"].alias, sql[:SQL_TEXT_LENGTH])
+            with self.lock:
+                self.statements[key]["count"] += 1
+                self.statements[key]["seconds"] += duration
+
+    def summarize(self) -> dict:
+        statements = sorted(
+            self.statements.items(), key=lambda item: -item[1]["seconds"]
+        )
+        return {
+            "count": sum(stats["count"] for _, stats in statements),
+            "seconds": sum(stats["seconds"] for _, stats in statements),
+            "top": [
+                {"alias": alias, "sql": sql, **stats}
+                for (alias, sql), stats in statements[:TOP_ENTRIES]
+            ],
+        }
+
+
+class TaskProfiler:
+    def __init__(self, task_name: str, task_id: str):
+        self.task_name = task_name
+        self.task_id = task_id
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self.queries = QueryRecorder()
+        self.stopped = threading.Event()
+        self.exit_stack = ExitStack()
+
+    def start(self):
+        for connection in connections.all():
+            self.exit_stack.enter_context(connection.execute_wrapper(self.queries))
+
+        self.sampler = threading.Thread(
+            target=self.sample, name=f"profiler-{self.task_id}", daemon=True
+        )
+        self.started_at = time.perf_counter()
+        self.sampler.start()
+
+    def sample(self):
+        sampler_id = threading.get_ident()
+        while not self.stopped.wait(settings.TASK_PROFILE_INTERVAL):
+            # the other tasks and the other samplers run in threads of their own
+            task_threads = get_task_threads(self.thread_id)
+            task_threads.discard(sampler_id)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in task_threads:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_describe_frame(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.started_at
+        self.stopped.set()
+        self.sampler.join()
+        self.exit_stack.close()
+
+    def summarize(self) -> dict:
+        own, cumulative = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(";")
+            own[functions[-1]] += count
+            for function in set(functions):
+                cumulative[function] += count
+
+        # a sample takes longer than the interval, the samples share the duration
+        seconds_per_sample = self.duration / self.samples if self.samples else 0.0
+        return {
+            "task": self.task_name,
+            "task_id": self.task_id,
+            "seconds": self.duration,
+            "samples": self.samples,
+            "interval": settings.TASK_PROFILE_INTERVAL,
+            "own_seconds": [
+                [function, count * seconds_per_sample]
+                for function, count in own.most_common(TOP_ENTRIES)
+            ],
+            "cumulative_seconds": [
+                [function, count * seconds_per_sample]
+                for function, count in cumulative.most_common(TOP_ENTRIES)
+            ],
+            "sql": self.queries.summarize(),
+        }
+
+    def write(self) -> str:
+        os.makedirs(settings.TASK_PROFILE_DIR, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+        path = os.path.join(
+            settings.TASK_PROFILE_DIR,
+            f"{self.task_name.rsplit('.', 1)[-1]}-{timestamp}-{self.task_id}",
+        )
+        with open(f"{path}.collapsed", "w", encoding="utf-8") as file:
+            for stack, count in self.stacks.items():
+                file.write(f"{stack} {count}\n")
+        with open(f"{path}.json", "wb") as file:
+            file.write(orjson.dumps(self.summarize(), option=orjson.OPT_INDENT_2))
+        return path
+
+
+_profilers = {}
+
+
+def _on_task_prerun(task_id=None, task=None, **kwargs):
+    if not is_profiled(task.name):
+        return
+    profiler = TaskProfiler(task.name, task_id)
+    profiler.start()
+    _profilers[task_id] = profiler
+
+
+def _on_task_postrun(task_id=None, task=None, **kwargs):
+    profiler = _profilers.pop(task_id, None)
+    if profiler is None:
+        return
+    profiler.stop()
+    try:
+        path = profiler.write()
+        logger.info(
+            f"Profiled {task.name} in {profiler.duration:.2f}s, "
+            f"{profiler.queries.summarize()['count']} queries, written to {path}.*"
+        )
+    except OSError as e:
+        logger.warning(f"Could not write the profile of {task.name}: {e}")
+
+
+def install_profiling_hooks():
+    # the sampled threads are those started by the task thread
+    threading.Thread.start = _start_thread(threading.Thread.start)
+    signals.task_prerun.connect(_on_task_prerun, weak=False)
+    signals.task_postrun.connect(_on_task_postrun, weak=False)
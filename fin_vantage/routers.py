@@ -0,0 +1,126 @@
+"""
+Routes the read-only queries to the database replicas.
+
+The queries made inside a read_replica() block are read from a replica that lags
+behind the primary by at most DATABASE_REPLICA_MAX_LAG seconds, or from the primary
+when none does. Everything else, the writes included, stays on the primary.
+"""
+
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from fin_vantage.instrumentation import DB_REPLICA_FALLBACKS, DB_REPLICA_READS
+
+logger = logging.getLogger(__name__)
+
+# the replay lag, zero when the replica has replayed everything it received, an idle
+# primary doesn't make the replay timestamp of its replicas any newer
+LAG_QUERY = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+_read_database = contextvars.ContextVar("read_database", default=None)
+
+_lags = {}
+_lags_lock = threading.Lock()
+
+
+def get_replicas() -> list[str]:
+    return [alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS]
+
+
+def measure_lag(alias: str) -> float | None:
+    """The lag of the replica in seconds, None when it can't be reached."""
+    connection = connections[alias]
+    try:
+        if connection.pool is None:
+            with connection.cursor() as cursor:
+                cursor.execute(LAG_QUERY)
+                (lag,) = cursor.fetchone()
+        else:
+            connection.pool.open()
+            # a replica that is down must not hold the reads for the whole pool timeout
+            with connection.pool.connection(
+                timeout=settings.DATABASE_REPLICA_CHECK_TIMEOUT
+            ) as pooled:
+                (lag,) = pooled.execute(LAG_QUERY).fetchone()
+    except (DatabaseError, psycopg.Error) as e:
+        logger.warning(f"Could not measure the lag of the {alias} replica: {e}")
+        return None
+    # a replica that never replayed a transaction has no replay timestamp
+    return float(lag) if lag is not None else 0.0
+
+
+def get_lag(alias: str) -> float | None:
+    now = time.monotonic()
+    with _lags_lock:
+        checked_at, lag = _lags.get(alias, (None, None))
+    if (
+        checked_at is None
+        or now - checked_at > settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL
+    ):
+        lag = measure_lag(alias)
+        with _lags_lock:
+            _lags[alias] = (now, lag)
+    return lag
+
+
+def choose_read_database() -> str:
+    replicas = get_replicas()
+    random.shuffle(replicas)
+    for alias in replicas:
+        lag = get_lag(alias)
+        if lag is None:
+            DB_REPLICA_FALLBACKS.inc(alias=alias, reason="unreachable")
+        elif lag > settings.DATABASE_REPLICA_MAX_LAG:
+            DB_REPLICA_FALLBACKS.inc(alias=alias, reason="lagging")
+        else:
+            return alias
+    return DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def read_replica():
+    """
+    Reads the queries of the block from a replica. The querysets are evaluated when
+    iterated, those built in the block must be evaluated in it too.
+    """
+    if _read_database.get() is not None:
+        # a nested block keeps the database of the outer one
+        yield _read_database.get()
+        return
+
+    alias = choose_read_database()
+    DB_REPLICA_READS.inc(alias=alias)
+    token = _read_database.set(alias)
+    try:
+        yield alias
+    finally:
+        _read_database.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return _read_database.get() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replicas get the schema through the replication
+        return db == DEFAULT_DB_ALIAS
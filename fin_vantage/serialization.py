@@ -0,0 +1,73 @@
+"""
+A compact serializer for the task payloads of the pipeline queues.
+
+The payloads are encoded with orjson, and compressed with zstandard once they are
+larger than TASK_PAYLOAD_COMPRESSION_THRESHOLD bytes. The first byte of a payload
+tells which of the two it is, so that small payloads don't pay for the compression.
+"""
+
+import decimal
+import threading
+
+import orjson
+import zstandard
+from django.conf import settings
+from kombu.serialization import register
+
+SERIALIZER_NAME = "orjson_zstd"
+CONTENT_TYPE = "application/x-orjson-zstd"
+
+RAW = b"J"
+COMPRESSED = b"Z"
+
+# the zstandard (de)compressors are not thread safe, each thread gets its own
+_local = threading.local()
+
+
+def _get_compressor() -> zstandard.ZstdCompressor:
+    if not hasattr(_local, "compressor"):
+        _local.compressor = zstandard.ZstdCompressor(level=3)
+    return _local.compressor
+
+
+def _get_decompressor() -> zstandard.ZstdDecompressor:
+    if not hasattr(_local, "decompressor"):
+        _local.decompressor = zstandard.ZstdDecompressor()
+    return _local.decompressor
+
+
+def _default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    raise TypeError(f"Type is not serializable: {type(obj).__name__}")
+
+
+def dumps(obj) -> bytes:
+    data = orjson.dumps(obj, default=_default)
+    if len(data) < settings.TASK_PAYLOAD_COMPRESSION_THRESHOLD:
+        return RAW + data
+    return COMPRESSED + _get_compressor().compress(data)
+
+
+def loads(payload: bytes | memoryview | str):
+    if isinstance(payload, str):
+        payload = payload.encode("latin-1")
+    payload = bytes(payload)
+
+    marker, data = payload[:1], payload[1:]
+    if marker == COMPRESSED:
+        # the frames written by compress() hold their size, decompress() needs it
+        data = _get_decompressor().decompress(data)
+    elif marker != RAW:
+        raise ValueError(f"Unknown {SERIALIZER_NAME} payload marker {marker!r}")
+    return orjson.loads(data)
+
+
+def register_serializer():
+    register(
+        SERIALIZER_NAME,
+        dumps,
+        loads,
+        content_type=CONTENT_TYPE,
+        content_encoding="binary",
+    )
@@ -15,6 +15,9 @@ from pathlib import Path
 
 import environ
 from celery.schedules import crontab
+from django.core.exceptions import ImproperlyConfigured
+
+from queues import Queues
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -91,6 +94,73 @@ WSGI_APPLICATION = "fin_vantage.wsgi.application"
 
 DATABASES = {"default": env.db()}
 
+# the read-only retrieval and scheduling queries go to the replicas, the tests use
+# the default database for them
+for index, url in enumerate(env.list("DATABASE_REPLICA_URLS", default=[])):
+    DATABASES[f"replica_{index}"] = {
+        **env.db_url_config(url),
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_ROUTERS = ["fin_vantage.routers.ReplicaRouter"]
+
+# seconds a replica may lag behind the primary before the reads fall back to it
+DATABASE_REPLICA_MAX_LAG = env.float("DATABASE_REPLICA_MAX_LAG", default=30)
+# seconds the lag check waits for a connection to a replica
+DATABASE_REPLICA_CHECK_TIMEOUT = env.float("DATABASE_REPLICA_CHECK_TIMEOUT", default=1)
+# seconds the lag measured on a replica is trusted for
+DATABASE_REPLICA_LAG_CHECK_INTERVAL = env.float(
+    "DATABASE_REPLICA_LAG_CHECK_INTERVAL", default=10
+)
+
+# partitions the financial statements by calendar_year when migrating, or later with
+# the maintain_statement_partitions command
+FINANCIAL_STATEMENT_PARTITIONING = env.bool(
+    "FINANCIAL_STATEMENT_PARTITIONING", default=False
+)
+# years past the current one that get their partition ahead of time
+FINANCIAL_STATEMENT_PARTITION_YEARS_AHEAD = env.int(
+    "FINANCIAL_STATEMENT_PARTITION_YEARS_AHEAD", default=2
+)
+
+# the pools are sized per kind of process, web or worker, the Celery workers run
+# with DJANGO_PROCESS_ROLE=worker and the web processes with the default
+PROCESS_ROLE = env("DJANGO_PROCESS_ROLE", default="web")
+DATABASE_POOL_ENABLED = env.bool("DATABASE_POOL_ENABLED", default=True)
+DATABASE_POOL_SIZES = {
+    "web": {
+        "min_size": env.int("DATABASE_POOL_WEB_MIN_SIZE", default=2),
+        "max_size": env.int("DATABASE_POOL_WEB_MAX_SIZE", default=10),
+    },
+    # a threads pool worker takes a connection per thread
+    "worker": {
+        "min_size": env.int("DATABASE_POOL_WORKER_MIN_SIZE", default=1),
+        "max_size": env.int("DATABASE_POOL_WORKER_MAX_SIZE", default=10),
+    },
+}
+
+
+def get_database_pool_options(alias: str) -> dict:
+    if PROCESS_ROLE not in DATABASE_POOL_SIZES:
+        raise ImproperlyConfigured(f"Unknown DJANGO_PROCESS_ROLE {PROCESS_ROLE}.")
+    return {
+        **DATABASE_POOL_SIZES[PROCESS_ROLE],
+        "name": f"{alias}-{PROCESS_ROLE}",
+        # seconds to wait for a free connection before failing
+        "timeout": env.float("DATABASE_POOL_TIMEOUT", default=10),
+        "max_lifetime": env.float("DATABASE_POOL_MAX_LIFETIME", default=30 * 60),
+        "max_idle": env.float("DATABASE_POOL_MAX_IDLE", default=5 * 60),
+    }
+
+
+if DATABASE_POOL_ENABLED:
+    for alias, database in DATABASES.items():
+        database.setdefault("OPTIONS", {})["pool"] = get_database_pool_options(alias)
+        # the connections are checked when taken from the pool
+        database["CONN_HEALTH_CHECKS"] = True
+        # the pool replaces the persistent connections
+        database["CONN_MAX_AGE"] = 0
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -127,16 +197,43 @@ USE_TZ = True
 
 LOG_DIR = env("LOG_PATH")
 
+# the tasks profiled on every run, by name, "*" for all of them, a single task can
+# also be profiled with the "profile-task-<name>" waffle switch
+PROFILED_TASKS = env.list("PROFILED_TASKS", default=[])
+TASK_PROFILE_DIR = os.path.join(LOG_DIR, "profiles")
+# seconds between two stack samples of a profiled task
+TASK_PROFILE_INTERVAL = env.float("TASK_PROFILE_INTERVAL", default=0.005)
+
+
+# records waiting for the log listener thread, past which the DEBUG and INFO ones
+# are dropped
+LOG_QUEUE_SIZE = env.int("LOG_QUEUE_SIZE", default=10000)
+# the task loggers write DEBUG records, the per symbol ones, to their files
+TASK_LOG_LEVEL = env("TASK_LOG_LEVEL", default="DEBUG")
+# the fraction of the DEBUG records that are kept
+LOG_DEBUG_SAMPLE_RATE = env.float("LOG_DEBUG_SAMPLE_RATE", default=0.01)
+
+VERBOSE_FORMAT = "{asctime} {levelname} {module} {message}"
+
+TASK_LOGGERS = [
+    "sync_companies",
+    "schedule_financial_fetching",
+    "fetch_financial_report",
+    "generate_financial_sentences",
+    "build_financial_embeddings",
+]
+
 
 def get_handler_config(name: str) -> dict:
+    # the records are written as JSON lines by the listener thread of the process
     return {
-        "level": "INFO",
-        "class": "logging.handlers.TimedRotatingFileHandler",
+        "level": "DEBUG",
+        "class": "fin_vantage.log_handlers.AsyncHandler",
         "filename": os.path.join(LOG_DIR, f"{name}.log"),
-        "when": "midnight",
-        "formatter": "verbose",
-        "encoding": "utf-8",
-        "backupCount": 30,
+        "console_level": "INFO",
+        "console_format": VERBOSE_FORMAT,
+        "queue_size": LOG_QUEUE_SIZE,
+        "filters": ["sample_debug"],
     }
 
 
@@ -145,7 +242,7 @@ LOGGING = {
     "disable_existing_loggers": False,
     "formatters": {
         "verbose": {
-            "format": "{asctime} {levelname} {module} {message}",
+            "format": VERBOSE_FORMAT,
             "style": "{",
         },
         "simple": {
@@ -153,48 +250,27 @@ LOGGING = {
             "style": "{",
         },
     },
+    "filters": {
+        "sample_debug": {
+            "()": "fin_vantage.log_handlers.SamplingFilter",
+            "rate": LOG_DEBUG_SAMPLE_RATE,
+        },
+    },
     "handlers": {
         "console": {
             "level": "INFO",
             "class": "logging.StreamHandler",
             "formatter": "verbose",
         },
-        "sync_companies": get_handler_config("sync_companies"),
-        "schedule_financial_fetching": get_handler_config(
-            "schedule_financial_fetching"
-        ),
-        "fetch_financial_report": get_handler_config("fetch_financial_report"),
-        "generate_financial_sentences": get_handler_config(
-            "generate_financial_sentences"
-        ),
-        "build_financial_embeddings": get_handler_config("build_financial_embeddings"),
+        **{name: get_handler_config(name) for name in TASK_LOGGERS},
     },
     "loggers": {
-        "sync_companies": {
-            "handlers": ["console", "sync_companies"],
-            "level": "INFO",
-            "propagate": False,
-        },
-        "schedule_financial_fetching": {
-            "handlers": ["console", "schedule_financial_fetching"],
-            "level": "INFO",
-            "propagate": False,
-        },
-        "fetch_financial_report": {
-            "handlers": ["console", "fetch_financial_report"],
-            "level": "INFO",
+        name: {
+            "handlers": [name],
+            "level": TASK_LOG_LEVEL,
             "propagate": False,
-        },
-        "generate_financial_sentences": {
-            "handlers": ["console", "generate_financial_sentences"],
-            "level": "INFO",
-            "propagate": False,
-        },
-        "build_financial_embeddings": {
-            "handlers": ["console", "build_financial_embeddings"],
-            "level": "INFO",
-            "propagate": False,
-        },
+        }
+        for name in TASK_LOGGERS
     },
 }
 
@@ -212,30 +288,192 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # Celery
 CELERY_BROKER_URL = env("CELERY_BROKER_URL", default="redis://localhost:6379/0")
 CELERY_RESULT_BACKEND = env("CELERY_RESULT_BACKEND", default="redis://localhost:6379/0")
-CELERY_ACCEPT_CONTENT = ["json"]
+# the pipeline tasks send their payloads with fin_vantage.serialization
+CELERY_ACCEPT_CONTENT = ["json", "application/x-orjson-zstd"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "UTC"
 
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
 
+# the tasks without an explicit queue, the fetch lanes are chosen when dispatching
+CELERY_TASK_ROUTES = {
+    "ingestion.tasks.fetch_financial_report": {"queue": Queues.FETCH_FINANCIAL_REPORT},
+    "embeds.tasks.build_financial_embeddings": {"queue": Queues.FINANCIAL_SENTENCES},
+    "ingestion.tasks.sync_companies": {"queue": Queues.SCHEDULING},
+    "ingestion.tasks.schedule_financial_fetching": {"queue": Queues.SCHEDULING},
+    "embeds.tasks.generate_financial_sentences": {"queue": Queues.SCHEDULING},
+    "core.tasks.maintain_statement_partitions": {"queue": Queues.SCHEDULING},
+}
+# payloads of the pipeline tasks larger than this many bytes are compressed
+TASK_PAYLOAD_COMPRESSION_THRESHOLD = env.int(
+    "TASK_PAYLOAD_COMPRESSION_THRESHOLD", default=4096
+)
+# one of fin_vantage.worker_profiles.WORKER_PROFILES, for the worker processes
+WORKER_PROFILE = env("WORKER_PROFILE", default=None)
+
 CELERY_BEAT_SCHEDULE = {
     "sync-companies": {
         "task": "ingestion.tasks.sync_companies",
         "schedule": crontab(hour=0),
     },
+    # hourly, so that refreshes don't wait a day behind a backfill, the fetch leases
+    # and the quota weighting keep the runs from dispatching twice or overspending
     "sync-financial-statements": {
         "task": "ingestion.tasks.schedule_financial_fetching",
-        "schedule": crontab(hour=1),
+        "schedule": crontab(minute=0),
     },
     "generate-financial-sentences": {
         "task": "embeds.tasks.generate_financial_sentences",
         "schedule": crontab(hour=4),
     },
+    # ahead of the new year, and for the years that landed in the default partition
+    "maintain-statement-partitions": {
+        "task": "core.tasks.maintain_statement_partitions",
+        "schedule": crontab(minute=0, hour=3),
+    },
 }
 
 
+# Metrics
+METRICS_REDIS_URL = env("METRICS_REDIS_URL", default=CELERY_BROKER_URL)
+# the benchmarks keep their Redis state apart, in a database flushed before every run
+BENCHMARK_REDIS_URL = env("BENCHMARK_REDIS_URL", default="redis://localhost:6379/15")
+
+
+# Exports
+# seconds an export statement, or the wait for the client between two chunks, may take
+# before the export is cut short, the open snapshot holds back VACUUM
+EXPORT_STATEMENT_TIMEOUT = env.float("EXPORT_STATEMENT_TIMEOUT", default=300)
+
+
 # Financial API
 FINANCIAL_DATA_API_URL = env("FINANCIAL_DATA_API_URL")
 FINANCIAL_DATA_API_KEY = env("FINANCIAL_DATA_API_KEY")
 STOCK_EXCHANGES = env.list("STOCK_EXCHANGES")
+# seconds to wait before every statements request, and after a 429 on the paid plan
+FINANCIAL_DATA_API_REQUEST_DELAY = env.float(
+    "FINANCIAL_DATA_API_REQUEST_DELAY", default=0.5
+)
+FINANCIAL_DATA_API_RATE_LIMIT_PAUSE = env.float(
+    "FINANCIAL_DATA_API_RATE_LIMIT_PAUSE", default=70
+)
+FINANCIAL_DATA_API_TIMEOUT = env.float("FINANCIAL_DATA_API_TIMEOUT", default=30)
+# bound of the queues between the fetch, parse and write stages of the pipelined fetch
+FETCH_PIPELINE_QUEUE_SIZE = env.int("FETCH_PIPELINE_QUEUE_SIZE", default=8)
+# companies dispatched to a fetch task are rescheduled if it didn't report back by then
+FETCH_LEASE_SECONDS = env.int("FETCH_LEASE_SECONDS", default=6 * 60 * 60)
+FETCH_MAX_BACKOFF_HOURS = env.int("FETCH_MAX_BACKOFF_HOURS", default=7 * 24)
+TRACKER_UPDATE_BATCH_SIZE = env.int("TRACKER_UPDATE_BATCH_SIZE", default=50)
+# names of ingestion.endpoints.ENDPOINTS to fetch for every company, a request each:
+# income_statement, balance_sheet, cash_flow, and their _quarterly variants
+FINANCIAL_DATA_ENDPOINTS = env.list(
+    "FINANCIAL_DATA_ENDPOINTS", default=["income_statement"]
+)
+# identical requests made by several workers at once are answered by a single call,
+# through this Redis, which also holds the circuit breaker
+INGESTION_REDIS_URL = env("INGESTION_REDIS_URL", default=CELERY_BROKER_URL)
+# seconds the Redis reads and writes, and connections, of the ingestion may take
+INGESTION_REDIS_TIMEOUT = env.float("INGESTION_REDIS_TIMEOUT", default=2)
+# the requests of the whole fleet share a circuit breaker, opened once this share of the
+# requests of the last window failed, see ingestion.circuit_breaker
+FINANCIAL_DATA_BREAKER_ENABLED = env.bool(
+    "FINANCIAL_DATA_BREAKER_ENABLED", default=True
+)
+FINANCIAL_DATA_BREAKER_WINDOW = env.int("FINANCIAL_DATA_BREAKER_WINDOW", default=60)
+FINANCIAL_DATA_BREAKER_ERROR_RATE = env.float(
+    "FINANCIAL_DATA_BREAKER_ERROR_RATE", default=0.5
+)
+FINANCIAL_DATA_BREAKER_MIN_REQUESTS = env.int(
+    "FINANCIAL_DATA_BREAKER_MIN_REQUESTS", default=10
+)
+# doubled by every failed probe, up to the max
+FINANCIAL_DATA_BREAKER_OPEN_SECONDS = env.float(
+    "FINANCIAL_DATA_BREAKER_OPEN_SECONDS", default=30
+)
+FINANCIAL_DATA_BREAKER_MAX_OPEN_SECONDS = env.float(
+    "FINANCIAL_DATA_BREAKER_MAX_OPEN_SECONDS", default=15 * 60
+)
+# the requests in flight across the fleet, grown by one per round of successful
+# requests and multiplied by the decrease on a failure
+FINANCIAL_DATA_CONCURRENCY_INITIAL = env.int(
+    "FINANCIAL_DATA_CONCURRENCY_INITIAL", default=4
+)
+FINANCIAL_DATA_CONCURRENCY_MIN = env.int("FINANCIAL_DATA_CONCURRENCY_MIN", default=1)
+FINANCIAL_DATA_CONCURRENCY_MAX = env.int("FINANCIAL_DATA_CONCURRENCY_MAX", default=32)
+FINANCIAL_DATA_CONCURRENCY_DECREASE = env.float(
+    "FINANCIAL_DATA_CONCURRENCY_DECREASE", default=0.5
+)
+# the failures of a burst lower the limit once
+FINANCIAL_DATA_CONCURRENCY_DECREASE_SECONDS = env.int(
+    "FINANCIAL_DATA_CONCURRENCY_DECREASE_SECONDS", default=5
+)
+FINANCIAL_DATA_CONCURRENCY_WAIT_SECONDS = env.float(
+    "FINANCIAL_DATA_CONCURRENCY_WAIT_SECONDS", default=60
+)
+# requests per day on the free plan, split between the scheduled lanes by weight
+FINANCIAL_DATA_API_DAILY_QUOTA = env.int("FINANCIAL_DATA_API_DAILY_QUOTA", default=250)
+FETCH_LANE_WEIGHTS = {"refresh": 0.7, "backfill": 0.3}
+
+
+# LLM
+LLM_MODEL = env("LLM_MODEL", default="MistralAI")
+# pull the RAG prompt from the LangChain hub, or use the local copy only
+RAG_PROMPT_FROM_HUB = env.bool("RAG_PROMPT_FROM_HUB", default=True)
+# seconds to wait after every embedding request, to stay under the provider rate limit
+EMBEDDING_REQUEST_DELAY = env.float("EMBEDDING_REQUEST_DELAY", default=5)
+# the local embedding provider, a Model2Vec style model downloaded from the hub
+LOCAL_EMBEDDING_MODEL_REPO = env(
+    "LOCAL_EMBEDDING_MODEL_REPO", default="minishlab/potion-base-8M"
+)
+LOCAL_EMBEDDING_MODEL_NAME = LOCAL_EMBEDDING_MODEL_REPO.rsplit("/", 1)[-1]
+LOCAL_EMBEDDING_MODEL_DIR = env(
+    "LOCAL_EMBEDDING_MODEL_DIR",
+    default=str(BASE_DIR / "models" / LOCAL_EMBEDDING_MODEL_NAME),
+)
+LOCAL_EMBEDDING_DIMENSION = env.int("LOCAL_EMBEDDING_DIMENSION", default=256)
+# None sizes the process pool to the host cores
+LOCAL_EMBEDDING_PROCESSES = env.int("LOCAL_EMBEDDING_PROCESSES", default=None)
+# a call is spread over the processes in batches of these sizes, the calls smaller
+# than a batch of the minimum size are embedded in process
+LOCAL_EMBEDDING_BATCH_CHARACTERS = env.int(
+    "LOCAL_EMBEDDING_BATCH_CHARACTERS", default=64 * 1024
+)
+LOCAL_EMBEDDING_MIN_BATCH_CHARACTERS = env.int(
+    "LOCAL_EMBEDDING_MIN_BATCH_CHARACTERS", default=2 * 1024
+)
+HF_TOKEN = env("HF_TOKEN", default=None)
+# analyses a reembed_analyses task embeds before queueing the next one, and per request
+REEMBED_PAGE_SIZE = env.int("REEMBED_PAGE_SIZE", default=512)
+REEMBED_BATCH_SIZE = env.int("REEMBED_BATCH_SIZE", default=32)
+# build_financial_embeddings writes the analyses it embedded by this many, or after
+# this many seconds
+EMBEDDING_WRITE_BATCH_SIZE = env.int("EMBEDDING_WRITE_BATCH_SIZE", default=200)
+EMBEDDING_WRITE_MAX_DELAY = env.float("EMBEDDING_WRITE_MAX_DELAY", default=30)
+# the analyses read by vector distance, before the re-ranking and the packing
+RETRIEVAL_CANDIDATES = env.int("RETRIEVAL_CANDIDATES", default=40)
+# the candidates less relevant than this, or than the best one less the margin, are
+# left out, a question about a company and a year doesn't fill the budget with others;
+# the relevance is the cosine similarity raised by the question's symbols and years
+RETRIEVAL_MIN_RELEVANCE = env.float("RETRIEVAL_MIN_RELEVANCE", default=0.0)
+RETRIEVAL_RELEVANCE_MARGIN = env.float("RETRIEVAL_RELEVANCE_MARGIN", default=0.1)
+# 0 orders the candidates by relevance only, 1 by novelty only
+RETRIEVAL_MMR_DIVERSITY = env.float("RETRIEVAL_MMR_DIVERSITY", default=0.3)
+# tokens of analyses sent with a question
+RETRIEVAL_CONTEXT_TOKENS = env.int("RETRIEVAL_CONTEXT_TOKENS", default=1500)
+# a tokenizer.json counting the tokens, four characters per token without one
+RETRIEVAL_TOKENIZER = env(
+    "RETRIEVAL_TOKENIZER",
+    default=str(Path(LOCAL_EMBEDDING_MODEL_DIR) / "tokenizer.json"),
+)
+# the question contexts and embeddings, cached per process and optionally in Redis
+QUERY_CACHE_SIZE = env.int("QUERY_CACHE_SIZE", default=1024)
+QUERY_CACHE_TTL = env.float("QUERY_CACHE_TTL", default=300)
+# the embeddings don't go stale as the analyses are written, they are kept longer
+QUERY_EMBEDDING_CACHE_SIZE = env.int("QUERY_EMBEDDING_CACHE_SIZE", default=4096)
+QUERY_EMBEDDING_CACHE_TTL = env.float("QUERY_EMBEDDING_CACHE_TTL", default=24 * 60 * 60)
+QUERY_CACHE_REDIS_URL = env("QUERY_CACHE_REDIS_URL", default=None)
+# seconds the Redis reads and writes, and connections, may take
+QUERY_CACHE_REDIS_TIMEOUT = env.float("QUERY_CACHE_REDIS_TIMEOUT", default=0.5)
+# seconds a request waits for the identical one computing its value
+QUERY_CACHE_WAIT_TIMEOUT = env.float("QUERY_CACHE_WAIT_TIMEOUT", default=60)
@@ -18,7 +18,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from core.views import prometheus_metrics
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("core.urls")),
+    path("metrics", prometheus_metrics, name="prometheus_metrics"),
 ]
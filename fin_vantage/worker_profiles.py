@@ -0,0 +1,126 @@
+"""
+Celery worker profiles, one per kind of queue.
+
+A worker runs a single profile, chosen with the WORKER_PROFILE setting
+(``WORKER_PROFILE=fetch celery -A fin_vantage worker``). The profile sets the queues
+it consumes, its pool and the settings that fit its tasks:
+
+- the fetch and embedding tasks mostly wait on HTTP and on their rate limiting
+  sleeps, a threads pool runs many of them without pinning a process per task. Every
+  fetch lane has a profile of its own, a worker consuming several queues takes their
+  tasks in turn, the hot and refresh tasks would wait behind the backfill ones
+- the jobs scanning every company run on a prefork pool without time limits, their
+  duration grows with the companies
+- the other tasks are short and CPU or database bound, they stay on a prefork pool
+  whose time limits stop the runaway ones
+
+The I/O profiles prefetch a single task per thread, so that a worker sleeping through
+a rate limit doesn't hold tasks other workers could run, and acknowledge the tasks once
+done, as their writes are idempotent and a crashed worker's tasks are redelivered.
+"""
+
+import os
+from dataclasses import dataclass
+
+from kombu import Exchange, Queue
+
+from queues import Queues
+
+DEFAULT_QUEUE = "celery"
+
+
+@dataclass(frozen=True)
+class WorkerProfile:
+    name: str
+    queues: tuple[str, ...]
+    pool: str
+    concurrency: int
+    prefetch_multiplier: int
+    acks_late: bool
+    # the threads pool can't enforce time limits, only the prefork one sets them
+    soft_time_limit: int | None = None
+    time_limit: int | None = None
+    max_tasks_per_child: int | None = None
+
+    def get_config(self) -> dict:
+        return {
+            "task_queues": [
+                Queue(name, Exchange(name), routing_key=name) for name in self.queues
+            ],
+            "worker_pool": self.pool,
+            "worker_concurrency": self.concurrency,
+            "worker_prefetch_multiplier": self.prefetch_multiplier,
+            "worker_max_tasks_per_child": self.max_tasks_per_child,
+            "task_acks_late": self.acks_late,
+            # with late acknowledgement, a task whose worker died is redelivered
+            "task_reject_on_worker_lost": self.acks_late,
+            "task_soft_time_limit": self.soft_time_limit,
+            "task_time_limit": self.time_limit,
+        }
+
+
+WORKER_PROFILES = {
+    profile.name: profile
+    for profile in (
+        WorkerProfile(
+            name="fetch_hot",
+            queues=(Queues.FETCH_FINANCIAL_REPORT_HOT,),
+            pool="threads",
+            concurrency=2,
+            prefetch_multiplier=1,
+            acks_late=True,
+        ),
+        WorkerProfile(
+            name="fetch",
+            queues=(Queues.FETCH_FINANCIAL_REPORT,),
+            pool="threads",
+            concurrency=8,
+            prefetch_multiplier=1,
+            acks_late=True,
+        ),
+        WorkerProfile(
+            name="fetch_backfill",
+            queues=(Queues.FETCH_FINANCIAL_REPORT_BACKFILL,),
+            pool="threads",
+            concurrency=4,
+            prefetch_multiplier=1,
+            acks_late=True,
+        ),
+        WorkerProfile(
+            name="embeddings",
+            queues=(Queues.FINANCIAL_SENTENCES,),
+            pool="threads",
+            concurrency=4,
+            prefetch_multiplier=1,
+            acks_late=True,
+        ),
+        WorkerProfile(
+            name="scheduling",
+            queues=(Queues.SCHEDULING,),
+            pool="prefork",
+            concurrency=1,
+            prefetch_multiplier=1,
+            acks_late=False,
+        ),
+        WorkerProfile(
+            name="default",
+            queues=(DEFAULT_QUEUE,),
+            pool="prefork",
+            concurrency=os.cpu_count() or 2,
+            prefetch_multiplier=4,
+            acks_late=False,
+            soft_time_limit=10 * 60,
+            time_limit=15 * 60,
+            max_tasks_per_child=100,
+        ),
+    )
+}
+
+
+def get_worker_profile(name: str) -> WorkerProfile:
+    try:
+        return WORKER_PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown worker profile {name}, expected one of {', '.join(WORKER_PROFILES)}"
+        ) from None
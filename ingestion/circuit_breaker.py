@@ -0,0 +1,329 @@
+"""
+Load shedding of the financial data API requests, shared by every worker through Redis.
+
+The circuit breaker counts the outcomes of the requests over the last
+FINANCIAL_DATA_BREAKER_WINDOW seconds. Once enough of them failed, it opens: the
+requests fail right away with CircuitOpenError instead of reaching the provider. After
+FINANCIAL_DATA_BREAKER_OPEN_SECONDS it half-opens and lets a single request through,
+the probe. The circuit closes if the probe succeeds, otherwise it opens again for twice
+as long, up to FINANCIAL_DATA_BREAKER_MAX_OPEN_SECONDS.
+
+While closed, the requests in flight across the fleet are bounded by a concurrency
+limit, adjusted by additive increase, multiplicative decrease: a successful request
+that took the last free slot adds 1 / limit to it, the limit only grows while it holds
+the fleet back, and a failure multiplies it by FINANCIAL_DATA_CONCURRENCY_DECREASE, at
+most once per FINANCIAL_DATA_CONCURRENCY_DECREASE_SECONDS. The fleet settles right
+below the rate the provider sustains.
+
+Without Redis, the requests are let through.
+"""
+
+import logging
+import math
+import time
+import uuid
+from contextlib import contextmanager
+
+import redis
+import requests
+from django.conf import settings
+
+from fin_vantage.instrumentation import (
+    FINANCIAL_API_BREAKER_TRANSITIONS,
+    FINANCIAL_API_CONCURRENCY_LIMIT,
+    FINANCIAL_API_CONCURRENCY_WAIT_SECONDS,
+    FINANCIAL_API_SHED,
+)
+
+logger = logging.getLogger("fetch_financial_report")
+
+KEY_PREFIX = "fin_vantage:ingestion:breaker:"
+STATE_KEY = f"{KEY_PREFIX}open"
+TRIPPED_KEY = f"{KEY_PREFIX}tripped"
+PROBE_KEY = f"{KEY_PREFIX}probe"
+LIMIT_KEY = f"{KEY_PREFIX}limit"
+DECREASED_KEY = f"{KEY_PREFIX}decreased"
+IN_FLIGHT_KEY = f"{KEY_PREFIX}in_flight"
+
+# the outcomes are counted in buckets of this many seconds
+BUCKET_SECONDS = 5
+POLL_SECONDS = 0.2
+# a request slot is freed by then, should its worker die
+SLOT_SECONDS = 300
+
+# frees the expired slots, then takes one if fewer than the limit are taken, returns 2
+# when it was the last one
+ACQUIRE_SCRIPT = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now)
+local limit = math.floor(tonumber(redis.call("GET", KEYS[2]) or ARGV[1]))
+local taken = redis.call("ZCARD", KEYS[1])
+if taken < limit then
+    redis.call("ZADD", KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+    redis.call("EXPIRE", KEYS[1], ARGV[2])
+    if taken + 1 >= limit then
+        return 2
+    end
+    return 1
+end
+return 0
+"""
+
+# returns the new limit as a string, Lua numbers are truncated to integers otherwise
+ADJUST_SCRIPT = """
+local limit = tonumber(redis.call("GET", KEYS[1]) or ARGV[1])
+if ARGV[2] == "increase" then
+    limit = math.min(limit + 1 / limit, tonumber(ARGV[4]))
+elseif redis.call("SET", KEYS[2], 1, "NX", "EX", ARGV[5]) then
+    limit = math.max(limit * tonumber(ARGV[3]), tonumber(ARGV[6]))
+else
+    return false
+end
+redis.call("SET", KEYS[1], tostring(limit))
+return tostring(limit)
+"""
+
+
+class CircuitOpenError(Exception):
+    """The provider is failing, the request wasn't made."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"The circuit is open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class ConcurrencyTimeoutError(Exception):
+    """No request slot freed up in time, the request wasn't made."""
+
+
+_client = None
+_scripts = {}
+
+
+def _get_client() -> redis.Redis:
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(
+            settings.INGESTION_REDIS_URL,
+            socket_timeout=settings.INGESTION_REDIS_TIMEOUT,
+            socket_connect_timeout=settings.INGESTION_REDIS_TIMEOUT,
+        )
+    return _client
+
+
+def _get_script(source: str):
+    if source not in _scripts:
+        _scripts[source] = _get_client().register_script(source)
+    return _scripts[source]
+
+
+def is_failure(e: Exception | None) -> bool:
+    """
+    Whether the outcome tells that the provider is struggling. The other client errors,
+    such as an unknown symbol, don't.
+    """
+    if e is None or not isinstance(e, requests.exceptions.RequestException):
+        return False
+    if e.response is None:
+        # timeouts and connection errors
+        return True
+    return e.response.status_code == 429 or e.response.status_code >= 500
+
+
+def get_bucket_keys(now: float) -> list[str]:
+    """The buckets of the window ending now, the current one first."""
+    bucket = int(now // BUCKET_SECONDS)
+    buckets = math.ceil(settings.FINANCIAL_DATA_BREAKER_WINDOW / BUCKET_SECONDS)
+    return [f"{KEY_PREFIX}outcomes:{bucket - index}" for index in range(buckets)]
+
+
+def get_open_seconds(trips: int) -> float:
+    return min(
+        settings.FINANCIAL_DATA_BREAKER_OPEN_SECONDS * 2 ** (trips - 1),
+        settings.FINANCIAL_DATA_BREAKER_MAX_OPEN_SECONDS,
+    )
+
+
+def get_retry_after() -> float:
+    """Seconds until the circuit half-opens, 0 if it isn't open."""
+    try:
+        client = _get_client()
+        ttl = max(client.pttl(STATE_KEY), client.pttl(PROBE_KEY))
+    except redis.RedisError as e:
+        logger.warning(f"Could not read the circuit breaker: {e}")
+        return settings.FINANCIAL_DATA_BREAKER_OPEN_SECONDS
+    return max(ttl, 0) / 1000
+
+
+def open_circuit(client: redis.Redis, trips: int):
+    open_seconds = get_open_seconds(trips)
+    client.set(STATE_KEY, trips, px=int(open_seconds * 1000))
+    FINANCIAL_API_BREAKER_TRANSITIONS.inc(state="open")
+    logger.warning(
+        f"Financial data API circuit opened for {open_seconds:.0f}s, trip {trips}."
+    )
+
+
+def close_circuit(client: redis.Redis):
+    pipeline = client.pipeline(transaction=False)
+    pipeline.delete(TRIPPED_KEY, STATE_KEY, PROBE_KEY)
+    # the failures that opened the circuit don't count anymore
+    pipeline.delete(*get_bucket_keys(time.time()))
+    pipeline.execute()
+    FINANCIAL_API_BREAKER_TRANSITIONS.inc(state="closed")
+    logger.info("Financial data API circuit closed.")
+
+
+def enter(endpoint: str) -> bool:
+    """
+    Raises CircuitOpenError unless the request can be made, and returns whether it is
+    the probe of a half-open circuit.
+    """
+    client = _get_client()
+    pipeline = client.pipeline(transaction=False)
+    pipeline.exists(STATE_KEY)
+    pipeline.exists(TRIPPED_KEY)
+    is_open, is_tripped = pipeline.execute()
+    if is_open:
+        FINANCIAL_API_SHED.inc(endpoint=endpoint, reason="open")
+        raise CircuitOpenError(get_retry_after())
+    if not is_tripped:
+        return False
+
+    # half-open, a single request probes the provider
+    probe_seconds = settings.FINANCIAL_DATA_API_TIMEOUT + POLL_SECONDS
+    if client.set(PROBE_KEY, 1, nx=True, ex=math.ceil(probe_seconds)):
+        FINANCIAL_API_BREAKER_TRANSITIONS.inc(state="half_open")
+        return True
+    FINANCIAL_API_SHED.inc(endpoint=endpoint, reason="probing")
+    raise CircuitOpenError(get_retry_after())
+
+
+def acquire_slot(endpoint: str) -> tuple[str, bool]:
+    """
+    Waits for a request slot under the concurrency limit, and returns its token and
+    whether it was the last free one.
+    """
+    acquire = _get_script(ACQUIRE_SCRIPT)
+    token = uuid.uuid4().hex
+    start_time = time.perf_counter()
+    deadline = time.monotonic() + settings.FINANCIAL_DATA_CONCURRENCY_WAIT_SECONDS
+    while not (
+        acquired := acquire(
+            keys=[IN_FLIGHT_KEY, LIMIT_KEY],
+            args=[settings.FINANCIAL_DATA_CONCURRENCY_INITIAL, SLOT_SECONDS, token],
+        )
+    ):
+        if time.monotonic() >= deadline:
+            FINANCIAL_API_SHED.inc(endpoint=endpoint, reason="concurrency")
+            raise ConcurrencyTimeoutError(
+                f"No financial data API request slot freed up in "
+                f"{settings.FINANCIAL_DATA_CONCURRENCY_WAIT_SECONDS}s"
+            )
+        time.sleep(POLL_SECONDS)
+    FINANCIAL_API_CONCURRENCY_WAIT_SECONDS.observe(
+        time.perf_counter() - start_time, endpoint=endpoint
+    )
+    return token, acquired == 2
+
+
+def adjust_limit(failed: bool, is_saturated: bool):
+    """
+    Lowers the limit after a failure, and raises it after a success that took the last
+    free slot. Below the limit, the successes don't tell that it could be higher.
+    """
+    if not failed and not is_saturated:
+        return
+    limit = _get_script(ADJUST_SCRIPT)(
+        keys=[LIMIT_KEY, DECREASED_KEY],
+        args=[
+            settings.FINANCIAL_DATA_CONCURRENCY_INITIAL,
+            "decrease" if failed else "increase",
+            settings.FINANCIAL_DATA_CONCURRENCY_DECREASE,
+            settings.FINANCIAL_DATA_CONCURRENCY_MAX,
+            settings.FINANCIAL_DATA_CONCURRENCY_DECREASE_SECONDS,
+            settings.FINANCIAL_DATA_CONCURRENCY_MIN,
+        ],
+    )
+    if limit is not None:
+        FINANCIAL_API_CONCURRENCY_LIMIT.observe(float(limit))
+
+
+def record(failed: bool, is_probe: bool):
+    client = _get_client()
+    if is_probe:
+        if failed:
+            trips = client.incr(TRIPPED_KEY)
+            open_circuit(client, trips)
+            client.delete(PROBE_KEY)
+        else:
+            close_circuit(client)
+        return
+
+    now = time.time()
+    bucket_keys = get_bucket_keys(now)
+    pipeline = client.pipeline(transaction=False)
+    pipeline.hincrby(bucket_keys[0], "failed" if failed else "succeeded", 1)
+    pipeline.expire(
+        bucket_keys[0], settings.FINANCIAL_DATA_BREAKER_WINDOW + BUCKET_SECONDS
+    )
+    pipeline.execute()
+    if not failed:
+        return
+
+    pipeline = client.pipeline(transaction=False)
+    for key in bucket_keys:
+        pipeline.hmget(key, "succeeded", "failed")
+    succeeded, failures = 0, 0
+    for bucket_succeeded, bucket_failed in pipeline.execute():
+        succeeded += int(bucket_succeeded or 0)
+        failures += int(bucket_failed or 0)
+    total = succeeded + failures
+    if (
+        total >= settings.FINANCIAL_DATA_BREAKER_MIN_REQUESTS
+        and failures / total >= settings.FINANCIAL_DATA_BREAKER_ERROR_RATE
+    ):
+        # the first worker to see it opens the circuit, the others find it tripped
+        if client.set(TRIPPED_KEY, 1, nx=True):
+            open_circuit(client, 1)
+
+
+@contextmanager
+def guard(endpoint: str):
+    """
+    Wraps a request to the provider: raises CircuitOpenError while the circuit is open,
+    waits for a slot under the concurrency limit, then records the outcome.
+    """
+    if not settings.FINANCIAL_DATA_BREAKER_ENABLED:
+        yield
+        return
+
+    try:
+        is_probe = enter(endpoint)
+        # the probe doesn't wait, the limit was lowered by the failures before it
+        token, is_saturated = (None, False) if is_probe else acquire_slot(endpoint)
+        is_guarded = True
+    except redis.RedisError as e:
+        logger.warning(f"Could not read the circuit breaker, not guarding: {e}")
+        is_guarded = False
+
+    if not is_guarded:
+        yield
+        return
+
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        failed = is_failure(error)
+        try:
+            if token is not None:
+                _get_client().zrem(IN_FLIGHT_KEY, token)
+            record(failed, is_probe)
+            adjust_limit(failed, is_saturated)
+        except redis.RedisError as e:
+            logger.warning(f"Could not record the request outcome: {e}")
@@ -0,0 +1,217 @@
+"""
+Requests to the financial data API.
+
+Identical requests made at the same time by several workers are deduplicated through
+Redis: the first one makes the call, the others wait for its response, which is kept
+only for as long as they take to read it. The requests of the whole fleet go through
+the circuit breaker of ingestion.circuit_breaker.
+"""
+
+import datetime
+import hashlib
+import logging
+import time
+
+import orjson
+import redis
+import requests
+from django.conf import settings
+from tenacity import (
+    after_log,
+    before_log,
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from fin_vantage.instrumentation import (
+    FINANCIAL_API_DEDUPLICATED,
+    FINANCIAL_API_RATE_LIMITED,
+    FINANCIAL_API_REQUEST_SECONDS,
+    FINANCIAL_API_RETRIES,
+)
+from ingestion import circuit_breaker
+from ingestion.endpoints import STATEMENT_KEYS, Endpoint, get_enabled_endpoints
+from ingestion.scheduling import count_api_request
+
+logger = logging.getLogger("fetch_financial_report")
+
+KEY_PREFIX = "fin_vantage:ingestion:request:"
+# how long the in flight marker of a request lives, should its worker die
+IN_FLIGHT_SECONDS = 120
+POLL_SECONDS = 0.2
+# the waiting requests poll every POLL_SECONDS, the response is gone well after
+RESULT_SECONDS = 5
+
+_client = None
+
+
+def _get_client() -> redis.Redis:
+    global _client
+    if _client is None:
+        # a stalled Redis fails the deduplication rather than holding the fetch threads
+        _client = redis.Redis.from_url(
+            settings.INGESTION_REDIS_URL,
+            socket_timeout=settings.INGESTION_REDIS_TIMEOUT,
+            socket_connect_timeout=settings.INGESTION_REDIS_TIMEOUT,
+        )
+    return _client
+
+
+def should_retry_exception(e):
+    # a 429 is handled by the caller, and the other client errors would fail again
+    if isinstance(e, requests.exceptions.HTTPError):
+        if e.response is not None and e.response.status_code == 429:
+            return False
+    return circuit_breaker.is_failure(e)
+
+
+def count_retry(endpoint: str):
+    def before_sleep(retry_state):
+        FINANCIAL_API_RETRIES.inc(endpoint=endpoint)
+
+    return before_sleep
+
+
+def request_financial_data(endpoint: str, path: str, params: dict | None = None):
+    """
+    GETs the given path of the financial data API, recording its latency under `endpoint`.
+    """
+    start_time = time.perf_counter()
+    status = "error"
+    try:
+        with circuit_breaker.guard(endpoint):
+            response = requests.get(
+                f"{settings.FINANCIAL_DATA_API_URL}{path}",
+                params={**(params or {}), "apikey": settings.FINANCIAL_DATA_API_KEY},
+                timeout=settings.FINANCIAL_DATA_API_TIMEOUT,
+            )
+            count_api_request()
+            status = str(response.status_code)
+            if response.status_code == 429:
+                FINANCIAL_API_RATE_LIMITED.inc(endpoint=endpoint)
+            response.raise_for_status()
+            return response
+    finally:
+        FINANCIAL_API_REQUEST_SECONDS.observe(
+            time.perf_counter() - start_time, endpoint=endpoint, status=status
+        )
+
+
+def get_request_key(endpoint: Endpoint, symbol: str, params: dict) -> str:
+    # the deployments sharing a Redis, or an API key, don't share their responses,
+    # the key is only part of the digest
+    request = orjson.dumps(
+        [
+            settings.FINANCIAL_DATA_API_URL,
+            settings.FINANCIAL_DATA_API_KEY,
+            endpoint.name,
+            endpoint.get_path(symbol),
+            {**endpoint.params, **params},
+        ],
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.blake2b(request, digest_size=20).hexdigest()
+
+
+def _request_endpoint(endpoint: Endpoint, symbol: str, params: dict) -> list:
+    # the retries stop once the circuit opens, CircuitOpenError isn't retried, and are
+    # jittered so that the workers failing together don't retry together
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_random_exponential(multiplier=4, max=10),
+        retry=retry_if_exception(should_retry_exception),
+        before=before_log(logger, logging.DEBUG),
+        after=after_log(logger, logging.DEBUG),
+        before_sleep=count_retry(endpoint.name),
+    )
+    def request():
+        time.sleep(settings.FINANCIAL_DATA_API_REQUEST_DELAY)
+        return request_financial_data(
+            endpoint.name,
+            endpoint.get_path(symbol),
+            params={**endpoint.params, **params},
+        )
+
+    return request().json()
+
+
+def request_deduplicated(
+    endpoint: Endpoint, symbol: str, params: dict | None = None
+) -> list:
+    """
+    Requests the endpoint for the symbol, unless another worker is already doing so,
+    in which case its response is awaited instead. Without Redis, every request is made.
+    """
+    params = params or {}
+    key = get_request_key(endpoint, symbol, params)
+    result_key = f"{KEY_PREFIX}{key}:result"
+    in_flight_key = f"{KEY_PREFIX}{key}:in_flight"
+
+    try:
+        client = _get_client()
+        is_owner = client.set(in_flight_key, 1, nx=True, ex=IN_FLIGHT_SECONDS)
+    except redis.RedisError as e:
+        logger.warning(f"Could not deduplicate the {endpoint.name} request: {e}")
+        return _request_endpoint(endpoint, symbol, params)
+
+    if is_owner:
+        try:
+            data = _request_endpoint(endpoint, symbol, params)
+            try:
+                # for the requests waiting on this one, not for those made afterwards
+                client.set(result_key, orjson.dumps(data), ex=RESULT_SECONDS)
+            except redis.RedisError as e:
+                logger.warning(f"Could not share the {endpoint.name} response: {e}")
+            return data
+        finally:
+            try:
+                client.delete(in_flight_key)
+            except redis.RedisError:
+                pass
+
+    # an identical request is in flight, its response shows up unless it fails,
+    # in which case the request is made here
+    deadline = time.monotonic() + IN_FLIGHT_SECONDS
+    try:
+        while time.monotonic() < deadline:
+            time.sleep(POLL_SECONDS)
+            if (result := client.get(result_key)) is not None:
+                FINANCIAL_API_DEDUPLICATED.inc(endpoint=endpoint.name)
+                return orjson.loads(result)
+            if not client.exists(in_flight_key):
+                break
+    except redis.RedisError as e:
+        logger.warning(f"Could not await the {endpoint.name} response: {e}")
+    return _request_endpoint(endpoint, symbol, params)
+
+
+def fetch_statements(
+    symbol: str, fetched_until: dict[str, datetime.date] | None = None
+) -> list[dict]:
+    """
+    Fetches every enabled endpoint for the symbol, and returns its statements, those of
+    the endpoints sharing a date and a period merged into one. The errors are raised.
+
+    `fetched_until` maps the endpoint names to the date of the latest statement of the
+    symbol stored. Only the newer statements are requested and returned.
+    """
+    fetched_until = fetched_until or {}
+    today = datetime.date.today()
+
+    statements = {}
+    for endpoint in get_enabled_endpoints():
+        until = fetched_until.get(endpoint.name)
+        limit = endpoint.get_limit(until, today)
+        params = {} if limit is None else {"limit": limit}
+        for statement in request_deduplicated(endpoint, symbol, params):
+            if until and statement.get("date", "") <= until.isoformat():
+                continue
+            merged = statements.setdefault(
+                (statement.get("date"), statement.get("period")),
+                {key: statement.get(key) for key in STATEMENT_KEYS},
+            )
+            # the endpoints share some fields, such as the net income of the cash flows
+            merged.update({key: statement.get(key) for key in endpoint.fields})
+    return list(statements.values())
@@ -0,0 +1,124 @@
+"""
+The financial data API endpoints the ingestion fetches, declared once.
+
+Adding a dataset is adding an Endpoint here and its name to FINANCIAL_DATA_ENDPOINTS.
+The statements endpoints answer a single symbol per request, so a company takes a
+request per enabled endpoint. The client deduplicates the identical requests made at
+the same time, and a refresh only asks for the statements newer than the stored ones.
+The statements of every endpoint sharing a date and a period are stored as one
+FinancialStatement.
+"""
+
+import datetime
+import math
+from dataclasses import dataclass, field
+
+from django.conf import settings
+
+# the fields identifying a statement, whichever endpoint returned it
+STATEMENT_KEYS = ("symbol", "date", "calendarYear", "period", "reportedCurrency")
+
+# the stored fields of the statements, by the FinancialStatement field storing them
+INCOME_STATEMENT_FIELDS = {
+    "revenue": "revenue",
+    "netIncome": "net_income",
+    "grossProfit": "gross_profit",
+    "operatingIncome": "operating_income",
+    "incomeBeforeTax": "income_before_tax",
+    "operatingExpenses": "operating_expenses",
+    "researchAndDevelopmentExpenses": "research_and_development_expenses",
+}
+BALANCE_SHEET_FIELDS = {
+    "cashAndCashEquivalents": "cash_and_cash_equivalents",
+    "totalAssets": "total_assets",
+    "totalLiabilities": "total_liabilities",
+    "totalStockholdersEquity": "total_stockholders_equity",
+    "totalDebt": "total_debt",
+}
+CASH_FLOW_FIELDS = {
+    "operatingCashFlow": "operating_cash_flow",
+    "capitalExpenditure": "capital_expenditure",
+    "freeCashFlow": "free_cash_flow",
+    "dividendsPaid": "dividends_paid",
+}
+
+QUARTERS = ("Q4", "Q3", "Q2", "Q1")
+
+
+@dataclass(frozen=True)
+class Endpoint:
+    name: str
+    # with a {symbol} placeholder
+    path: str
+    # the fields of its statements that are stored, see STATEMENT_KEYS for the others
+    fields: dict[str, str]
+    params: dict = field(default_factory=dict)
+    # the FinancialStatement periods the endpoint returns, the latest first in a year
+    periods: tuple[str, ...] = ("FY",)
+
+    def get_path(self, symbol: str) -> str:
+        return self.path.format(symbol=symbol)
+
+    def get_limit(
+        self, fetched_until: datetime.date | None, today: datetime.date
+    ) -> int | None:
+        """
+        Statements to request for a company whose latest stored statement is from
+        `fetched_until`, the whole history (None) for a company never fetched.
+        """
+        if fetched_until is None:
+            return None
+        return max(1, today.year - fetched_until.year) * len(self.periods)
+
+
+def get_statement_endpoints(
+    name: str, path: str, fields: dict[str, str]
+) -> tuple[Endpoint, Endpoint]:
+    """The annual and the quarterly endpoints of a statement."""
+    return (
+        Endpoint(name=name, path=path, fields=fields, params={"period": "annual"}),
+        Endpoint(
+            name=f"{name}_quarterly",
+            path=path,
+            fields=fields,
+            params={"period": "quarter"},
+            periods=QUARTERS,
+        ),
+    )
+
+
+ENDPOINTS = {
+    endpoint.name: endpoint
+    for endpoint in (
+        *get_statement_endpoints(
+            "income_statement",
+            "/v3/income-statement/{symbol}",
+            INCOME_STATEMENT_FIELDS,
+        ),
+        *get_statement_endpoints(
+            "balance_sheet",
+            "/v3/balance-sheet-statement/{symbol}",
+            BALANCE_SHEET_FIELDS,
+        ),
+        *get_statement_endpoints(
+            "cash_flow",
+            "/v3/cash-flow-statement/{symbol}",
+            CASH_FLOW_FIELDS,
+        ),
+    )
+}
+
+
+def get_enabled_endpoints() -> list[Endpoint]:
+    return [ENDPOINTS[name] for name in settings.FINANCIAL_DATA_ENDPOINTS]
+
+
+def get_requests_per_company() -> int:
+    return len(get_enabled_endpoints())
+
+
+def get_companies_for_requests(requests: int | None) -> int | None:
+    """How many companies a budget of API requests covers, None stays unlimited."""
+    if requests is None:
+        return None
+    return math.floor(requests / get_requests_per_company())
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ingestion.tasks import request_hot_refresh
+
+
+class Command(BaseCommand):
+    help = "Fetches the financial reports of the given companies now, through the hot queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument("symbols", nargs="+")
+
+    def handle(self, *args, **options):
+        companies = request_hot_refresh(options["symbols"])
+        if not companies:
+            raise CommandError("None of the given symbols is a tracked company.")
+
+        missing = set(options["symbols"]) - {symbol for _, symbol in companies}
+        if missing:
+            self.stdout.write(
+                self.style.WARNING(f"Not tracked: {', '.join(sorted(missing))}.")
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f"Queued {len(companies)} companies for a hot refresh.")
+        )
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-19 14:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ingestion", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="apiusage",
+            name="requests_made",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
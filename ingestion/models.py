@@ -4,3 +4,4 @@ from django.db import models
 class ApiUsage(models.Model):
     date = models.DateField(unique=True)
     limit_reached = models.BooleanField(default=False)
+    requests_made = models.PositiveIntegerField(default=0)
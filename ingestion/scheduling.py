@@ -0,0 +1,83 @@
+import datetime
+import math
+import threading
+
+import waffle
+from django.conf import settings
+from django.db.models import F
+
+from ingestion.models import ApiUsage
+from queues import Queues
+
+# lanes of the scheduled fetches, the hot lane is only fed on demand
+REFRESH = "refresh"
+BACKFILL = "backfill"
+
+LANE_QUEUES = {
+    REFRESH: Queues.FETCH_FINANCIAL_REPORT,
+    BACKFILL: Queues.FETCH_FINANCIAL_REPORT_BACKFILL,
+}
+
+_lock = threading.Lock()
+_pending_requests = 0
+
+
+def count_api_request():
+    global _pending_requests
+    with _lock:
+        _pending_requests += 1
+
+
+def flush_api_usage():
+    """Adds the API requests made by this process since the last flush to today's usage."""
+    global _pending_requests
+    with _lock:
+        requests_made, _pending_requests = _pending_requests, 0
+    if not requests_made:
+        return
+
+    today_api_usage, _ = ApiUsage.objects.get_or_create(date=datetime.date.today())
+    ApiUsage.objects.filter(pk=today_api_usage.pk).update(
+        requests_made=F("requests_made") + requests_made
+    )
+
+
+def get_remaining_quota() -> int | None:
+    """Requests left for today, None when the paid plan has no daily limit."""
+    if waffle.switch_is_active("paid-plan"):
+        return None
+
+    today_api_usage = ApiUsage.objects.filter(date=datetime.date.today()).first()
+    if today_api_usage is None:
+        return settings.FINANCIAL_DATA_API_DAILY_QUOTA
+    if today_api_usage.limit_reached:
+        return 0
+    return max(
+        settings.FINANCIAL_DATA_API_DAILY_QUOTA - today_api_usage.requests_made, 0
+    )
+
+
+def plan_dispatch(
+    lanes: dict[str, list], budget: int | None, weights: dict[str, float]
+) -> dict[str, list]:
+    """
+    Splits the budget (in companies) between the lanes according to their weights.
+    The share a lane can't use flows to the others, and a None budget takes everything.
+    """
+    if budget is None:
+        return dict(lanes)
+
+    total_weight = sum(weights[lane] for lane in lanes if lanes[lane]) or 1
+    allocation = {
+        lane: min(len(candidates), math.floor(budget * weights[lane] / total_weight))
+        for lane, candidates in lanes.items()
+    }
+
+    # hand the rounding leftovers and the unused shares out, by weight
+    leftover = budget - sum(allocation.values())
+    for lane in sorted(lanes, key=lambda lane: -weights[lane]):
+        extra = min(leftover, len(lanes[lane]) - allocation[lane])
+        allocation[lane] += extra
+        leftover -= extra
+
+    return {lane: lanes[lane][: allocation[lane]] for lane in lanes}
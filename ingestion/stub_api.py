@@ -0,0 +1,191 @@
+"""
+Local stand-in for the financial data API, used by the benchmarks.
+
+Emulates ``/v3/stock/list`` and the income statement, balance sheet and cash flow
+statement endpoints, annual or quarterly, with generated, deterministic data, a
+configurable response latency and periodic 429 responses.
+"""
+
+import itertools
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import orjson
+
+STOCK_LIST_PATH = "/v3/stock/list"
+
+
+@dataclass
+class StubApiConfig:
+    companies: int = 1000
+    exchange: str = "BENCH"
+    years: int = 5
+    latest_year: int = 2024
+    latency: float = 0.0
+    # every n-th request is answered with a 429, 0 disables it
+    rate_limit_every: int = 0
+
+
+def get_symbol(index: int) -> str:
+    return f"B{index:07d}"
+
+
+def get_stock_list(config: StubApiConfig) -> list[dict]:
+    return [
+        {
+            "symbol": get_symbol(index),
+            "name": f"Benchmark Company {index}",
+            "exchangeShortName": config.exchange,
+        }
+        for index in range(config.companies)
+    ]
+
+
+QUARTERS = (("Q4", "12-31"), ("Q3", "09-30"), ("Q2", "06-30"), ("Q1", "03-31"))
+
+
+def get_income_statement_fields(revenue: float) -> dict:
+    return {
+        "revenue": round(revenue, 2),
+        "grossProfit": round(revenue * 0.4, 2),
+        "researchAndDevelopmentExpenses": round(revenue * 0.1, 2),
+        "operatingExpenses": round(revenue * 0.25, 2),
+        "operatingIncome": round(revenue * 0.15, 2),
+        "incomeBeforeTax": round(revenue * 0.14, 2),
+        "netIncome": round(revenue * 0.11, 2),
+    }
+
+
+def get_balance_sheet_fields(revenue: float) -> dict:
+    return {
+        "cashAndCashEquivalents": round(revenue * 0.2, 2),
+        "totalAssets": round(revenue * 1.5, 2),
+        "totalLiabilities": round(revenue * 0.9, 2),
+        "totalStockholdersEquity": round(revenue * 0.6, 2),
+        "totalDebt": round(revenue * 0.4, 2),
+    }
+
+
+def get_cash_flow_fields(revenue: float) -> dict:
+    return {
+        "netIncome": round(revenue * 0.11, 2),
+        "operatingCashFlow": round(revenue * 0.18, 2),
+        "capitalExpenditure": round(-revenue * 0.05, 2),
+        "freeCashFlow": round(revenue * 0.13, 2),
+        "dividendsPaid": round(-revenue * 0.03, 2),
+    }
+
+
+STATEMENT_PATHS = {
+    "/v3/income-statement/": get_income_statement_fields,
+    "/v3/balance-sheet-statement/": get_balance_sheet_fields,
+    "/v3/cash-flow-statement/": get_cash_flow_fields,
+}
+
+
+def get_statements(
+    config: StubApiConfig,
+    symbol: str,
+    limit: int | None = None,
+    period: str = "annual",
+    get_fields=get_income_statement_fields,
+) -> list[dict]:
+    # symbols are "B" followed by the company index, which seeds the numbers
+    seed = int(symbol[1:]) if symbol[1:].isdigit() else len(symbol)
+    periods = QUARTERS if period == "quarter" else (("FY", "12-31"),)
+    count = config.years * len(periods)
+    statements = []
+    for offset in range(count if limit is None else min(limit, count)):
+        year = config.latest_year - offset // len(periods)
+        period_name, period_end = periods[offset % len(periods)]
+        revenue = (
+            1_000_000
+            * (seed % 997 + 1)
+            * (1 + 0.05 * (count - offset) / len(periods))
+            / (len(periods) if period == "quarter" else 1)
+        )
+        statements.append(
+            {
+                "date": f"{year}-{period_end}",
+                "symbol": symbol,
+                "reportedCurrency": "USD",
+                "calendarYear": str(year),
+                "period": period_name,
+                **get_fields(revenue),
+            }
+        )
+    return statements
+
+
+class StubApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: StubApiConfig, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), StubApiRequestHandler)
+        self.config = config
+        self.request_counter = itertools.count(1)
+        self.stock_list = orjson.dumps(get_stock_list(config))
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def start(self) -> "StubApiServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class StubApiRequestHandler(BaseHTTPRequestHandler):
+    server: StubApiServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        config = self.server.config
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        time.sleep(config.latency)
+
+        request_number = next(self.server.request_counter)
+        if config.rate_limit_every and request_number % config.rate_limit_every == 0:
+            self._send(429, b'{"Error Message": "Limit Reach"}')
+            return
+
+        if url.path.endswith(STOCK_LIST_PATH):
+            self._send(200, self.server.stock_list)
+            return
+
+        for statement_path, get_fields in STATEMENT_PATHS.items():
+            if statement_path in url.path:
+                symbol = url.path.split(statement_path, 1)[1]
+                limit = int(query["limit"][0]) if "limit" in query else None
+                period = query.get("period", ["annual"])[0]
+                statements = get_statements(config, symbol, limit, period, get_fields)
+                self._send(200, orjson.dumps(statements))
+                return
+        self._send(404, b'{"Error Message": "Not found"}')
@@ -1,26 +1,63 @@
 import datetime
 import logging
+import queue
+import random
+import threading
 import time
 from decimal import Decimal
 
 import requests
 import waffle
 from celery import shared_task
-from dateutil.relativedelta import relativedelta
 from django.conf import settings
-from django.db import transaction
-from django.db.models import Q
+from django.db import connection, transaction
+from django.db.models import Max, Q
+from django.utils import timezone
 from tenacity import (
     after_log,
     before_log,
     retry,
     retry_if_exception,
     stop_after_attempt,
-    wait_exponential,
+    wait_random_exponential,
 )
 
+from core.metrics import refresh_financial_metrics
 from core.models import Company, CompanyDataTracker, Currency, FinancialStatement
+from fin_vantage.instrumentation import (
+    DB_WRITE_SECONDS,
+    PARSE_SECONDS,
+    RECORDS_PARSED,
+)
+from fin_vantage.routers import read_replica
+from fin_vantage.serialization import SERIALIZER_NAME
+from ingestion.circuit_breaker import (
+    CircuitOpenError,
+    ConcurrencyTimeoutError,
+    get_retry_after,
+)
+from ingestion.client import (
+    count_retry,
+    fetch_statements,
+    request_financial_data,
+    should_retry_exception,
+)
+from ingestion.endpoints import (
+    BALANCE_SHEET_FIELDS,
+    CASH_FLOW_FIELDS,
+    get_companies_for_requests,
+    get_enabled_endpoints,
+)
 from ingestion.models import ApiUsage
+from ingestion.scheduling import (
+    BACKFILL,
+    LANE_QUEUES,
+    REFRESH,
+    flush_api_usage,
+    get_remaining_quota,
+    plan_dispatch,
+)
+from ingestion.tracking import TrackerUpdates, is_eligible, mark_in_flight
 from queues import Queues
 
 
@@ -43,7 +80,7 @@ def handle_too_many_requests():
     is_paid_plan_active = waffle.switch_is_active("paid-plan")
 
     if is_paid_plan_active:
-        time.sleep(70)  # sleep for 1 minute + a buffer
+        time.sleep(settings.FINANCIAL_DATA_API_RATE_LIMIT_PAUSE)  # 1 minute + a buffer
         return False
     else:
         today_api_usage, _ = ApiUsage.objects.get_or_create(date=datetime.date.today())
@@ -52,13 +89,6 @@ def handle_too_many_requests():
         return True
 
 
-def should_retry_exception(e):
-    if isinstance(e, requests.exceptions.HTTPError):
-        if e.response is not None and e.response.status_code == 429:
-            return False
-    return isinstance(e, requests.exceptions.RequestException)
-
-
 @shared_task
 def sync_companies():
     logger = logging.getLogger("sync_companies")
@@ -71,23 +101,20 @@ def sync_companies():
 
     @retry(
         stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
+        # jittered, the full range, so that the retries don't line up
+        wait=wait_random_exponential(multiplier=4, max=10),
         retry=retry_if_exception(should_retry_exception),
         before=before_log(logger, logging.DEBUG),
         after=after_log(logger, logging.DEBUG),
+        before_sleep=count_retry("stock_list"),
     )
     def get_companies_list():
-        response = requests.get(
-            f"{settings.FINANCIAL_DATA_API_URL}/v3/stock/list",
-            params={"apikey": settings.FINANCIAL_DATA_API_KEY},
-        )
-        response.raise_for_status()
-        return response
+        return request_financial_data("stock_list", "/v3/stock/list")
 
     try:
         companies_list = get_companies_list().json()
     except requests.exceptions.RequestException as e:
-        if e.response.status_code == 429:
+        if e.response is not None and e.response.status_code == 429:
             should_break = handle_too_many_requests()
             logger.info(
                 "API limit reached. Marking today's usage as limit reached."
@@ -97,19 +124,30 @@ def sync_companies():
 
             if should_break:
                 return
+        else:
+            # timeouts and connection errors have no response
+            logger.error(f"Error fetching companies list: {e}. Stopping ...")
+            return
     except Exception as e:
         logger.error(f"Error fetching companies list: {e}. Stopping ...")
         return
+    finally:
+        flush_api_usage()
 
+    parse_start_time = time.perf_counter()
     companies = [
         Company(name=company.get("name"), symbol=company.get("symbol"))
         for company in companies_list
         if company.get("exchangeShortName", "") in settings.STOCK_EXCHANGES
     ]
+    PARSE_SECONDS.inc(time.perf_counter() - parse_start_time, task="sync_companies")
+    RECORDS_PARSED.inc(len(companies_list), task="sync_companies")
 
     count_before = Company.objects.count()
 
-    with transaction.atomic():
+    with DB_WRITE_SECONDS.time(
+        task="sync_companies", model="Company"
+    ), transaction.atomic():
         Company.objects.bulk_create(companies, batch_size=1000, ignore_conflicts=True)
 
         companies_without_tracking = Company.objects.filter(
@@ -133,138 +171,458 @@ def sync_companies():
         logger.info("No new companies were inserted.")
 
 
-@shared_task
+def get_api_reset_time() -> datetime.datetime:
+    """The daily API limit resets at midnight."""
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    return timezone.make_aware(datetime.datetime.combine(tomorrow, datetime.time.min))
+
+
+def get_fetched_until(companies) -> dict[str, dict]:
+    """
+    The date of the latest stored statement of each company, per enabled endpoint,
+    so that a refresh only requests and parses the newer ones.
+    """
+    endpoints = get_enabled_endpoints()
+    symbols = {company_id: symbol for company_id, symbol in companies}
+    rows = (
+        FinancialStatement.objects.filter(company_id__in=list(symbols))
+        .values("company_id")
+        .annotate(
+            **{
+                endpoint.name: Max(
+                    "date_reported", filter=Q(period__in=endpoint.periods)
+                )
+                for endpoint in endpoints
+            }
+        )
+    )
+    return {
+        symbols[row["company_id"]]: {
+            endpoint.name: row[endpoint.name]
+            for endpoint in endpoints
+            if row[endpoint.name] is not None
+        }
+        for row in rows
+    }
+
+
+class FetchOutcome:
+    FAILED = "failed"
+    # the symbol was not at fault, it can be retried right away
+    RATE_LIMITED = "rate_limited"
+    # the daily limit was reached, nothing else can be fetched today
+    STOP = "stop"
+    # the circuit breaker is open, or the fleet is at its concurrency limit, nothing
+    # else can be fetched until it half-opens or the requests in flight drain
+    SHED = "shed"
+
+
+def handle_fetch_error(e: Exception, symbol: str, logger: logging.Logger) -> str:
+    """
+    Logs a failed statements request and returns its FetchOutcome.
+    """
+    if isinstance(e, (CircuitOpenError, ConcurrencyTimeoutError)):
+        logger.warning(f"Not fetching {symbol}: {e}")
+        return FetchOutcome.SHED
+    if isinstance(e, requests.exceptions.RequestException):
+        if e.response is not None and e.response.status_code == 429:
+            should_break = handle_too_many_requests()
+            logger.info(
+                "API limit reached. Marking today's usage as limit reached."
+                if should_break
+                else "API limit reached, to be resumed."
+            )
+
+            return FetchOutcome.STOP if should_break else FetchOutcome.RATE_LIMITED
+
+        logger.error(f"HTTP error for {symbol}: {e}")
+    else:
+        logger.error(f"Other error for {symbol}: {e}")
+    return FetchOutcome.FAILED
+
+
+def get_release_time(outcome: str) -> datetime.datetime:
+    """When the companies skipped after a STOP or SHED outcome are eligible again."""
+    if outcome == FetchOutcome.SHED:
+        # shed with the circuit closed, no request slot freed up in time; the wait is
+        # jittered so the companies don't all come back at once
+        minimum = settings.FINANCIAL_DATA_CONCURRENCY_WAIT_SECONDS * random.uniform(
+            1, 2
+        )
+        return timezone.now() + datetime.timedelta(
+            seconds=max(get_retry_after(), minimum)
+        )
+    return get_api_reset_time()
+
+
+def parse_amount(value) -> Decimal | None:
+    return None if value is None else Decimal(str(value))
+
+
+def parse_financial_statements(
+    company_id: int,
+    symbol: str,
+    company_statements: list[dict],
+    currencies: dict,
+    logger: logging.Logger,
+) -> list[FinancialStatement]:
+    parse_start_time = time.perf_counter()
+
+    financial_statements = []
+    for statement_data in company_statements:
+        currency = currencies.get(statement_data.get("reportedCurrency"))
+        statement_date = statement_data.get("date")
+        if not currency:
+            logger.warning(
+                f"Statement with date {statement_date} for symbol {symbol} was omitted. It lacks a mentioned currency."
+            )
+            continue
+        if statement_data.get("revenue") is None:
+            # a balance sheet or a cash flow statement without its income statement
+            logger.warning(
+                f"Statement with date {statement_date} for symbol {symbol} was omitted. It lacks an income statement."
+            )
+            continue
+
+        financial_statements.append(
+            FinancialStatement(
+                company_id=company_id,
+                date_reported=statement_date,
+                calendar_year=int(statement_data.get("calendarYear")),
+                period=statement_data.get("period"),
+                currency=currency,
+                revenue=Decimal(str(statement_data.get("revenue"))),
+                net_income=Decimal(str(statement_data.get("netIncome"))),
+                gross_profit=Decimal(str(statement_data.get("grossProfit"))),
+                operating_income=Decimal(str(statement_data.get("operatingIncome"))),
+                income_before_tax=Decimal(str(statement_data.get("incomeBeforeTax"))),
+                operating_expenses=Decimal(
+                    str(statement_data.get("operatingExpenses"))
+                ),
+                research_and_development_expenses=Decimal(
+                    str(statement_data.get("researchAndDevelopmentExpenses", 0))
+                ),
+                **{
+                    field: parse_amount(statement_data.get(key))
+                    for key, field in (BALANCE_SHEET_FIELDS | CASH_FLOW_FIELDS).items()
+                },
+            )
+        )
+
+    PARSE_SECONDS.inc(
+        time.perf_counter() - parse_start_time, task="fetch_financial_report"
+    )
+    RECORDS_PARSED.inc(len(company_statements), task="fetch_financial_report")
+    return financial_statements
+
+
+def refresh_metrics_after_fetch(company_ids, logger: logging.Logger):
+    try:
+        refreshed = refresh_financial_metrics(company_ids)
+        logger.info(f"Refreshed financial metrics for {refreshed} company-years.")
+    except Exception as e:
+        logger.error(f"Error refreshing financial metrics: {e}")
+
+
+@shared_task(serializer=SERIALIZER_NAME)
 def fetch_financial_report(companies):
     logger = logging.getLogger("fetch_financial_report")
     today = datetime.date.today()
 
     if not is_api_usable():
         logger.info("API limit reached for today. Skipping sync.")
+        updates = TrackerUpdates()
+        for company_id, _ in companies:
+            updates.release(company_id, get_api_reset_time())
+        updates.flush()
         return
 
     currencies = {currency.code: currency for currency in Currency.objects.all()}
 
     logger.info("Starting fetch_financial_report task ...")
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        retry=retry_if_exception(should_retry_exception),
-        before=before_log(logger, logging.DEBUG),
-        after=after_log(logger, logging.DEBUG),
-    )
-    def get_financial_statements_for_company(symbol: str):
-        time.sleep(0.5)
-        response = requests.get(
-            f"{settings.FINANCIAL_DATA_API_URL}/v3/income-statement/{symbol}",
-            params={"period": "annual", "apikey": settings.FINANCIAL_DATA_API_KEY},
-        )
-        response.raise_for_status()
-        return response
+    if waffle.switch_is_active("pipelined-fetch"):
+        fetch_financial_report_pipelined(companies, currencies, logger)
+        return
 
+    fetched_until = get_fetched_until(companies)
+
+    updates = TrackerUpdates()
+    fetched_company_ids = []
     financial_statements = []
-    for company_id, symbol in companies:
+    for index, (company_id, symbol) in enumerate(companies):
         try:
-            logger.info(f"Fetching data for {symbol}")
-            company_statements = get_financial_statements_for_company(symbol).json()
-        except requests.exceptions.RequestException as e:
-            if e.response.status_code == 429:
-                should_break = handle_too_many_requests()
-                logger.info(
-                    "API limit reached. Marking today's usage as limit reached."
-                    if should_break
-                    else "API limit reached, to be resumed."
-                )
-
-                if should_break:
-                    break
-
-            logger.error(f"HTTP error for {symbol}: {e}")
-            continue
+            logger.debug(f"Fetching data for {symbol}", extra={"symbol": symbol})
+            company_statements = fetch_statements(symbol, fetched_until.get(symbol))
         except Exception as e:
-            logger.error(f"Other error for {symbol}: {e}")
+            outcome = handle_fetch_error(e, symbol, logger)
+            if outcome in (FetchOutcome.STOP, FetchOutcome.SHED):
+                release_time = get_release_time(outcome)
+                for skipped_company_id, _ in companies[index:]:
+                    updates.release(skipped_company_id, release_time)
+                break
+            if outcome == FetchOutcome.RATE_LIMITED:
+                updates.release(company_id)
+            else:
+                updates.fail(company_id)
             continue
 
-        for statement_data in company_statements:
-            currency = currencies.get(statement_data.get("reportedCurrency"))
-            statement_date = statement_data.get("date")
-            if not currency:
-                logger.warning(
-                    f"Statement with date {statement_date} for symbol {symbol} was omitted. It lacks a mentioned currency."
-                )
-                continue
-
-            financial_statements.append(
-                FinancialStatement(
-                    company_id=company_id,
-                    date_reported=statement_date,
-                    calendar_year=int(statement_data.get("calendarYear")),
-                    period=statement_data.get("period"),
-                    currency=currency,
-                    revenue=Decimal(str(statement_data.get("revenue"))),
-                    net_income=Decimal(str(statement_data.get("netIncome"))),
-                    gross_profit=Decimal(str(statement_data.get("grossProfit"))),
-                    operating_income=Decimal(
-                        str(statement_data.get("operatingIncome"))
-                    ),
-                    income_before_tax=Decimal(
-                        str(statement_data.get("incomeBeforeTax"))
-                    ),
-                    operating_expenses=Decimal(
-                        str(statement_data.get("operatingExpenses"))
-                    ),
-                    research_and_development_expenses=Decimal(
-                        str(statement_data.get("researchAndDevelopmentExpenses", 0))
-                    ),
-                )
+        financial_statements.extend(
+            parse_financial_statements(
+                company_id, symbol, company_statements, currencies, logger
             )
+        )
+        fetched_company_ids.append(company_id)
+    updates.flush()
+    flush_api_usage()
 
-    today = datetime.datetime.now().date()
     try:
-        with transaction.atomic():
+        with DB_WRITE_SECONDS.time(
+            task="fetch_financial_report", model="FinancialStatement"
+        ), transaction.atomic():
+            # a yearly refresh returns the already stored statements too
             FinancialStatement.objects.bulk_create(
-                financial_statements, batch_size=1000
+                financial_statements, batch_size=1000, ignore_conflicts=True
             )
-            CompanyDataTracker.objects.filter(
-                company_id__in=[company_id for company_id, _ in companies]
-            ).update(last_financial_report_fetch=today)
+            for company_id in fetched_company_ids:
+                updates.succeed(company_id)
+            updates.flush()
 
         logger.info(
             f"Successfully inserted {len(financial_statements)} financial statements."
         )
     except Exception as e:
         logger.error(f"Database error when storing financial statements: {e}")
+        updates = TrackerUpdates()
+        for company_id in fetched_company_ids:
+            updates.fail(company_id)
+        updates.flush()
+        return
 
+    refresh_metrics_after_fetch(
+        {statement.company_id for statement in financial_statements}, logger
+    )
 
-@shared_task
-def schedule_financial_fetching():
-    logger = logging.getLogger("schedule_financial_fetching")
 
-    logger.info("Starting schedule_financial_fetching task ...")
+_PIPELINE_DONE = object()
+_FETCHED = "fetched"
 
-    # fetch the data for all the companies that have never had their financial statement fetched
-    # or for those that have it fetched 1 year ago
-    one_year_ago = datetime.date.today() - relativedelta(years=1)
-    companies_to_fetch = list(
-        CompanyDataTracker.objects.filter(
-            Q(last_financial_report_fetch__isnull=True)
-            | Q(last_financial_report_fetch__lt=one_year_ago)
-        )
+
+def fetch_financial_report_pipelined(companies, currencies, logger):
+    """
+    Runs fetching, parsing and writing as concurrent stages connected by bounded queues.
+    The network stays busy while the database writes, and every symbol is committed
+    as soon as it is parsed. The tracker outcomes are written in batches, a crash before
+    they are leaves the symbols in flight until their lease expires, and their refetch
+    is idempotent.
+
+    Besides the statements, the queues carry the outcomes of the failed or skipped symbols,
+    so that only the writer touches the trackers.
+    """
+    fetched_until = get_fetched_until(companies)
+    fetched = queue.Queue(maxsize=settings.FETCH_PIPELINE_QUEUE_SIZE)
+    parsed = queue.Queue(maxsize=settings.FETCH_PIPELINE_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def fetch_stage():
+        try:
+            for index, (company_id, symbol) in enumerate(companies):
+                if stopped.is_set():
+                    break
+                try:
+                    logger.debug(
+                        f"Fetching data for {symbol}", extra={"symbol": symbol}
+                    )
+                    company_statements = fetch_statements(
+                        symbol, fetched_until.get(symbol)
+                    )
+                except Exception as e:
+                    outcome = handle_fetch_error(e, symbol, logger)
+                    if outcome in (FetchOutcome.STOP, FetchOutcome.SHED):
+                        for skipped_company_id, skipped_symbol in companies[index:]:
+                            fetched.put(
+                                (
+                                    outcome,
+                                    skipped_company_id,
+                                    skipped_symbol,
+                                    None,
+                                )
+                            )
+                        break
+                    fetched.put((outcome, company_id, symbol, None))
+                    continue
+                fetched.put((_FETCHED, company_id, symbol, company_statements))
+        finally:
+            fetched.put(_PIPELINE_DONE)
+            # handle_too_many_requests may have opened a connection for this thread
+            connection.close()
+
+    def parse_stage():
+        while (item := fetched.get()) is not _PIPELINE_DONE:
+            kind, company_id, symbol, company_statements = item
+            if kind != _FETCHED:
+                parsed.put(item)
+                continue
+            try:
+                statements = parse_financial_statements(
+                    company_id, symbol, company_statements, currencies, logger
+                )
+            except Exception as e:
+                logger.error(f"Parsing error for {symbol}: {e}")
+                parsed.put((FetchOutcome.FAILED, company_id, symbol, None))
+                continue
+            parsed.put((_FETCHED, company_id, symbol, statements))
+        parsed.put(_PIPELINE_DONE)
+
+    stages = [
+        threading.Thread(target=fetch_stage, name="fetch_financial_report.fetch"),
+        threading.Thread(target=parse_stage, name="fetch_financial_report.parse"),
+    ]
+    for stage in stages:
+        stage.start()
+
+    updates = TrackerUpdates()
+    written_company_ids = []
+    statements_count = 0
+    release_times = {}
+    try:
+        while (item := parsed.get()) is not _PIPELINE_DONE:
+            kind, company_id, symbol, statements = item
+            if kind in (FetchOutcome.STOP, FetchOutcome.SHED):
+                if kind not in release_times:
+                    release_times[kind] = get_release_time(kind)
+                updates.release(company_id, release_times[kind])
+                continue
+            elif kind == FetchOutcome.RATE_LIMITED:
+                updates.release(company_id)
+                continue
+            elif kind == FetchOutcome.FAILED:
+                updates.fail(company_id)
+                continue
+
+            try:
+                with DB_WRITE_SECONDS.time(
+                    task="fetch_financial_report", model="FinancialStatement"
+                ), transaction.atomic():
+                    # a refetched symbol may already have some of its statements stored
+                    FinancialStatement.objects.bulk_create(
+                        statements, batch_size=1000, ignore_conflicts=True
+                    )
+            except Exception as e:
+                logger.error(
+                    f"Database error when storing financial statements for {symbol}: {e}"
+                )
+                updates.fail(company_id)
+                continue
+
+            updates.succeed(company_id)
+            written_company_ids.append(company_id)
+            statements_count += len(statements)
+        updates.flush()
+    finally:
+        # if the writer stopped early, the fetching stops at the next symbol
+        # and draining the parsed queue lets the parsing run to its end
+        stopped.set()
+        while any(stage.is_alive() for stage in stages):
+            try:
+                parsed.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        flush_api_usage()
+
+    logger.info(
+        f"Successfully inserted {statements_count} financial statements "
+        f"for {len(written_company_ids)} companies."
+    )
+    refresh_metrics_after_fetch(written_company_ids, logger)
+
+
+def get_companies_to_fetch():
+    # the trackers hold when each company can be fetched again: right away for the new ones,
+    # a year after a success, after a backoff for the failed ones and after the lease
+    # for the in flight ones whose task never reported back
+    return (
+        CompanyDataTracker.objects.filter(is_eligible())
         .select_related("company")
-        .values_list("company_id", "company__symbol")
+        .order_by("next_fetch_eligible_at")
+        .values_list("company_id", "company__symbol", "last_financial_report_fetch")
     )
 
+
+def dispatch_fetching(
+    companies, queue: str, logger: logging.Logger, eligible_only: bool = True
+):
     chunk_size = 20
     chunks = [
-        companies_to_fetch[index : index + chunk_size]
-        for index in range(0, len(companies_to_fetch), chunk_size)
+        companies[index : index + chunk_size]
+        for index in range(0, len(companies), chunk_size)
     ]
 
-    QUEUE = Queues.FETCH_FINANCIAL_REPORT
-
     for chunk in chunks:
+        leased = set(
+            mark_in_flight([company_id for company_id, _ in chunk], eligible_only)
+        )
+        if len(leased) < len(chunk):
+            logger.info(
+                f"Skipped {len(chunk) - len(leased)} companies leased meanwhile."
+            )
+            chunk = [company for company in chunk if company[0] in leased]
+        if not chunk:
+            continue
         fetch_financial_report.apply_async(
             args=[chunk],
-            queue=QUEUE,
+            queue=queue,
+        )
+        logger.info(f"Queued {len(chunk)} companies to {queue}.")
+
+
+@shared_task
+def schedule_financial_fetching():
+    logger = logging.getLogger("schedule_financial_fetching")
+
+    logger.info("Starting schedule_financial_fetching task ...")
+
+    # companies fetched before are refreshes, the never fetched ones are the backfill
+    lanes = {REFRESH: [], BACKFILL: []}
+    with read_replica():
+        for company_id, symbol, last_fetch in get_companies_to_fetch():
+            lanes[BACKFILL if last_fetch is None else REFRESH].append(
+                (company_id, symbol)
+            )
+
+    remaining_quota = get_remaining_quota()
+    logger.info(
+        f"Found {len(lanes[REFRESH])} refreshes and {len(lanes[BACKFILL])} backfills, "
+        + (
+            "no daily quota."
+            if remaining_quota is None
+            else f"{remaining_quota} requests left today."
         )
-        logger.info(f"Queued {len(chunk)} companies to {QUEUE}.")
+    )
+
+    # the quota is in requests, a company takes one per enabled endpoint
+    planned = plan_dispatch(
+        lanes, get_companies_for_requests(remaining_quota), settings.FETCH_LANE_WEIGHTS
+    )
+    for lane, companies in planned.items():
+        dispatch_fetching(companies, LANE_QUEUES[lane], logger)
+
+
+def request_hot_refresh(symbols: list[str]) -> list:
+    """
+    Fetches the given companies right away through the hot lane, bypassing the
+    quota weighting of the scheduled lanes.
+    """
+    companies = list(
+        CompanyDataTracker.objects.filter(company__symbol__in=symbols).values_list(
+            "company_id", "company__symbol"
+        )
+    )
+    # on demand, the companies are fetched whenever they were last
+    dispatch_fetching(
+        companies,
+        Queues.FETCH_FINANCIAL_REPORT_HOT,
+        logging.getLogger("schedule_financial_fetching"),
+        eligible_only=False,
+    )
+    return companies
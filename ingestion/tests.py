@@ -1,3 +1,480 @@
-from django.test import TestCase
+import datetime
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import requests
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from core.models import Company, CompanyDataTracker, Currency
+from ingestion import circuit_breaker
+from ingestion.circuit_breaker import (
+    CircuitOpenError,
+    ConcurrencyTimeoutError,
+    acquire_slot,
+    adjust_limit,
+    enter,
+    guard,
+    is_failure,
+    record,
+)
+from ingestion.client import fetch_statements, get_request_key
+from ingestion.endpoints import ENDPOINTS
+from ingestion.tracking import FetchStatus, TrackerUpdates, mark_in_flight
+from ingestion.tasks import (
+    FetchOutcome,
+    get_release_time,
+    handle_fetch_error,
+    parse_financial_statements,
+)
+
+
+def http_error(status_code: int) -> requests.exceptions.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(response=response)
+
+
+def statement(symbol: str, date: str = "2024-12-31") -> dict:
+    return {"symbol": symbol, "date": date}
+
+
+class FetchStatementsTests(SimpleTestCase):
+    def fetch(self, endpoints, responses, fetched_until=None):
+        """Answers every request with the response of its endpoint, raising the errors."""
+
+        def request_deduplicated(endpoint, symbol, params=None):
+            response = responses[endpoint.name]
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        with mock.patch(
+            "ingestion.client.get_enabled_endpoints",
+            return_value=[ENDPOINTS[name] for name in endpoints],
+        ), mock.patch(
+            "ingestion.client.request_deduplicated", side_effect=request_deduplicated
+        ) as requested:
+            statements = fetch_statements("AAPL", fetched_until)
+        return statements, [call.args[2] for call in requested.call_args_list]
+
+    def test_the_endpoints_are_merged_by_date_and_period(self):
+        statements, _ = self.fetch(
+            ["income_statement", "balance_sheet", "cash_flow"],
+            {
+                "income_statement": [
+                    {**statement("AAPL"), "period": "FY", "netIncome": 10},
+                    {**statement("AAPL", "2023-12-31"), "period": "FY", "netIncome": 8},
+                ],
+                "balance_sheet": [
+                    {**statement("AAPL"), "period": "FY", "totalAssets": 100}
+                ],
+                # the net income of the cash flows isn't the one stored
+                "cash_flow": [
+                    {
+                        **statement("AAPL"),
+                        "period": "FY",
+                        "netIncome": 11,
+                        "freeCashFlow": 5,
+                    }
+                ],
+            },
+        )
+
+        self.assertEqual(len(statements), 2)
+        latest = statements[0]
+        self.assertEqual(latest["date"], "2024-12-31")
+        self.assertEqual(latest["netIncome"], 10)
+        self.assertEqual(latest["totalAssets"], 100)
+        self.assertEqual(latest["freeCashFlow"], 5)
+        self.assertNotIn("totalAssets", statements[1])
+
+    def test_annual_and_quarterly_statements_stay_apart(self):
+        statements, _ = self.fetch(
+            ["income_statement", "income_statement_quarterly"],
+            {
+                "income_statement": [{**statement("AAPL"), "period": "FY"}],
+                "income_statement_quarterly": [{**statement("AAPL"), "period": "Q4"}],
+            },
+        )
+
+        self.assertEqual([s["period"] for s in statements], ["FY", "Q4"])
+
+    def test_only_the_newer_statements_are_requested(self):
+        statements, requested = self.fetch(
+            ["income_statement", "income_statement_quarterly"],
+            {
+                "income_statement": [
+                    {**statement("AAPL"), "period": "FY"},
+                    {**statement("AAPL", "2023-12-31"), "period": "FY"},
+                ],
+                "income_statement_quarterly": [],
+            },
+            fetched_until={"income_statement": datetime.date(2023, 12, 31)},
+        )
+
+        today = datetime.date.today()
+        self.assertEqual(requested, [{"limit": today.year - 2023}, {}])
+        self.assertEqual([s["date"] for s in statements], ["2024-12-31"])
+
+    def test_errors_are_raised(self):
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.fetch(
+                ["income_statement", "balance_sheet"],
+                {
+                    "income_statement": [statement("AAPL")],
+                    "balance_sheet": http_error(404),
+                },
+            )
+
+
+class RequestKeyTests(SimpleTestCase):
+    def test_deployments_dont_share_responses(self):
+        endpoint = ENDPOINTS["income_statement"]
+        key = get_request_key(endpoint, "AAPL", {})
+
+        with override_settings(FINANCIAL_DATA_API_URL="http://127.0.0.1:8000/api"):
+            self.assertNotEqual(get_request_key(endpoint, "AAPL", {}), key)
+        with override_settings(FINANCIAL_DATA_API_KEY="another key"):
+            self.assertNotEqual(get_request_key(endpoint, "AAPL", {}), key)
+        self.assertNotEqual(get_request_key(endpoint, "AAPL", {"limit": 1}), key)
+        self.assertEqual(get_request_key(endpoint, "AAPL", {}), key)
+
+
+class ParseFinancialStatementsTests(SimpleTestCase):
+    currencies = {"USD": Currency(code="USD", symbol="$")}
+
+    def parse(self, company_statements):
+        return parse_financial_statements(
+            1, "AAPL", company_statements, self.currencies, mock.Mock()
+        )
+
+    def income_statement(self, **fields):
+        return {
+            **statement("AAPL"),
+            "calendarYear": "2024",
+            "period": "FY",
+            "reportedCurrency": "USD",
+            "revenue": 100,
+            "netIncome": 10,
+            "grossProfit": 40,
+            "operatingIncome": 15,
+            "incomeBeforeTax": 14,
+            "operatingExpenses": 25,
+            **fields,
+        }
+
+    def test_balance_sheet_and_cash_flow_fields(self):
+        [parsed] = self.parse(
+            [self.income_statement(totalAssets=150.5, freeCashFlow=-3)]
+        )
+
+        self.assertEqual(parsed.revenue, Decimal(100))
+        self.assertEqual(parsed.research_and_development_expenses, 0)
+        self.assertEqual(parsed.total_assets, Decimal("150.5"))
+        self.assertEqual(parsed.free_cash_flow, Decimal(-3))
+        self.assertIsNone(parsed.total_debt)
+
+    def test_statements_without_income_statement_are_skipped(self):
+        balance_sheet = {
+            **statement("AAPL"),
+            "period": "FY",
+            "reportedCurrency": "USD",
+            "totalAssets": 150,
+        }
+
+        self.assertEqual(self.parse([balance_sheet]), [])
+
+
+class IsFailureTests(SimpleTestCase):
+    def test_the_provider_failing(self):
+        for e in (
+            http_error(429),
+            http_error(500),
+            http_error(503),
+            requests.exceptions.Timeout(),
+            requests.exceptions.ConnectionError(),
+        ):
+            with self.subTest(e=e):
+                self.assertTrue(is_failure(e))
+
+    def test_the_request_at_fault(self):
+        for e in (None, http_error(400), http_error(404), ValueError()):
+            with self.subTest(e=e):
+                self.assertFalse(is_failure(e))
+
+
+class HandleFetchErrorTests(SimpleTestCase):
+    def test_shed_requests_stop_the_fetch(self):
+        logger = mock.Mock()
+        for e in (CircuitOpenError(10), ConcurrencyTimeoutError()):
+            with self.subTest(e=e):
+                self.assertEqual(
+                    handle_fetch_error(e, "AAPL", logger), FetchOutcome.SHED
+                )
+
+    def test_a_refused_symbol_fails(self):
+        self.assertEqual(
+            handle_fetch_error(http_error(404), "AAPL", mock.Mock()),
+            FetchOutcome.FAILED,
+        )
+
+
+@override_settings(FINANCIAL_DATA_CONCURRENCY_WAIT_SECONDS=60)
+class GetReleaseTimeTests(SimpleTestCase):
+    def get_release_seconds(self, retry_after: float) -> float:
+        with mock.patch("ingestion.tasks.get_retry_after", return_value=retry_after):
+            release_time = get_release_time(FetchOutcome.SHED)
+        return (release_time - timezone.now()).total_seconds()
+
+    def test_shed_with_the_circuit_closed_waits_for_a_slot(self):
+        self.assertTrue(59 < self.get_release_seconds(0) <= 120)
+
+    def test_shed_with_the_circuit_open_waits_for_it(self):
+        self.assertTrue(299 < self.get_release_seconds(300) <= 300)
+
+
+class FakeRedisTestCase(SimpleTestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeRedis()
+        patcher = mock.patch.multiple(circuit_breaker, _client=self.client, _scripts={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+@override_settings(
+    FINANCIAL_DATA_BREAKER_ENABLED=True,
+    FINANCIAL_DATA_BREAKER_WINDOW=60,
+    FINANCIAL_DATA_BREAKER_MIN_REQUESTS=4,
+    FINANCIAL_DATA_BREAKER_ERROR_RATE=0.5,
+    FINANCIAL_DATA_BREAKER_OPEN_SECONDS=10,
+    FINANCIAL_DATA_BREAKER_MAX_OPEN_SECONDS=30,
+    FINANCIAL_DATA_API_TIMEOUT=5,
+    FINANCIAL_DATA_CONCURRENCY_INITIAL=4,
+    FINANCIAL_DATA_CONCURRENCY_WAIT_SECONDS=0,
+)
+class CircuitBreakerTests(FakeRedisTestCase):
+    def trip(self):
+        record(False, is_probe=False)
+        for _ in range(3):
+            record(True, is_probe=False)
+
+    def half_open(self):
+        # as if the open state expired
+        self.client.delete(circuit_breaker.STATE_KEY)
+
+    def test_closed(self):
+        self.assertFalse(enter("income_statement"))
+
+    def test_opens_past_the_error_rate(self):
+        record(False, is_probe=False)
+        record(True, is_probe=False)
+        record(True, is_probe=False)
+        self.assertFalse(enter("income_statement"))
+
+        record(True, is_probe=False)
+
+        with self.assertRaises(CircuitOpenError) as raised:
+            enter("income_statement")
+        self.assertAlmostEqual(raised.exception.retry_after, 10, delta=1)
+
+    def test_too_few_requests_dont_open_it(self):
+        for _ in range(3):
+            record(True, is_probe=False)
+
+        self.assertFalse(enter("income_statement"))
+
+    def test_a_single_probe_when_half_open(self):
+        self.trip()
+        self.half_open()
+
+        self.assertTrue(enter("income_statement"))
+        with self.assertRaises(CircuitOpenError):
+            enter("income_statement")
+
+    def test_a_successful_probe_closes_it(self):
+        self.trip()
+        self.half_open()
+        enter("income_statement")
+
+        record(False, is_probe=True)
+
+        self.assertFalse(enter("income_statement"))
+        # the failures that opened it are forgotten
+        record(True, is_probe=False)
+        self.assertFalse(enter("income_statement"))
+
+    def test_a_failed_probe_doubles_the_open_time(self):
+        self.trip()
+        for open_seconds in (20, 30, 30):
+            with self.subTest(open_seconds=open_seconds):
+                self.half_open()
+                enter("income_statement")
+
+                record(True, is_probe=True)
+
+                ttl = self.client.pttl(circuit_breaker.STATE_KEY) / 1000
+                self.assertAlmostEqual(ttl, open_seconds, delta=1)
+                with self.assertRaises(CircuitOpenError):
+                    enter("income_statement")
+
+    def test_guard_records_the_outcome(self):
+        for _ in range(4):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                with guard("income_statement"):
+                    raise http_error(503)
+
+        with self.assertRaises(CircuitOpenError):
+            with guard("income_statement"):
+                pass
+        # the slots were freed
+        self.assertEqual(self.client.zcard(circuit_breaker.IN_FLIGHT_KEY), 0)
+
+    def test_refused_requests_dont_open_it(self):
+        for _ in range(4):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                with guard("income_statement"):
+                    raise http_error(404)
+
+        with guard("income_statement"):
+            pass
+
+
+@override_settings(
+    FINANCIAL_DATA_CONCURRENCY_INITIAL=2,
+    FINANCIAL_DATA_CONCURRENCY_MIN=1,
+    FINANCIAL_DATA_CONCURRENCY_MAX=3,
+    FINANCIAL_DATA_CONCURRENCY_DECREASE=0.5,
+    FINANCIAL_DATA_CONCURRENCY_DECREASE_SECONDS=5,
+    FINANCIAL_DATA_CONCURRENCY_WAIT_SECONDS=0,
+)
+class ConcurrencyLimitTests(FakeRedisTestCase):
+    def get_limit(self) -> float:
+        return float(self.client.get(circuit_breaker.LIMIT_KEY))
+
+    def test_slots_up_to_the_limit(self):
+        _, is_saturated = acquire_slot("income_statement")
+        self.assertFalse(is_saturated)
+        _, is_saturated = acquire_slot("income_statement")
+        self.assertTrue(is_saturated)
+
+        with self.assertRaises(ConcurrencyTimeoutError):
+            acquire_slot("income_statement")
+
+    def test_a_freed_slot_is_taken_again(self):
+        token, _ = acquire_slot("income_statement")
+        acquire_slot("income_statement")
+
+        self.client.zrem(circuit_breaker.IN_FLIGHT_KEY, token)
+
+        _, is_saturated = acquire_slot("income_statement")
+        self.assertTrue(is_saturated)
+
+    def test_expired_slots_are_freed(self):
+        self.client.zadd(circuit_breaker.IN_FLIGHT_KEY, {"dead": 0, "dead too": 1})
+
+        acquire_slot("income_statement")
+
+        self.assertEqual(self.client.zcard(circuit_breaker.IN_FLIGHT_KEY), 1)
+
+    def test_increases_only_when_saturated(self):
+        adjust_limit(failed=False, is_saturated=False)
+        self.assertIsNone(self.client.get(circuit_breaker.LIMIT_KEY))
+
+        adjust_limit(failed=False, is_saturated=True)
+        self.assertAlmostEqual(self.get_limit(), 2.5)
+        adjust_limit(failed=False, is_saturated=True)
+        self.assertAlmostEqual(self.get_limit(), 2.9)
+        adjust_limit(failed=False, is_saturated=True)
+        self.assertAlmostEqual(self.get_limit(), 3)
+
+    def test_decreases_once_per_period(self):
+        adjust_limit(failed=True, is_saturated=False)
+        self.assertAlmostEqual(self.get_limit(), 1)
+
+        self.client.set(circuit_breaker.LIMIT_KEY, 3)
+        adjust_limit(failed=True, is_saturated=False)
+        self.assertAlmostEqual(self.get_limit(), 3)
+
+        self.client.delete(circuit_breaker.DECREASED_KEY)
+        adjust_limit(failed=True, is_saturated=True)
+        self.assertAlmostEqual(self.get_limit(), 1.5)
+        # a slot is a whole request
+        self.client.delete(circuit_breaker.DECREASED_KEY)
+        adjust_limit(failed=True, is_saturated=True)
+        self.assertAlmostEqual(self.get_limit(), 1)
+
+
+@override_settings(FETCH_LEASE_SECONDS=3600, FETCH_MAX_BACKOFF_HOURS=8)
+class TrackingTests(TestCase):
+    def create_tracker(self, symbol: str, **fields) -> CompanyDataTracker:
+        company = Company.objects.create(name=symbol, symbol=symbol)
+        return CompanyDataTracker.objects.create(company=company, **fields)
+
+    def get_eligible_in(self, tracker: CompanyDataTracker) -> datetime.timedelta:
+        tracker.refresh_from_db()
+        return tracker.next_fetch_eligible_at - timezone.now()
+
+    def test_only_the_eligible_companies_are_leased(self):
+        eligible = self.create_tracker("AAPL")
+        leased = self.create_tracker(
+            "MSFT",
+            fetch_status=FetchStatus.IN_FLIGHT,
+            next_fetch_eligible_at=timezone.now() + datetime.timedelta(hours=1),
+        )
+
+        self.assertEqual(
+            mark_in_flight([eligible.company_id, leased.company_id]),
+            [eligible.company_id],
+        )
+        eligible.refresh_from_db()
+        self.assertEqual(eligible.fetch_status, FetchStatus.IN_FLIGHT)
+        self.assertAlmostEqual(
+            self.get_eligible_in(eligible).total_seconds(), 3600, delta=60
+        )
+
+    def test_hot_refreshes_lease_any_company(self):
+        leased = self.create_tracker(
+            "MSFT", next_fetch_eligible_at=timezone.now() + datetime.timedelta(days=1)
+        )
+
+        self.assertEqual(
+            mark_in_flight([leased.company_id], eligible_only=False),
+            [leased.company_id],
+        )
+
+    def test_failures_back_off_exponentially_up_to_the_cap(self):
+        cases = [(0, 1), (2, 4), (3, 8), (10, 8)]
+        trackers = {
+            attempts: self.create_tracker(f"C{attempts}", fetch_attempts=attempts)
+            for attempts, _ in cases
+        }
+
+        updates = TrackerUpdates(batch_size=100)
+        for tracker in trackers.values():
+            updates.fail(tracker.company_id)
+        updates.flush()
+
+        for attempts, hours in cases:
+            with self.subTest(attempts=attempts):
+                tracker = trackers[attempts]
+                self.assertAlmostEqual(
+                    self.get_eligible_in(tracker).total_seconds(),
+                    hours * 3600,
+                    delta=60,
+                )
+                self.assertEqual(tracker.fetch_status, FetchStatus.FAILED)
+                self.assertEqual(tracker.fetch_attempts, attempts + 1)
+
+    def test_success_resets_the_attempts(self):
+        tracker = self.create_tracker("AAPL", fetch_attempts=3)
+
+        updates = TrackerUpdates(batch_size=100)
+        updates.succeed(tracker.company_id)
+        updates.flush()
+
+        tracker.refresh_from_db()
+        self.assertEqual(tracker.fetch_status, FetchStatus.SUCCEEDED)
+        self.assertEqual(tracker.fetch_attempts, 0)
+        self.assertEqual(tracker.last_financial_report_fetch, datetime.date.today())
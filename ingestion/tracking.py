@@ -0,0 +1,115 @@
+import datetime
+
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import DurationField, ExpressionWrapper, F, Q, Value
+from django.db.models.functions import Least, Now, Power
+from django.utils import timezone
+
+from core.models import CompanyDataTracker
+
+FetchStatus = CompanyDataTracker.FetchStatus
+
+
+def is_eligible() -> Q:
+    """The trackers of the companies that can be fetched now."""
+    return Q(next_fetch_eligible_at__isnull=True) | Q(
+        next_fetch_eligible_at__lte=timezone.now()
+    )
+
+
+def mark_in_flight(company_ids: list[int], eligible_only: bool = True) -> list[int]:
+    """
+    Leases the companies to a fetch task, they are rescheduled if the lease expires.
+    The companies are read from a replica, those no longer eligible on the primary,
+    or being leased by another scheduler, are left out. Returns the leased ones.
+    """
+    with transaction.atomic():
+        trackers = CompanyDataTracker.objects.filter(company_id__in=company_ids)
+        if eligible_only:
+            # checked again on the locked rows, as they are on the primary
+            trackers = trackers.filter(is_eligible())
+        leased = list(
+            trackers.select_for_update(skip_locked=True).values_list(
+                "company_id", flat=True
+            )
+        )
+        CompanyDataTracker.objects.filter(company_id__in=leased).update(
+            fetch_status=FetchStatus.IN_FLIGHT,
+            next_fetch_eligible_at=timezone.now()
+            + datetime.timedelta(seconds=settings.FETCH_LEASE_SECONDS),
+        )
+    return leased
+
+
+class TrackerUpdates:
+    """
+    Buffers the per symbol outcomes of a fetch task and writes them to the
+    trackers in a few bulk updates, once `batch_size` outcomes are pending.
+    """
+
+    def __init__(self, batch_size: int | None = None):
+        self.batch_size = batch_size or settings.TRACKER_UPDATE_BATCH_SIZE
+        self.succeeded = []
+        self.failed = []
+        self.released = []
+
+    def __len__(self):
+        return len(self.succeeded) + len(self.failed) + len(self.released)
+
+    def _added(self):
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def succeed(self, company_id: int):
+        self.succeeded.append(company_id)
+        self._added()
+
+    def fail(self, company_id: int):
+        self.failed.append(company_id)
+        self._added()
+
+    def release(self, company_id: int, eligible_at: datetime.datetime | None = None):
+        """
+        The company wasn't attempted, it goes back to pending without counting an attempt,
+        and becomes eligible again at `eligible_at`, or right away.
+        """
+        self.released.append((company_id, eligible_at))
+        self._added()
+
+    def flush(self):
+        if self.succeeded:
+            CompanyDataTracker.objects.filter(company_id__in=self.succeeded).update(
+                fetch_status=FetchStatus.SUCCEEDED,
+                fetch_attempts=0,
+                last_financial_report_fetch=datetime.date.today(),
+                next_fetch_eligible_at=timezone.now() + relativedelta(years=1),
+            )
+
+        if self.failed:
+            # exponential backoff, 1h after the first failure, capped
+            backoff = ExpressionWrapper(
+                Value(datetime.timedelta(hours=1))
+                * Least(
+                    Power(2, F("fetch_attempts")),
+                    Value(settings.FETCH_MAX_BACKOFF_HOURS),
+                ),
+                output_field=DurationField(),
+            )
+            CompanyDataTracker.objects.filter(company_id__in=self.failed).update(
+                fetch_status=FetchStatus.FAILED,
+                fetch_attempts=F("fetch_attempts") + 1,
+                next_fetch_eligible_at=Now() + backoff,
+            )
+
+        released_by_eligibility = {}
+        for company_id, eligible_at in self.released:
+            released_by_eligibility.setdefault(eligible_at, []).append(company_id)
+        for eligible_at, company_ids in released_by_eligibility.items():
+            CompanyDataTracker.objects.filter(company_id__in=company_ids).update(
+                fetch_status=FetchStatus.PENDING,
+                next_fetch_eligible_at=eligible_at,
+            )
+
+        self.succeeded, self.failed, self.released = [], [], []
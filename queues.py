@@ -1,3 +1,10 @@
 class Queues:
+    # financial report fetching lanes, each one served by its own workers
+    FETCH_FINANCIAL_REPORT_HOT = "fetch_financial_report_hot"
     FETCH_FINANCIAL_REPORT = "fetch_financial_report"
-    FINANCIAL_SENTENCES = "financial_sentences"
\ No newline at end of file
+    FETCH_FINANCIAL_REPORT_BACKFILL = "fetch_financial_report_backfill"
+
+    FINANCIAL_SENTENCES = "financial_sentences"
+
+    # the jobs scanning every company, on workers without the default time limits
+    SCHEDULING = "scheduling"